@@ -0,0 +1,146 @@
+# app_logging.py
+
+import json
+import logging
+import sys
+
+# Levels of the tool's output:
+# - quiet: per-sheet summaries, warnings and errors
+# - normal: plus progress messages (which sheet is processed, cache use, ...)
+# - verbose: plus one line for every cell that is changed
+SUMMARY = 25
+logging.addLevelName(SUMMARY, 'SUMMARY')
+
+LOG_LEVELS = {
+    'quiet': SUMMARY,
+    'normal': logging.INFO,
+    'verbose': logging.DEBUG,
+}
+
+ROOT_LOGGER = 'formula_cell_mapper'
+
+# Number of change records kept in memory before they are written out
+DEFAULT_BUFFER_SIZE = 1000
+
+
+def get_logger(name):
+    """
+    Returns the logger of a module.
+
+    Messages use %-style arguments, e.g. log.debug("Updated %s", coord), so
+    they are only formatted when the level is enabled.
+    """
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+class _ConsoleFormatter(logging.Formatter):
+    """Plain message lines; warnings and errors start with 'Warning: ' or 'Error: '."""
+
+    def format(self, record):
+        message = super().format(record)
+        if record.levelno >= logging.ERROR:
+            return 'Error: ' + message
+        if record.levelno >= logging.WARNING:
+            return 'Warning: ' + message
+        return message
+
+
+def _setup_root_logger():
+    """Sends the tool's messages to stdout as plain lines, at the normal level."""
+    logger = logging.getLogger(ROOT_LOGGER)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(_ConsoleFormatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+        logger.setLevel(LOG_LEVELS['normal'])
+    return logger
+
+
+def configure_logging(level='normal', change_log_path=None):
+    """
+    Sets the output level and, optionally, the JSONL file for change records.
+
+    Parameters:
+    - level: 'quiet', 'normal' or 'verbose'
+    - change_log_path: Path of the JSONL file that receives one record per
+      changed cell (None disables the change log)
+    """
+    _setup_root_logger().setLevel(LOG_LEVELS[level])
+    set_change_log(change_log_path)
+
+
+def progress_enabled():
+    """Returns True if progress bars should be shown (normal and verbose levels)."""
+    return logging.getLogger(ROOT_LOGGER).getEffectiveLevel() <= logging.INFO
+
+
+class ChangeLog:
+    """
+    Buffered JSONL writer for per-cell change records.
+
+    Records are collected in memory and appended to the file every
+    buffer_size records and on flush()/close(), so the hot loops never
+    wait for terminal or disk I/O per cell. Without a path, record() is
+    a no-op; callers can check `enabled` to skip building the record.
+
+    Parameters:
+    - path: Path of the JSONL file, or None to disable the log
+    - buffer_size: Number of records kept in memory before writing
+    """
+
+    def __init__(self, path=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.path = path
+        self.enabled = path is not None
+        self._buffer = []
+        self._buffer_size = buffer_size
+
+    def record(self, kind, sheet, cell, old, new, **extra):
+        """
+        Adds one change record.
+
+        Parameters:
+        - kind: What changed, e.g. 'formula' or 'defined_name'
+        - sheet: Sheet name
+        - cell: Cell coordinate ('L404')
+        - old: Value before the change
+        - new: Value after the change
+        - extra: Additional fields stored with the record
+        """
+        if not self.enabled:
+            return
+        entry = {'kind': kind, 'sheet': sheet, 'cell': cell, 'old': old, 'new': new}
+        entry.update(extra)
+        self._buffer.append(entry)
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered records to the file."""
+        if not self._buffer:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(entry, default=str) + '\n' for entry in self._buffer)
+        self._buffer = []
+
+    def close(self):
+        """Writes the remaining records."""
+        if self.enabled:
+            self.flush()
+
+
+_setup_root_logger()
+_change_log = ChangeLog()
+
+
+def set_change_log(path, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Replaces the process-wide change log, flushing the previous one."""
+    global _change_log
+    _change_log.close()
+    _change_log = ChangeLog(path, buffer_size)
+    return _change_log
+
+
+def get_change_log():
+    """Returns the process-wide change log."""
+    return _change_log
@@ -0,0 +1,322 @@
+# batch.py
+
+"""
+Headless entry point: runs the named-range and formula steps of main.py over
+many workbooks, driven by a job file instead of prompts.
+
+Usage:
+    python batch.py job.json [--workers N] [--summary results.json]
+                             [--log-level quiet|normal|verbose] [--change-log-dir DIR]
+
+Job file (JSON, or YAML when PyYAML is installed):
+
+    {
+      "files": ["clients/**/*.xlsx", "extra/Client 42.xlsx"],
+      "named_ranges": [
+        {"sheet": "Tax Calculation", "type": "with_prefix", "prefix": "display_code_",
+         "cell_range": "L200:L408", "search_columns": ["J", "K"]}
+      ],
+      "update_formulas": {"sheets": "all", "skip_sheets": ["KORF VL"]},
+      "save": {"mode": "save_as_new"},
+      "workers": 4
+    }
+
+- files: Paths or glob patterns, relative to the job file
+- named_ranges: Configurations as collected by main.py, plus the sheet they apply to
+- update_formulas: false to skip the step; "sheets" is "all" or a list of sheet names,
+  "skip_sheets" defaults to formula_updater.SHEETS_TO_SKIP. Sheets left unchanged since
+  the last saved run (see run_manifest) are not rewritten again
+- save: "mode" is "overwrite", "save_as_new" (default, adds "prefix", default 'updated_'),
+  "output_dir" (same file name in "directory") or "none" (dry run)
+- workers: Number of workbooks processed at the same time (default: number of CPUs)
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import openpyxl
+from tqdm import tqdm
+from formula_updater import SHEETS_TO_SKIP, update_workbook_formulas
+from name_index import NameIndex
+from run_manifest import RunManifest
+from named_range_planner import add_named_range_configurations
+from app_logging import LOG_LEVELS, configure_logging, get_change_log, get_logger, set_change_log
+from metrics import Metrics, set_metrics
+
+try:
+    import yaml
+except ImportError:  # YAML job files are optional
+    yaml = None
+
+log = get_logger(__name__)
+
+SAVE_MODES = ['overwrite', 'save_as_new', 'output_dir', 'none']
+
+def load_job(job_path):
+    """
+    Reads and validates a job file.
+
+    Parameters:
+    - job_path: Path to a .json, .yaml or .yml job file
+
+    Returns:
+    - Job dict with defaults filled in
+
+    Raises:
+    - ValueError if the job file is invalid
+    """
+    with open(job_path, encoding='utf-8') as f:
+        if job_path.lower().endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError("YAML job files need PyYAML (pip install pyyaml); use JSON instead.")
+            try:
+                job = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(f"Invalid YAML: {e}")
+        else:
+            job = json.load(f)
+
+    if not isinstance(job, dict):
+        raise ValueError("The job file must contain a mapping at the top level.")
+    if not job.get('files'):
+        raise ValueError("The job file must list at least one entry in 'files'.")
+
+    base_dir = os.path.dirname(os.path.abspath(job_path))
+    job['files'] = [os.path.join(base_dir, pattern) for pattern in job['files']]
+    job['named_ranges'] = [_validate_configuration(config) for config in job.get('named_ranges') or []]
+
+    update = job.get('update_formulas', {})
+    if update is not False:
+        update = dict(update or {})
+        update.setdefault('sheets', 'all')
+        update.setdefault('skip_sheets', SHEETS_TO_SKIP if update['sheets'] == 'all' else [])
+    job['update_formulas'] = update
+
+    save = dict(job.get('save') or {})
+    save.setdefault('mode', 'save_as_new')
+    if save['mode'] not in SAVE_MODES:
+        raise ValueError(f"Unknown save mode '{save['mode']}'. Use one of: {', '.join(SAVE_MODES)}.")
+    if save['mode'] == 'output_dir':
+        if not save.get('directory'):
+            raise ValueError("Save mode 'output_dir' needs a 'directory'.")
+        save['directory'] = os.path.join(base_dir, save['directory'])
+    save.setdefault('prefix', 'updated_')
+    job['save'] = save
+    return job
+
+def _validate_configuration(config):
+    """Checks one named range configuration and normalises its search columns."""
+    config = dict(config)
+    for key in ['sheet', 'cell_range', 'search_columns']:
+        if not config.get(key):
+            raise ValueError(f"Named range configuration {config} is missing '{key}'.")
+    config.setdefault('type', 'with_prefix' if config.get('prefix') else 'without_prefix')
+    if config['type'] not in ['with_prefix', 'without_prefix']:
+        raise ValueError(f"Unknown named range type '{config['type']}'.")
+    if config['type'] == 'with_prefix' and not config.get('prefix'):
+        raise ValueError(f"Named range configuration {config} needs a 'prefix'.")
+
+    search_columns = config['search_columns']
+    if isinstance(search_columns, str):
+        search_columns = search_columns.split(',')
+    search_columns = [col.strip().upper() for col in search_columns]
+    # Same rule as the interactive prompt: single column letters A-Z
+    valid_columns = [chr(i) for i in range(ord('A'), ord('Z')+1)]
+    invalid_cols = [col for col in search_columns if col not in valid_columns]
+    if invalid_cols:
+        raise ValueError(f"Invalid column letters detected: {', '.join(invalid_cols)}.")
+    config['search_columns'] = search_columns
+    return config
+
+def expand_files(patterns):
+    """
+    Expands file paths and glob patterns into a sorted list of unique .xlsx files.
+    Excel lock files ('~$...') are left out.
+    """
+    files = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True) if glob.has_magic(pattern) else [pattern]
+        for path in matches:
+            if os.path.isfile(path) and not os.path.basename(path).startswith('~$'):
+                files.add(os.path.abspath(path))
+    return sorted(files)
+
+def output_path_for(file_path, save):
+    """Returns the path a processed workbook is saved to, or None for a dry run."""
+    directory, file_name = os.path.split(file_path)
+    if save['mode'] == 'overwrite':
+        return file_path
+    if save['mode'] == 'save_as_new':
+        return os.path.join(directory, save['prefix'] + file_name)
+    if save['mode'] == 'output_dir':
+        return os.path.join(save['directory'], file_name)
+    return None
+
+def _sheets_to_update(sheet_names, update):
+    """Applies the 'sheets' and 'skip_sheets' settings to a workbook's sheet list."""
+    if update['sheets'] == 'all':
+        selected = sheet_names
+    else:
+        selected = [name for name in update['sheets'] if name in sheet_names]
+    return [name for name in selected if name not in update['skip_sheets']]
+
+def _init_worker(log_level):
+    """Process pool initializer: applies the output level in every worker."""
+    configure_logging(log_level)
+
+def process_workbook(file_path, job, change_log_dir=None):
+    """
+    Runs the job on one workbook. Meant to run in a worker process.
+
+    Parameters:
+    - file_path: Path to the .xlsx file
+    - job: Job dict from load_job
+    - change_log_dir: Directory receiving '<file name>.changes.jsonl' with one
+      record per changed cell (None disables the change log)
+
+    Returns:
+    - Result dict with 'file', 'status' ('ok' or 'error'), 'output', 'named_ranges',
+      'formulas_updated', 'missing_sheets', 'seconds', 'metrics' (phase timings
+      and counters, see metrics.Metrics) and, on failure, 'error'
+    """
+    started = time.perf_counter()
+    result = {
+        'file': file_path, 'status': 'ok', 'output': None,
+        'named_ranges': 0, 'formulas_updated': 0, 'missing_sheets': [],
+    }
+    metrics = set_metrics(Metrics())
+    if change_log_dir is not None:
+        set_change_log(os.path.join(change_log_dir, os.path.basename(file_path) + '.changes.jsonl'))
+    try:
+        with metrics.phase('load'):
+            wb = openpyxl.load_workbook(file_path)
+        name_index = NameIndex.load_or_build(wb, file_path)
+
+        # Named ranges, one planned scan per sheet
+        configs_by_sheet = {}
+        for config in job['named_ranges']:
+            configs_by_sheet.setdefault(config['sheet'], []).append(config)
+        for sheet_name, configurations in configs_by_sheet.items():
+            if sheet_name not in wb.sheetnames:
+                result['missing_sheets'].append(sheet_name)
+                continue
+            created = add_named_range_configurations(wb, wb[sheet_name], configurations, name_index=name_index)
+            if created is None:
+                raise ValueError(f"Named range configurations for '{sheet_name}' could not be applied.")
+            result['named_ranges'] += created
+
+        # Formula update; this process is already one of the pool's workers
+        update = job['update_formulas']
+        if update is not False:
+            if update['sheets'] != 'all':
+                result['missing_sheets'].extend(name for name in update['sheets'] if name not in wb.sheetnames)
+            sheet_names = _sheets_to_update(wb.sheetnames, update)
+            manifest = RunManifest.load_for_file(file_path)
+            result['formulas_updated'] = update_workbook_formulas(wb, sheet_names, max_workers=1, name_index=name_index,
+                                                                  manifest=manifest)
+        else:
+            manifest = None
+
+        output_file = output_path_for(file_path, job['save'])
+        if output_file is not None:
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            with metrics.phase('save'):
+                wb.save(output_file)
+            try:
+                name_index.save_for_file(output_file)
+            except OSError as e:
+                log.warning("Could not write name cache: %s", e)
+            if manifest is not None:
+                try:
+                    manifest.save_for_file(output_file)
+                except OSError as e:
+                    log.warning("Could not write run manifest: %s", e)
+            result['output'] = output_file
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        get_change_log().close()
+
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    report = metrics.report()
+    result['metrics'] = {'phases': report['phases'], 'counters': report['counters']}
+    return result
+
+def run_job(job, max_workers=None, log_level='normal', change_log_dir=None):
+    """
+    Processes every workbook of a job in a process pool, one task per workbook.
+
+    Parameters:
+    - job: Job dict from load_job
+    - max_workers: Number of worker processes (default: the job's 'workers', else number of CPUs)
+    - log_level: Output level of the workers ('quiet', 'normal' or 'verbose')
+    - change_log_dir: Directory for the per-workbook JSONL change logs (None disables them)
+
+    Returns:
+    - List of result dicts from process_workbook, in file order
+    """
+    files = expand_files(job['files'])
+    if not files:
+        print("No workbooks matched the job's 'files'.")
+        return []
+
+    if change_log_dir is not None:
+        os.makedirs(change_log_dir, exist_ok=True)
+    max_workers = max_workers or job.get('workers')
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(log_level,)) as executor:
+        futures = {executor.submit(process_workbook, file_path, job, change_log_dir): file_path for file_path in files}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing Workbooks", unit="file"):
+            results[futures[future]] = future.result()
+    return [results[file_path] for file_path in files]
+
+def print_summary(results):
+    """Prints one line per workbook and the totals."""
+    print("\n--- Batch Summary ---")
+    for result in results:
+        name = os.path.basename(result['file'])
+        if result['status'] != 'ok':
+            print(f"  FAILED {name}: {result['error']}")
+            continue
+        line = (f"  OK     {name}: {result['named_ranges']} named range(s), "
+                f"{result['formulas_updated']} formula(s) updated in {result['seconds']}s")
+        if result['missing_sheets']:
+            line += f" (missing sheets: {', '.join(result['missing_sheets'])})"
+        print(line)
+    failed = sum(1 for result in results if result['status'] != 'ok')
+    print(f"\n{len(results) - failed} workbook(s) processed, {failed} failed.")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create named ranges and update formulas in many workbooks.")
+    parser.add_argument('job', help="Path to the JSON/YAML job file")
+    parser.add_argument('--workers', type=int, help="Number of workbooks processed at the same time")
+    parser.add_argument('--summary', help="Write the per-file results to this JSON file")
+    parser.add_argument('--log-level', choices=list(LOG_LEVELS), default='quiet',
+                        help="Output of the workers (default: quiet, per-sheet summaries only)")
+    parser.add_argument('--change-log-dir', help="Write one JSONL change log per workbook to this directory")
+    args = parser.parse_args(argv)
+    configure_logging(args.log_level)
+
+    try:
+        job = load_job(args.job)
+    except (OSError, ValueError) as e:
+        print(f"Error reading job file: {e}")
+        return 2
+
+    results = run_job(job, args.workers, args.log_level, args.change_log_dir)
+    print_summary(results)
+
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Summary written to '{args.summary}'.")
+
+    return 1 if any(result['status'] != 'ok' for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,380 @@
+# benchmark.py
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import tempfile
+import time
+import openpyxl
+from openpyxl.workbook.defined_name import DefinedName
+from formula_tokenizer import FormulaRewriter
+from formula_updater import update_workbook_formulas
+from name_index import NameIndex
+from named_range_planner import add_named_range_configurations
+from app_logging import ROOT_LOGGER
+
+# Columns holding the generated formulas and the merged regions
+FORMULA_COLUMNS = range(13, 21)  # M:T
+MERGED_COLUMNS = range(24, 27)   # X:Z
+
+# First row of the block that gets named ranges (codes in J/K, values in L)
+NAMED_BLOCK_START = 10
+
+# A scenario counts as a regression when it is this much slower than the baseline
+REGRESSION_THRESHOLD = 1.10
+
+
+def build_formulas(count, seed=42):
+    """
+    Builds a deterministic list of formulas that look like the ones in our tax workbooks.
+    Rows are spread over the whole sheet, so only a fraction of the formulas
+    touch the named block in L200:L408.
+
+    Parameters:
+    - count: Number of formulas to generate
+    - seed: Random seed so every run uses the same formulas
+
+    Returns:
+    - List of formula strings
+    """
+    rng = random.Random(seed)
+    templates = [
+        "=L{r}*K{r}",
+        "=SUM(L{a}:L{b})+L{r}",
+        "='Tax Calculation'!L{r}-'Tax Calculation'!M{r}",
+        "=IF(J{r}=\"1657\",L{r},0)",
+        "=ROUND($L${r}*0.5,2)",
+        "=Summary!C{r}+D{r}",
+        "=VLOOKUP(J{r},'Rates'!$A$1:$C$500,3,FALSE)",
+        "=MAX(0,L{r}-L{a})*1.05",
+    ]
+    formulas = []
+    for _ in range(count):
+        row = rng.randint(10, 4000)
+        formulas.append(rng.choice(templates).format(r=row, a=row - 5, b=row + 5))
+    return formulas
+
+
+def build_filled_columns(count):
+    """
+    Builds (row, formula) pairs for columns of filled-down formulas over the
+    named block, e.g. '=L404*K404' in row 404 and '=L405*K405' in row 405.
+
+    Parameters:
+    - count: Number of formulas to generate
+    """
+    templates = [
+        "=L{r}*K{r}",
+        "=IF(J{r}=\"\",0,L{r}*0.25)",
+        "=ROUND(L{r}-M{r},2)",
+        "='Tax Calculation'!L{r}+Summary!C{r}",
+    ]
+    cells = []
+    while len(cells) < count:
+        for template in templates:
+            for row in range(200, 409):
+                cells.append((row, template.format(r=row)))
+    return cells[:count]
+
+
+def build_mapping():
+    """Builds a mapping similar to the one produced by update_formulas."""
+    cells = {f"L{row}": f"display_code_{1000 + row}" for row in range(200, 409, 2)}
+    return {'Tax Calculation': cells}
+
+
+def legacy_rewrite(formulas, mapping, sheet):
+    """The regex-plus-callback path that update_formulas used before the tokenizer."""
+    cell_ref_pattern = re.compile(r"(?:'([^']+)')?!?(\$?[A-Z]{1,3}\$?\d{1,7})")
+
+    def replace_match(match, current_sheet):
+        sheet_name, cell_ref = match.groups()
+        ref_sheet = sheet_name if sheet_name else current_sheet
+        cell_ref_clean = cell_ref.upper().replace('$', '')
+        if ':' in match.string:
+            return match.group(0)
+        return mapping.get(ref_sheet, {}).get(cell_ref_clean, match.group(0))
+
+    return [cell_ref_pattern.sub(lambda m: replace_match(m, sheet), f) for f in formulas]
+
+
+def tokenizer_rewrite(formulas, mapping, sheet):
+    """The FormulaRewriter path used by update_formulas."""
+    rewriter = FormulaRewriter(mapping)
+    return [rewriter.rewrite(f, sheet) for f in formulas]
+
+
+def tokenizer_rewrite_with_rows(cells, mapping, sheet):
+    """The FormulaRewriter path with the row-relative plan cache enabled."""
+    rewriter = FormulaRewriter(mapping)
+    result = [rewriter.rewrite(f, sheet, row) for row, f in cells]
+    return result, rewriter.cache_info()
+
+
+def generate_workbook(path, sheets=3, rows=2000, formula_density=0.3, cross_sheet_fraction=0.2,
+                      merged_regions=20, defined_names=200, seed=42):
+    """
+    Writes a deterministic workbook shaped like our tax workbooks.
+
+    The first sheet is 'Tax Calculation' with a block of tax codes in J/K and
+    amounts in L starting at NAMED_BLOCK_START; the first defined_names rows
+    of the block already have a 'display_code_<code>' name. Every sheet gets
+    formulas in M:T that reference column L of the block rows, and merged
+    regions in X:Z. A reference is local (L404) or, for cross_sheet_fraction
+    of the formulas, qualified with another sheet: 'Tax Calculation' from the
+    other sheets, one of the other sheets from 'Tax Calculation'. Only local
+    references on 'Tax Calculation' and qualified ones pointing at it hit a
+    name.
+
+    Parameters:
+    - path: Where to save the .xlsx file
+    - sheets: Number of sheets
+    - rows: Number of rows per sheet
+    - formula_density: Fraction of the M:T cells that hold a formula
+    - cross_sheet_fraction: Fraction of formulas, on every sheet, whose reference
+      is qualified with another sheet ('Tax Calculation'!L1); with a single
+      sheet every reference is local
+    - merged_regions: Number of merged regions per sheet
+    - defined_names: Number of rows of the block that get a defined name
+    - seed: Random seed so every run builds the same workbook
+
+    Returns:
+    - Dict describing the workbook (the parameters plus formula and name counts)
+    """
+    rng = random.Random(seed)
+    wb = openpyxl.Workbook()
+    titles = ['Tax Calculation'] + [f'Sheet {i}' for i in range(2, sheets + 1)]
+    block_rows = range(NAMED_BLOCK_START, min(rows, NAMED_BLOCK_START + max(defined_names, 1) * 2))
+    formula_count = 0
+
+    for index, title in enumerate(titles):
+        ws = wb.active if index == 0 else wb.create_sheet()
+        ws.title = title
+        if index == 0:
+            for row in block_rows:
+                code = 1000 + row
+                ws.cell(row=row, column=10, value=code if row % 3 else str(code))
+                ws.cell(row=row, column=11, value=f"Line {row}")
+                ws.cell(row=row, column=12, value=rng.randint(0, 100_000))
+
+        for row in range(1, rows + 1):
+            for column in FORMULA_COLUMNS:
+                if rng.random() >= formula_density:
+                    continue
+                target = rng.choice(block_rows)
+                if len(titles) == 1 or rng.random() >= cross_sheet_fraction:
+                    reference = f"L{target}"
+                else:
+                    other = titles[0] if index else rng.choice(titles[1:])
+                    reference = f"'{other}'!L{target}"
+                template = rng.choice([
+                    "={ref}*K{row}",
+                    "=ROUND({ref}*0.25,2)",
+                    "=IF({ref}>0,{ref},0)",
+                    "=SUM(L{a}:L{b})+{ref}",
+                    "=A{row}+B{row}",
+                ])
+                ws.cell(row=row, column=column, value=template.format(ref=reference, row=row, a=target, b=target + 5))
+                formula_count += 1
+
+        for _ in range(merged_regions):
+            top = rng.randint(1, max(1, rows - 3))
+            ws.merge_cells(start_row=top, start_column=MERGED_COLUMNS[0],
+                           end_row=top + 2, end_column=MERGED_COLUMNS[-1])
+
+    for row in list(block_rows)[:defined_names]:
+        name = f"display_code_{1000 + row}"
+        wb.defined_names[name] = DefinedName(name=name, attr_text=f"'Tax Calculation'!$L${row}")
+
+    wb.save(path)
+    return {
+        'sheets': sheets, 'rows': rows, 'formula_density': formula_density,
+        'cross_sheet_fraction': cross_sheet_fraction, 'merged_regions': merged_regions,
+        'defined_names': defined_names, 'seed': seed, 'formulas': formula_count,
+    }
+
+
+def time_scenario(run, setup=None, repeat=3):
+    """
+    Returns the best wall time of run() over a few repetitions.
+
+    Parameters:
+    - run: Function to time; receives the result of setup() if one is given
+    - setup: Optional untimed function preparing fresh input for every repetition
+    """
+    best = None
+    for _ in range(repeat):
+        args = (setup(),) if setup is not None else ()
+        start = time.perf_counter()
+        run(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_workbook_scenarios(path, repeat=3):
+    """
+    Times load, mapping build, name creation, formula rewrite and save on a generated workbook.
+
+    Returns:
+    - Dict of scenario name -> best wall time in seconds
+    """
+    load = lambda: openpyxl.load_workbook(path)
+    configurations = [{
+        'type': 'with_prefix', 'prefix': 'display_code_',
+        'cell_range': f'L{NAMED_BLOCK_START}:L{NAMED_BLOCK_START + 2000}', 'search_columns': ['J', 'K'],
+    }]
+
+    def create_names(wb):
+        add_named_range_configurations(wb, wb['Tax Calculation'], configurations)
+
+    def rewrite(wb):
+        update_workbook_formulas(wb, wb.sheetnames, max_workers=1)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_path = os.path.join(temp_dir, 'saved.xlsx')
+        return {
+            'load': time_scenario(load, repeat=repeat),
+            'mapping_build': time_scenario(NameIndex.from_workbook, load, repeat),
+            'name_creation': time_scenario(create_names, load, repeat),
+            'formula_rewrite': time_scenario(rewrite, load, repeat),
+            'save': time_scenario(lambda wb: wb.save(output_path), load, repeat),
+        }
+
+
+def run_rewriter_scenarios(repeat=3):
+    """Times the FormulaRewriter against the legacy regex on in-memory formulas."""
+    formulas = build_formulas(200_000)
+    cells = build_filled_columns(200_000)
+    mapping = build_mapping()
+    sheet = 'Tax Calculation'
+    return {
+        'rewriter_legacy': time_scenario(lambda: legacy_rewrite(formulas, mapping, sheet), repeat=repeat),
+        'rewriter_tokenizer': time_scenario(lambda: tokenizer_rewrite(formulas, mapping, sheet), repeat=repeat),
+        'rewriter_row_cache': time_scenario(lambda: tokenizer_rewrite_with_rows(cells, mapping, sheet), repeat=repeat),
+    }
+
+
+def compare_with_baseline(results, workbook, baseline):
+    """
+    Prints every scenario next to its baseline time.
+
+    Parameters:
+    - results: Dict of scenario name -> seconds
+    - workbook: Description of the generated workbook (from generate_workbook)
+    - baseline: Contents of a baseline file written by run_suite
+
+    Returns:
+    - List of scenario names that are slower than the baseline by more than REGRESSION_THRESHOLD
+    """
+    regressions = []
+    print(f"\n{'Scenario':<20} {'Baseline':>10} {'Current':>10} {'Ratio':>8}")
+    for name, seconds in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            print(f"{name:<20} {'-':>10} {seconds:>10.3f} {'-':>8}")
+            continue
+        ratio = seconds / base if base else float('inf')
+        flag = '  SLOWER' if ratio > REGRESSION_THRESHOLD else ''
+        print(f"{name:<20} {base:>10.3f} {seconds:>10.3f} {ratio:>7.2f}x{flag}")
+        if ratio > REGRESSION_THRESHOLD:
+            regressions.append(name)
+    if baseline.get('workbook') != workbook:
+        print("Note: the baseline was recorded with different workbook parameters.")
+    return regressions
+
+
+def run_suite(argv=None):
+    """
+    Runs the benchmark suite on a generated workbook and compares it with a baseline.
+
+    Returns:
+    - Exit code: 1 if a scenario regressed against the baseline, else 0
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the rewrite and naming paths on a generated workbook.")
+    parser.add_argument('--sheets', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--formula-density', type=float, default=0.3)
+    parser.add_argument('--cross-sheet', type=float, default=0.2, help="Fraction of cross-sheet references")
+    parser.add_argument('--merged', type=int, default=20, help="Merged regions per sheet")
+    parser.add_argument('--names', type=int, default=200, help="Number of defined names")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-rewriter', action='store_true', help="Skip the in-memory rewriter scenarios")
+    parser.add_argument('--baseline', help="Compare with this baseline file")
+    parser.add_argument('--write-baseline', help="Write the results to this baseline file")
+    args = parser.parse_args(argv)
+
+    # Only timings on the terminal
+    logging.getLogger(ROOT_LOGGER).setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'benchmark.xlsx')
+        workbook = generate_workbook(
+            path, args.sheets, args.rows, args.formula_density, args.cross_sheet,
+            args.merged, args.names, args.seed
+        )
+        print(f"Generated workbook: {workbook['sheets']} sheets, {workbook['rows']} rows, "
+              f"{workbook['formulas']} formulas, {workbook['defined_names']} names")
+        results = run_workbook_scenarios(path, args.repeat)
+    if not args.skip_rewriter:
+        results.update(run_rewriter_scenarios(args.repeat))
+
+    for name, seconds in results.items():
+        print(f"{name:<20} {seconds:.3f}s")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, workbook, baseline)
+
+    if args.write_baseline:
+        with open(args.write_baseline, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'openpyxl': openpyxl.__version__,
+                'workbook': workbook,
+                'results': results,
+            }, f, indent=2)
+        print(f"Baseline written to '{args.write_baseline}'.")
+
+    return 1 if regressions else 0
+
+
+def main():
+    formulas = build_formulas(200_000)
+    mapping = build_mapping()
+    sheet = 'Tax Calculation'
+
+    print(f"Rewriting {len(formulas)} formulas...")
+    legacy = time_scenario(lambda: legacy_rewrite(formulas, mapping, sheet))
+    tokenizer = time_scenario(lambda: tokenizer_rewrite(formulas, mapping, sheet))
+
+    print(f"Legacy regex + callback: {legacy:.3f}s ({len(formulas) / legacy:,.0f} formulas/s)")
+    print(f"FormulaRewriter:         {tokenizer:.3f}s ({len(formulas) / tokenizer:,.0f} formulas/s)")
+    print(f"Speed-up: {legacy / tokenizer:.2f}x")
+
+    cells = build_filled_columns(200_000)
+    formulas = [f for _, f in cells]
+    print(f"\nRewriting {len(cells)} filled-down formulas over the named block...")
+    legacy = time_scenario(lambda: legacy_rewrite(formulas, mapping, sheet))
+    uncached = time_scenario(lambda: tokenizer_rewrite(formulas, mapping, sheet))
+    cached = time_scenario(lambda: tokenizer_rewrite_with_rows(cells, mapping, sheet))
+    _, info = tokenizer_rewrite_with_rows(cells, mapping, sheet)
+
+    print(f"Legacy regex + callback:     {legacy:.3f}s")
+    print(f"FormulaRewriter (no rows):   {uncached:.3f}s")
+    print(f"FormulaRewriter (row cache): {cached:.3f}s ({info.hits} hits, {info.misses} misses)")
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        sys.exit(run_suite(sys.argv[2:]))
+    main()
@@ -0,0 +1,89 @@
+# cell_address.py
+
+import re
+from functools import lru_cache
+
+# Bit layout of a packed cell key: row | column (15 bits).
+# Excel allows 1,048,576 rows and 16,384 columns; column 16,384 (XFD)
+# needs the 15th bit.
+COLUMN_BITS = 15
+COLUMN_MASK = (1 << COLUMN_BITS) - 1
+MAX_ROW = 1048576
+MAX_COLUMN = 16384
+
+# An A1 address with optional '$' markers; the letters and the row are captured
+ADDRESS_PATTERN = re.compile(r"\$?([A-Za-z]{1,3})\$?(\d+)")
+
+# Number of address texts whose packed key is remembered by address_key
+ADDRESS_CACHE_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=None)
+def column_index(letters):
+    """Turns column letters into a column number ('L' -> 12, 'XFD' -> 16384)."""
+    column = 0
+    for char in letters.upper():
+        column = column * 26 + ord(char) - 64
+    return column
+
+
+@lru_cache(maxsize=None)
+def column_letter(column):
+    """Turns a column number into its letters (28 -> 'AB')."""
+    letters = ''
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def split_address(coord):
+    """
+    Splits an A1 address into its column letters and row number.
+
+    Parameters:
+    - coord: Address such as 'L404' or '$L$404'
+
+    Returns:
+    - Tuple (column_letters, row), e.g. ('L', 404)
+
+    Raises:
+    - ValueError if coord is not an A1 address
+    """
+    match = ADDRESS_PATTERN.fullmatch(coord)
+    if match is None:
+        raise ValueError(f"Not a cell address: '{coord}'")
+    return match.group(1).upper(), int(match.group(2))
+
+
+def parse_address(coord):
+    """Turns 'L404' or '$L$404' into (row, column) numbers."""
+    letters, row = split_address(coord)
+    return row, column_index(letters)
+
+
+def pack(row, column):
+    """Packs a row and column number into one integer key."""
+    return (row << COLUMN_BITS) | column
+
+
+def unpack(key):
+    """Returns the (row, column) of a packed key."""
+    return key >> COLUMN_BITS, key & COLUMN_MASK
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def address_key(coord):
+    """
+    Returns the packed key of an A1 address ('$L$404' -> key of row 404, column 12).
+
+    Reference texts repeat a lot across filled-down formulas, so the keys
+    of recent texts are cached and a lookup does not parse the text again.
+    """
+    return pack(*parse_address(coord))
+
+
+def key_address(key):
+    """Returns the A1 address of a packed key ('L404')."""
+    row, column = unpack(key)
+    return f"{column_letter(column)}{row}"
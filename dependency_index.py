@@ -0,0 +1,198 @@
+# dependency_index.py
+
+import numpy as np
+from formula_tokenizer import CANDIDATE_PATTERN
+from formula_updater import collect_formula_cells
+from cell_address import COLUMN_BITS, pack, parse_address
+from range_index import range_corners
+from metrics import get_metrics
+from app_logging import get_logger
+
+log = get_logger(__name__)
+
+# Excel allows 1,048,576 rows; with the column bits that fits in an int64 key
+_ROW_BITS = 21
+
+
+class DependencyIndex:
+    """
+    Inverted index from each referenced cell to the formulas that reference
+    it, kept per sheet.
+
+    A sheet is indexed from a single pass of the tokenizer's cheap candidate
+    pattern over its formula cells. The references are kept as two aligned
+    numpy arrays: sorted packed (row, column) keys of the referenced cells
+    and the positions of the formulas that contain them. Finding the
+    formulas that can change for a set of named cells is then one
+    searchsorted per named cell, so a rewrite only touches those formulas
+    instead of every formula of the selected sheets.
+
+    Only the sheets that were asked for are indexed (see index_sheets and
+    refresh), so updating one sheet does not pay for the whole workbook, and
+    refresh re-indexes a sheet whose formulas no longer match the index.
+
+    Keys leave out the sheet and the candidate pattern also sees fragments
+    of ranges, so the index returns a superset of the dependent formulas;
+    FormulaRewriter makes the exact decision for each of them.
+    """
+
+    def __init__(self):
+        # Sheet name -> (formula cells, ref keys, positions); the formula cells
+        # are (row, column, formula) tuples and positions index into them
+        self._sheets = {}
+
+    def __len__(self):
+        return sum(len(formula_cells) for formula_cells, _, _ in self._sheets.values())
+
+    def __contains__(self, sheet_title):
+        return sheet_title in self._sheets
+
+    @classmethod
+    def build(cls, formula_cells_by_sheet):
+        """
+        Builds the index from collected formula cells.
+
+        Parameters:
+        - formula_cells_by_sheet: Dict of sheet name -> list of (row, column, formula)
+          tuples, as returned by formula_updater.collect_formula_cells
+
+        Returns:
+        - DependencyIndex
+        """
+        index = cls()
+        index.index_sheets(formula_cells_by_sheet)
+        return index
+
+    @classmethod
+    def from_workbook(cls, wb, sheet_names=None):
+        """
+        Builds the index over the visible worksheets of a workbook.
+
+        Parameters:
+        - wb: openpyxl Workbook object
+        - sheet_names: Only index these sheets (default: all)
+        """
+        index = cls()
+        index.refresh([wb[name] for name in sheet_names] if sheet_names is not None else wb.worksheets)
+        return index
+
+    def index_sheets(self, formula_cells_by_sheet):
+        """
+        Indexes (or re-indexes) the formula cells of some sheets.
+
+        Parameters:
+        - formula_cells_by_sheet: Dict of sheet name -> list of (row, column, formula) tuples
+        """
+        # Cell text -> packed key; filled-down formulas repeat cells a lot
+        keys = {}
+        for sheet, formula_cells in formula_cells_by_sheet.items():
+            ref_keys = []
+            positions = []
+            for position, (_, _, formula) in enumerate(formula_cells):
+                for cell in set(CANDIDATE_PATTERN.findall(formula)):
+                    key = keys.get(cell)
+                    if key is None:
+                        ref_row, ref_column = parse_address(cell)
+                        if ref_row >> _ROW_BITS or ref_column >> COLUMN_BITS:
+                            key = -1  # Beyond the last row or column Excel allows
+                        else:
+                            key = pack(ref_row, ref_column)
+                        keys[cell] = key
+                    if key >= 0:
+                        ref_keys.append(key)
+                        positions.append(position)
+
+            ref_keys = np.array(ref_keys, dtype=np.int64)
+            positions = np.array(positions, dtype=np.int64)
+            order = np.argsort(ref_keys, kind='stable')
+            self._sheets[sheet] = (list(formula_cells), ref_keys[order], positions[order])
+
+    def refresh(self, sheets, formula_cells_by_sheet=None):
+        """
+        Indexes the visible sheets that are not indexed yet or whose formulas changed.
+
+        Formulas edited outside a rewrite (directly in the workbook, by
+        expanding names or by an undo) no longer match the indexed ones, so
+        those sheets are indexed again.
+
+        Parameters:
+        - sheets: List of openpyxl Worksheet objects
+        - formula_cells_by_sheet: Optional dict of sheet name -> formula cells
+          already collected by collect_formula_cells; the cells collected
+          here are added to it
+        """
+        if formula_cells_by_sheet is None:
+            formula_cells_by_sheet = {}
+        stale = {}
+        for ws in sheets:
+            if ws.sheet_state in ['hidden', 'veryHidden']:
+                continue
+            formula_cells = formula_cells_by_sheet.get(ws.title)
+            if formula_cells is None:
+                formula_cells = formula_cells_by_sheet[ws.title] = collect_formula_cells(ws)
+            if not self.is_current(ws.title, formula_cells):
+                stale[ws.title] = formula_cells
+        if stale:
+            log.info("Indexing formula references of %d sheet(s)...", len(stale))
+            with get_metrics().phase('dependency_index'):
+                self.index_sheets(stale)
+
+    def is_current(self, sheet_title, formula_cells):
+        """Returns True if the sheet is indexed with exactly these (row, column, formula) tuples."""
+        entry = self._sheets.get(sheet_title)
+        return entry is not None and entry[0] == formula_cells
+
+    def formulas_referencing(self, mapping, sheet_names=None):
+        """
+        Returns the formula cells that may reference a named cell.
+
+        Parameters:
+        - mapping: Dict of sheet name -> {cell address ('L404') or range
+          ('L200:L210') -> defined name}; a range is looked up by its corners
+        - sheet_names: Only return formulas living in these sheets (default:
+          every indexed sheet); sheets that are not indexed are left out
+
+        Returns:
+        - List of (position, sheet, row, column, formula) tuples in sheet and
+          row order; position is the one set_formula expects for that sheet
+        """
+        named_cells = set()
+        for cells in mapping.values():
+            for coord in cells:
+                if ':' in coord:
+                    named_cells.update(range_corners(coord))
+                else:
+                    named_cells.add(coord)
+        named_keys = np.unique(np.array(
+            [pack(*parse_address(coord)) for coord in named_cells],
+            dtype=np.int64
+        ))
+        if not len(named_keys):
+            return []
+
+        result = []
+        for sheet in (self._sheets if sheet_names is None else sheet_names):
+            if sheet not in self._sheets:
+                continue
+            formula_cells, ref_keys, sheet_positions = self._sheets[sheet]
+            starts = np.searchsorted(ref_keys, named_keys, side='left')
+            ends = np.searchsorted(ref_keys, named_keys, side='right')
+            found = [sheet_positions[start:end] for start, end in zip(starts.tolist(), ends.tolist()) if end > start]
+            if not found:
+                continue
+            for position in np.unique(np.concatenate(found)).tolist():
+                row, column, formula = formula_cells[position]
+                result.append((position, sheet, row, column, formula))
+        return result
+
+    def set_formula(self, sheet_title, position, formula):
+        """
+        Records the new text of a rewritten formula.
+
+        The references of the old text stay indexed: rewriting only replaces
+        references with names, so the old keys are a superset of the new ones
+        and rewriting the formula again is a no-op for them.
+        """
+        formula_cells = self._sheets[sheet_title][0]
+        row, column, _ = formula_cells[position]
+        formula_cells[position] = (row, column, formula)
@@ -0,0 +1,354 @@
+# formula_tokenizer.py
+
+import re
+from collections import OrderedDict, namedtuple
+from cell_address import ADDRESS_PATTERN, COLUMN_BITS, address_key, column_index
+from range_index import RangeIndex
+
+# Single compiled pattern that finds the references in a formula.
+# String literals, quoted sheet names and structured references are consumed
+# as a whole so a cell-like fragment inside them is never seen as a reference.
+# Function names, defined names and numbers are not matched at all: the
+# look-behind and look-ahead around the cell reject any fragment glued to
+# them, which keeps the regex engine scanning in C instead of handing every
+# token back to Python.
+#
+# Only the reference alternative has capturing groups:
+# 1 = quoted sheet name, 2 = unquoted sheet name, 3 = cell, 4 = range end.
+# Every other token leaves match.lastindex as None.
+TOKEN_PATTERN = re.compile(r"""
+    "(?:[^"]|"")*"                                      # string literal
+  | (?<![\w.$#:!])                                      # not inside a name, number, range or after a sheet
+    (?:
+        (?:
+            '((?:[^']|'')+)'                            # 'Quoted Sheet'!
+          | ((?:\[\d+\])?[^\W\d][\w.]*(?::[^\W\d][\w.]*)?)   # Sheet1! / [1]Sheet1! / Sheet1:Sheet3!
+        )!
+    )?
+    (\$?[A-Z]{1,3}\$?\d+)                               # A1, $A1, A$1, $A$1
+    (:\$?[A-Z]{1,3}\$?\d+)?                             # optional range end
+    (?![\w.(!\[:])                                      # not a function, name or sheet
+  | '(?:[^']|'')*'!?                                    # quoted sheet without a cell
+  | \[(?:[^\[\]]|\[[^\]]*\])*\]                         # structured reference / [1]
+""", re.VERBOSE)
+
+_QUOTED_SHEET, _SHEET, _CELL, _TAIL = 1, 2, 3, 4
+
+# Cheap pre-filter: every cell-like fragment, without the leading '$'. It finds
+# a superset of the cells TOKEN_PATTERN accepts, so a formula whose fragments
+# are all unnamed can be returned as is without running the full tokenizer.
+CANDIDATE_PATTERN = re.compile(r"[A-Z]{1,3}\$?\d+")
+
+# Above this many named cells the trie regex takes longer to compile than the
+# set-based pre-filter saves, so the latter is used instead.
+TRIE_PREFILTER_LIMIT = 5000
+
+# Number of row-relative rewrite plans kept by a FormulaRewriter
+DEFAULT_CACHE_SIZE = 4096
+
+# Stands for the anchor row inside a cached template. XML cannot carry NUL,
+# so it never occurs in a real formula.
+_ROW_MARKER = '\x00'
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def iter_references(formula):
+    """
+    Yields every cell or range reference found in a formula.
+
+    Parameters:
+    - formula: Formula text (with or without the leading '=')
+
+    Returns:
+    - Generator of (sheet_name, cell_ref, range_end, start, end) tuples.
+      sheet_name is None when the reference has no sheet prefix, range_end is
+      None for a single cell, and start/end are the offsets in the formula.
+    """
+    for match in TOKEN_PATTERN.finditer(formula):
+        if match.lastindex is None:
+            continue
+        quoted, sheet, cell, tail = match.group(_QUOTED_SHEET, _SHEET, _CELL, _TAIL)
+        if quoted is not None:
+            sheet = quoted.replace("''", "'")
+        yield sheet, cell, tail[1:] if tail else None, match.start(), match.end()
+
+
+def _absolute_variants(coord):
+    """Returns 'L404', '$L404', 'L$404' and '$L$404' for a clean coordinate."""
+    split = len(coord.rstrip('0123456789'))
+    col, row = coord[:split], coord[split:]
+    return (coord, f"${coord}", f"{col}${row}", f"${col}${row}")
+
+
+def _trie_pattern(node):
+    """Turns a nested dict trie into a compact regex alternation."""
+    alternatives = []
+    for char, child in sorted(node.items()):
+        if char == '':
+            continue
+        prefix = r'\$?' if char == '$' else re.escape(char)
+        alternatives.append(prefix + _trie_pattern(child))
+    if not alternatives:
+        return ''
+    body = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+    return f'(?:{body})?' if '' in node else body
+
+
+def _build_prefilter(coords):
+    """
+    Builds a predicate that tells whether a formula may reference one of the given cells.
+
+    Parameters:
+    - coords: Iterable of clean coordinates ('L404')
+
+    Returns:
+    - Function taking a formula and returning a truthy value if the formula
+      contains a fragment that looks like one of the cells.
+    """
+    coords = list(coords)
+    if not coords:
+        return lambda formula: False
+    if len(coords) > TRIE_PREFILTER_LIMIT:
+        keys = frozenset(
+            variant for coord in coords for variant in _absolute_variants(coord)
+            if not variant.startswith('$')
+        )
+        return lambda formula: not keys.isdisjoint(CANDIDATE_PATTERN.findall(formula))
+
+    # Trie over 'L$404'-style keys where '$' stands for an optional dollar sign,
+    # compiled into a single regex whose first-character set lets the regex
+    # engine skip through the formula in C.
+    trie = {}
+    for coord in coords:
+        split = len(coord.rstrip('0123456789'))
+        node = trie
+        for char in coord[:split] + '$' + coord[split:]:
+            node = node.setdefault(char, {})
+        node[''] = True
+    return re.compile(_trie_pattern(trie) + r'(?!\d)').search
+
+
+class FormulaRewriter:
+    """
+    Replaces standalone single-cell references and named ranges with their
+    defined names.
+
+    The rewriter is built once from the nested sheet -> cell -> name mapping
+    and then reused for every formula. A range reference is replaced only
+    when a defined name covers exactly that block (looked up in a per-sheet
+    RangeIndex); a single cell is never replaced inside a range. References
+    that sit inside a string literal or point to a cell without a name are
+    left untouched.
+
+    When the row of the formula's cell is passed to rewrite(), the tokenized
+    formula is cached under a row-relative (R1C1-style) template: every
+    occurrence of the row number is replaced by a marker, so the filled-down
+    '=L404*K404' in row 404 and '=L405*K405' in row 405 share one entry. On a
+    hit the cached plan is re-anchored to the new row and only the named-cell
+    lookups are repeated. The cache is an LRU of cache_size entries.
+
+    Parameters:
+    - mapping: Dict of sheet name -> {cell address ('L404') or range
+      ('L200:L210') -> defined name}
+    - cache_size: Maximum number of cached plans (0 disables the cache)
+    """
+
+    def __init__(self, mapping, cache_size=DEFAULT_CACHE_SIZE):
+        # Sheet -> {packed cell key -> name}; any spelling of a reference
+        # ('L404', '$L$404') resolves to the same key through address_key.
+        self._cells = {}
+        self._ranges = {}
+        self._prefilters = {}
+        all_coords = set()
+        for sheet, cells in mapping.items():
+            coords = set()
+            lookup = {}
+            ranges = RangeIndex()
+            for coord, name in cells.items():
+                if ':' in coord:
+                    ranges.add(coord, name)
+                    continue
+                coord = coord.upper().replace('$', '')
+                coords.add(coord)
+                lookup[address_key(coord)] = name
+            self._cells[sheet] = lookup
+            if ranges:
+                # A named range can only match if one of its corners is in the formula
+                self._ranges[sheet] = ranges
+                coords |= ranges.corners()
+            self._prefilters[sheet] = _build_prefilter(coords)
+            all_coords |= coords
+        # Cross-sheet references can point at any sheet with names.
+        self._any_sheet_prefilter = _build_prefilter(all_coords)
+        self._replacers = {}
+
+        # (sheet, row-relative template) -> rewrite plan, in LRU order
+        self._plans = OrderedDict()
+        self._cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def cache_info(self):
+        """Returns the hit/miss counters of the row-relative plan cache."""
+        return CacheInfo(self.hits, self.misses, self._cache_size, len(self._plans))
+
+    def _replacer_for(self, current_sheet):
+        """Builds (once per sheet) the re.sub callback for formulas on that sheet."""
+        cells_by_sheet = self._cells
+        ranges_by_sheet = self._ranges
+        local_cells = cells_by_sheet.get(current_sheet)
+        local_ranges = ranges_by_sheet.get(current_sheet)
+
+        def replace(match):
+            # Only single cells (lastindex 3) and ranges (lastindex 4) can change.
+            lastindex = match.lastindex
+            if lastindex == _CELL:
+                by_sheet, local = cells_by_sheet, local_cells
+            elif lastindex == _TAIL:
+                by_sheet, local = ranges_by_sheet, local_ranges
+            else:
+                return match.group()
+            quoted, sheet = match.group(_QUOTED_SHEET, _SHEET)
+            if quoted is not None:
+                lookup = by_sheet.get(quoted.replace("''", "'"))
+            elif sheet is not None:
+                lookup = by_sheet.get(sheet)
+            else:
+                lookup = local
+            if lookup is None:
+                return match.group()
+            if lastindex == _CELL:
+                return lookup.get(address_key(match.group(_CELL))) or match.group()
+            return lookup.get(match.group(_CELL) + match.group(_TAIL)) or match.group()
+
+        return replace
+
+    def _build_plan(self, formula, current_sheet, row_text, template):
+        """
+        Tokenizes a formula into a plan that can be re-anchored to other rows.
+
+        Returns:
+        - Tuple (pieces, slots): pieces is the formula split around the
+          references to named sheets, with the row number replaced by the
+          marker; slots is a list of (piece_index, lookup, column, row_part).
+          For a cell, lookup is the sheet's key -> name dict and row_part
+          is None when the row is the anchor row, the row number when it is
+          fixed, or the row digits with the marker otherwise. For a range,
+          lookup is the sheet's RangeIndex, column is None and row_part is
+          the range text with the marker.
+          None if the formula cannot be expressed relative to its row.
+        """
+        cells_by_sheet = self._cells
+        ranges_by_sheet = self._ranges
+        pieces = []
+        slots = []
+        last = 0
+        for match in TOKEN_PATTERN.finditer(formula):
+            lastindex = match.lastindex
+            if lastindex == _CELL:
+                by_sheet, cell = cells_by_sheet, match.group(_CELL)
+            elif lastindex == _TAIL:
+                by_sheet, cell = ranges_by_sheet, match.group(_CELL) + match.group(_TAIL)
+            else:
+                continue
+            quoted, sheet = match.group(_QUOTED_SHEET, _SHEET)
+            if quoted is not None or sheet is not None:
+                # The sheet is resolved once, so it must not depend on the row
+                if row_text in (quoted or sheet):
+                    return None
+                cells = by_sheet.get(quoted.replace("''", "'") if quoted is not None else sheet)
+            else:
+                cells = by_sheet.get(current_sheet)
+            if cells is None:
+                continue
+            pieces.append(formula[last:match.start()].replace(row_text, _ROW_MARKER))
+            if lastindex == _TAIL:
+                slots.append((len(pieces), cells, None, cell.replace(row_text, _ROW_MARKER)))
+            else:
+                letters, digits = ADDRESS_PATTERN.fullmatch(cell).groups()
+                row_part = digits.replace(row_text, _ROW_MARKER)
+                if row_part == _ROW_MARKER:
+                    row_part = None
+                elif _ROW_MARKER not in row_part:
+                    row_part = int(digits)
+                slots.append((len(pieces), cells, column_index(letters), row_part))
+            pieces.append(match.group().replace(row_text, _ROW_MARKER))
+            last = match.end()
+        pieces.append(formula[last:].replace(row_text, _ROW_MARKER))
+
+        # A row number spanning two pieces would not survive the split
+        if ''.join(pieces) != template:
+            return None
+        return pieces, slots
+
+    def _rewrite_tokens(self, formula, current_sheet):
+        """Runs the full tokenizer over a formula."""
+        replace = self._replacers.get(current_sheet)
+        if replace is None:
+            replace = self._replacers[current_sheet] = self._replacer_for(current_sheet)
+
+        formula_new = TOKEN_PATTERN.sub(replace, formula)
+        return formula if formula_new == formula else formula_new
+
+    def rewrite(self, formula, current_sheet, row=None):
+        """
+        Rewrites a single formula.
+
+        Parameters:
+        - formula: Formula text as stored in the cell (e.g. '=L404*K404')
+        - current_sheet: Name of the sheet the formula lives in
+        - row: Row of the formula's cell; enables the row-relative plan cache
+
+        Returns:
+        - The rewritten formula, or the very same string object if nothing changed.
+        """
+        # Fast path: skip the tokenizer when no cell-like fragment in the
+        # formula can possibly have a name.
+        if '!' in formula:
+            may_match = self._any_sheet_prefilter
+        else:
+            may_match = self._prefilters.get(current_sheet)
+            if may_match is None:
+                return formula
+        if not may_match(formula):
+            return formula
+
+        if row is None or not self._cache_size:
+            return self._rewrite_tokens(formula, current_sheet)
+
+        row_text = str(row)
+        key = (current_sheet, formula.replace(row_text, _ROW_MARKER))
+        plans = self._plans
+        plan = plans.get(key, False)
+        if plan is False:
+            self.misses += 1
+            plan = plans[key] = self._build_plan(formula, current_sheet, row_text, key[1])
+            if len(plans) > self._cache_size:
+                plans.popitem(last=False)
+        else:
+            self.hits += 1
+            plans.move_to_end(key)
+
+        if plan is None:
+            return self._rewrite_tokens(formula, current_sheet)
+
+        # Re-anchor the plan: only the named-cell lookups depend on the row
+        pieces, slots = plan
+        parts = None
+        for index, lookup, column, row_part in slots:
+            if column is None:
+                name = lookup.get(row_part.replace(_ROW_MARKER, row_text))
+            elif row_part is None:
+                name = lookup.get((row << COLUMN_BITS) | column)
+            elif row_part.__class__ is int:
+                name = lookup.get((row_part << COLUMN_BITS) | column)
+            else:
+                name = lookup.get((int(row_part.replace(_ROW_MARKER, row_text)) << COLUMN_BITS) | column)
+            if name is not None:
+                if parts is None:
+                    parts = pieces.copy()
+                parts[index] = name
+        if parts is None:
+            return formula
+        return ''.join(parts).replace(_ROW_MARKER, row_text)
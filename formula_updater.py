@@ -1,24 +1,42 @@
 # formula_updater.py
 
-import re
 import time
-from openpyxl.workbook.defined_name import DefinedName
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from openpyxl.worksheet.formula import ArrayFormula, DataTableFormula
 from utils import get_user_input  # Assuming utils.py is in the same directory
+from formula_tokenizer import FormulaRewriter
+from name_index import NameIndex
+from skip_index import SkipIndex
+from run_manifest import mapping_fingerprint
+from journal import get_journal
 from tqdm import tqdm  # Importing tqdm for progress indicators
+from app_logging import SUMMARY, get_change_log, get_logger, progress_enabled
+from metrics import get_metrics
 
-def update_formulas(wb):
-    """
-    Updates formulas in selected worksheets by replacing cell references with their named ranges.
-    Handles references with and without sheet names.
+log = get_logger(__name__)
 
-    For example:
-    - In 'Tax Calculation' sheet: '=L404' becomes '=display_code_1657'
-    - In 'Summary' sheet: '="Tax Calculation"!L404' becomes '=display_code_1657'
+# Sheets that are never touched when updating formulas in all sheets
+SHEETS_TO_SKIP = ['KORF VL', 'KORF BXL', 'KORF WA', 'Communal tax']
+
+# Number of formula cells rewritten between two progress bar updates
+PROGRESS_BATCH_SIZE = 1000
+
+# Fewest formulas, summed over the sheets, for which update_dependent_formulas
+# hands the rewrite to a process pool; below it starting the worker processes
+# costs more than the rewrite itself
+PARALLEL_MIN_FORMULAS = 20000
+
+def select_sheets_to_update(sheet_names):
+    """
+    Prompts the user to choose between updating a specific sheet or all sheets.
 
     Parameters:
-    - wb: openpyxl Workbook object
+    - sheet_names: List of sheet names in workbook order
+
+    Returns:
+    - List of sheet names to update, or None if the chosen sheet does not exist.
     """
-    # 1. Prompt the user to choose between updating a specific sheet or all sheets
     print("\n--- Formula Update Options ---")
     print("1. Update formulas in a specific sheet")
     print("2. Update formulas in all sheets")
@@ -33,155 +51,457 @@ def update_formulas(wb):
     if choice == "1":
         # Update a specific sheet
         default_specific_sheet = 'Tax Calculation'
-        available_sheets = wb.sheetnames
-        print(f"\nAvailable sheets: {', '.join(available_sheets)}")
+        print(f"\nAvailable sheets: {', '.join(sheet_names)}")
         specific_sheet = get_user_input(
             f"Enter the sheet name to update (default: '{default_specific_sheet}')",
             default_specific_sheet
         ).strip()
-        if specific_sheet not in wb.sheetnames:
+        if specific_sheet not in sheet_names:
             print(f"Error: Sheet '{specific_sheet}' does not exist in the workbook.")
-            return
-        sheets_to_update = [wb[specific_sheet]]
+            return None
+        return [specific_sheet]
+
+    # Update all sheets except the ones to skip
+    return [name for name in sheet_names if name not in SHEETS_TO_SKIP]
+
+def collect_formula_cells(ws):
+    """
+    Builds a compact, picklable picture of a sheet's formula cells in one pass.
+
+    Parameters:
+    - ws: openpyxl Worksheet object
+
+    Returns:
+    - List of (row, column, formula) tuples, in row order, for every string
+      formula that may be rewritten. For an array formula the tuple holds
+      the text of its top-left cell (see store_formula).
+    """
+    metrics = get_metrics()
+    with metrics.phase('skip_index'):
+        skip_index = SkipIndex.from_worksheet(ws)
+
+    # Walk the stored cells only; ws.iter_rows() would create the empty
+    # cells of the whole used range just to find the formulas.
+    cells = ws._cells.values() if hasattr(ws, '_cells') else (cell for row in ws.iter_rows() for cell in row)
+
+    with metrics.phase('scan'):
+        formula_cells = []
+        scanned = skipped = 0
+        for cell in cells:
+            scanned += 1
+            if cell.data_type != 'f':
+                continue
+            if skip_index.skips(cell.row, cell.column):
+                skipped += 1
+                continue
+            formula = cell.value
+            if isinstance(formula, ArrayFormula):
+                formula = formula.text
+            elif isinstance(formula, DataTableFormula):
+                continue  # What-if data tables have no formula text
+            if not formula:
+                continue
+            if not isinstance(formula, str):
+                log.warning("Skipping cell %s in '%s': Expected string formula, got %s", cell.coordinate, ws.title, type(formula).__name__)
+                continue
+            formula_cells.append((cell.row, cell.column, formula))
+        formula_cells.sort()
+
+    metrics.count('cells_scanned', scanned)
+    metrics.count('cells_skipped', skipped)
+    metrics.count('formula_cells', len(formula_cells))
+    return formula_cells
+
+def formula_text(value):
+    """Returns the formula text of a cell value (plain string or ArrayFormula)."""
+    return value.text if isinstance(value, ArrayFormula) else value
+
+def store_formula(cell, formula):
+    """
+    Writes a rewritten formula back to its cell.
+
+    An array formula keeps its ArrayFormula object and range; only the
+    text is replaced, so it is saved as an array formula again. The write
+    is added to the journal of the running operation, if any.
+    """
+    journal = get_journal()
+    if journal is not None:
+        journal.record_formula(cell.parent.title, cell.row, cell.column, formula_text(cell.value), formula)
+    if isinstance(cell.value, ArrayFormula):
+        cell.value.text = formula
     else:
-        # Update all sheets
-        sheets_to_update = wb.worksheets
-        # Sheets to skip
-        sheets_to_skip = ['KORF VL', 'KORF BXL', 'KORF WA', 'Communal tax']
+        cell.value = formula
 
-        sheets_to_update = [ws for ws in sheets_to_update if ws.title not in sheets_to_skip]
+def _report_update(sheet_title, cell, formula, formula_new, change_log):
+    """Logs one changed formula (verbose level) and adds it to the change log."""
+    log.debug("  Updated cell %s in '%s': '%s' to '%s'", cell.coordinate, sheet_title, formula, formula_new)
+    if change_log.enabled:
+        change_log.record('formula', sheet_title, cell.coordinate, formula, formula_new)
 
-    # 2. Create a nested mapping from sheet_name to (cell_address -> named_range)
-    mapping = {}
+def _report_sheet(sheet_title, updated):
+    """Logs the per-sheet summary, which is shown at every level."""
+    log.log(SUMMARY, "Sheet '%s': %d formula(s) updated", sheet_title, updated)
 
-    # Iterate over defined names
-    for name in wb.defined_names:
-        dn = wb.defined_names[name]  # Retrieve the DefinedName object
-        if not isinstance(dn, DefinedName):
-            print(f"Warning: '{name}' is not a DefinedName object.")
-            continue
-        print(f"Defined Name: '{dn.name}'")
+# Rewriter of a worker process, built once by _init_worker
+_worker_rewriter = None
+
+def _init_worker(mapping):
+    """Process pool initializer: builds the rewriter once per worker."""
+    global _worker_rewriter
+    _worker_rewriter = FormulaRewriter(mapping)
+
+def _rewrite_sheet(sheet_title, formula_cells):
+    """
+    Worker task: rewrites the formulas of one sheet.
 
-        # Only consider named ranges that refer to single cells
-        try:
-            destinations = list(dn.destinations)  # List of (sheet, cell) tuples
-        except AttributeError:
-            print(f"Warning: DefinedName '{dn.name}' does not have 'destinations' attribute.")
+    Returns:
+    - Tuple (changed, hits, misses): list of (row, column, new_formula) tuples
+      for the formulas that changed, and the plan cache hits/misses of this task
+    """
+    rewrite = _worker_rewriter.rewrite
+    hits, misses = _worker_rewriter.hits, _worker_rewriter.misses
+    changed = []
+    for row, column, formula in formula_cells:
+        formula_new = rewrite(formula, sheet_title, row)
+        if formula_new is not formula:
+            changed.append((row, column, formula_new))
+    return changed, _worker_rewriter.hits - hits, _worker_rewriter.misses - misses
+
+def update_sheets_in_parallel(sheets, mapping, max_workers=None, formula_cells_by_sheet=None, changed_formulas=None):
+    """
+    Rewrites the formulas of several sheets in a process pool, one task per sheet.
+
+    The formula cells of each sheet are collected in this process (openpyxl
+    objects cannot be sent to workers) and submitted as soon as they are
+    ready, so collecting the next sheet overlaps with rewriting the previous
+    ones. Results are written back in sheet order.
+
+    Parameters:
+    - sheets: List of openpyxl Worksheet objects (hidden sheets already removed)
+    - mapping: Dict of sheet name -> {cell address -> defined name}
+    - max_workers: Number of worker processes (default: number of CPUs)
+    - formula_cells_by_sheet: Optional dict of sheet name -> formula cells
+      already collected by collect_formula_cells
+    - changed_formulas: Optional dict that receives sheet name ->
+      {(row, column): new formula} for every rewritten formula
+
+    Returns:
+    - Number of formulas that were rewritten
+    """
+    metrics = get_metrics()
+    formula_cells_by_sheet = formula_cells_by_sheet or {}
+    results = {}
+    cache_hits = cache_misses = 0
+    with metrics.phase('rewrite_parallel'), ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(mapping,)) as executor:
+        futures = {}
+        for ws in sheets:
+            formula_cells = formula_cells_by_sheet.get(ws.title)
+            if formula_cells is None:
+                log.info("Collecting formulas in sheet: %s at %s", ws.title, time.strftime('%X'))
+                formula_cells = collect_formula_cells(ws)
+            futures[executor.submit(_rewrite_sheet, ws.title, formula_cells)] = ws.title
+
+        # Report progress per sheet as the workers finish
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing Sheets", unit="sheet",
+                           disable=not progress_enabled()):
+            changed, hits, misses = future.result()
+            results[futures[future]] = changed
+            cache_hits += hits
+            cache_misses += misses
+
+    # Merge the results back in deterministic (sheet) order
+    change_log = get_change_log()
+    updated = 0
+    with metrics.phase('write_back'):
+        for ws in sheets:
+            for row, column, formula_new in results[ws.title]:
+                cell = ws.cell(row=row, column=column)
+                _report_update(ws.title, cell, formula_text(cell.value), formula_new, change_log)
+                store_formula(cell, formula_new)
+            if changed_formulas is not None:
+                changed_formulas.setdefault(ws.title, {}).update(
+                    ((row, column), formula_new) for row, column, formula_new in results[ws.title]
+                )
+            updated += len(results[ws.title])
+            _report_sheet(ws.title, len(results[ws.title]))
+        change_log.flush()
+    metrics.count('formulas_rewritten', updated)
+
+    log.info("Rewrite cache: %d hits, %d misses", cache_hits, cache_misses)
+    return updated
+
+def update_dependent_formulas(sheets, mapping, dependency_index, max_workers=1, changed_formulas=None):
+    """
+    Rewrites only the formulas that reference a named cell, as found in a DependencyIndex.
+
+    The work depends on the number of named cells and their dependents
+    instead of the total number of formulas in the selected sheets. When
+    they live in several sheets, max_workers is not 1 and there are at
+    least PARALLEL_MIN_FORMULAS of them, they are rewritten by
+    update_sheets_in_parallel.
+
+    Parameters:
+    - sheets: List of openpyxl Worksheet objects (hidden sheets are skipped)
+    - mapping: Dict of sheet name -> {cell address -> defined name}
+    - dependency_index: DependencyIndex built from the same workbook
+    - max_workers: Number of worker processes (None: number of CPUs; 1, the
+      default, keeps everything in this process)
+    - changed_formulas: See update_sheets_in_parallel
+
+    Returns:
+    - Number of formulas that were rewritten
+    """
+    visible_sheets = {}
+    for ws in sheets:
+        if ws.sheet_state in ['hidden', 'veryHidden']:
+            log.info("Skipping hidden sheet: %s", ws.title)
             continue
+        visible_sheets[ws.title] = ws
+
+    metrics = get_metrics()
+    with metrics.phase('dependency_lookup'):
+        candidates = dependency_index.formulas_referencing(mapping, visible_sheets)
+    metrics.count('dependent_formulas', len(candidates))
+    log.info("Rewriting %d of %d formulas that reference named cells.", len(candidates), len(dependency_index))
+
+    candidate_sheets = {sheet_title for _, sheet_title, _, _, _ in candidates}
+    if len(candidate_sheets) > 1 and max_workers != 1 and len(candidates) >= PARALLEL_MIN_FORMULAS:
+        return _update_dependent_formulas_in_parallel(visible_sheets, candidates, mapping, dependency_index, max_workers,
+                                                      changed_formulas)
+
+    rewriter = FormulaRewriter(mapping)
+    change_log = get_change_log()
+    updated_by_sheet = dict.fromkeys(visible_sheets, 0)
+    with metrics.phase('rewrite'):
+        for position, sheet_title, row, column, formula in candidates:
+            formula_new = rewriter.rewrite(formula, sheet_title, row)
+            if formula_new is formula:
+                continue
+            cell = visible_sheets[sheet_title].cell(row=row, column=column)
+            _report_update(sheet_title, cell, formula, formula_new, change_log)
+            store_formula(cell, formula_new)
+            dependency_index.set_formula(sheet_title, position, formula_new)
+            if changed_formulas is not None:
+                changed_formulas.setdefault(sheet_title, {})[(row, column)] = formula_new
+            updated_by_sheet[sheet_title] += 1
+        change_log.flush()
+    metrics.count('formulas_rewritten', sum(updated_by_sheet.values()))
+
+    for sheet_title, updated in updated_by_sheet.items():
+        _report_sheet(sheet_title, updated)
+    info = rewriter.cache_info()
+    log.info("Rewrite cache: %d hits, %d misses", info.hits, info.misses)
+    return sum(updated_by_sheet.values())
+
+def _update_dependent_formulas_in_parallel(visible_sheets, candidates, mapping, dependency_index, max_workers,
+                                          changed_formulas=None):
+    """
+    Parallel branch of update_dependent_formulas: only the candidate formulas
+    are sent to update_sheets_in_parallel, and the rewritten ones are synced
+    back into the dependency index.
+    """
+    formula_cells_by_sheet = {}
+    for _, sheet_title, row, column, formula in candidates:
+        formula_cells_by_sheet.setdefault(sheet_title, []).append((row, column, formula))
+    sheets = [ws for sheet_title, ws in visible_sheets.items() if sheet_title in formula_cells_by_sheet]
+    updated = update_sheets_in_parallel(sheets, mapping, max_workers, formula_cells_by_sheet, changed_formulas)
+
+    for sheet_title in visible_sheets:
+        if sheet_title not in formula_cells_by_sheet:
+            _report_sheet(sheet_title, 0)
+    for position, sheet_title, row, column, formula in candidates:
+        formula_new = formula_text(visible_sheets[sheet_title].cell(row=row, column=column).value)
+        if formula_new != formula:
+            dependency_index.set_formula(sheet_title, position, formula_new)
+    return updated
+
+def update_formulas(wb, max_workers=None, name_index=None, dependency_index=None, manifest=None):
+    """
+    Updates formulas in selected worksheets by replacing cell references with their named ranges.
+    Handles references with and without sheet names.
+
+    For example:
+    - In 'Tax Calculation' sheet: '=L404' becomes '=display_code_1657'
+    - In 'Summary' sheet: '="Tax Calculation"!L404' becomes '=display_code_1657'
+
+    When several sheets are selected, the rewrite runs in a process pool.
+
+    Parameters:
+    - wb: openpyxl Workbook object
+    - max_workers: Number of worker processes for multi-sheet updates (default: number of CPUs)
+    - name_index: NameIndex kept for the session (built from wb.defined_names if omitted)
+    - dependency_index: Optional DependencyIndex kept for the session; only the
+      formulas that reference a named cell are rewritten
+    - manifest: Optional RunManifest of the last run; sheets it shows as
+      unchanged are skipped
+
+    Returns:
+    - Number of formulas that were rewritten, or None if no valid sheet was chosen
+    """
+    # 1. Prompt the user to choose between updating a specific sheet or all sheets
+    sheet_names = select_sheets_to_update(wb.sheetnames)
+    if sheet_names is None:
+        return
+    return update_workbook_formulas(wb, sheet_names, max_workers, name_index, dependency_index, manifest)
+
+def update_workbook_formulas(wb, sheet_names, max_workers=None, name_index=None, dependency_index=None, manifest=None):
+    """
+    Non-interactive core of update_formulas: rewrites the formulas of the given sheets.
+
+    Parameters:
+    - wb: openpyxl Workbook object
+    - sheet_names: Names of the sheets to update (hidden sheets are skipped)
+    - max_workers: Number of worker processes for multi-sheet updates
+      (default: number of CPUs; 1 keeps everything in this process)
+    - name_index: NameIndex kept for the session (built from wb.defined_names if omitted)
+    - dependency_index: Optional DependencyIndex kept across updates; the
+      selected sheets it does not cover yet, or whose formulas were edited
+      since, are indexed first (DependencyIndex.refresh), then only the
+      formulas that reference a named cell are rewritten (see
+      update_dependent_formulas, which also uses max_workers)
+    - manifest: Optional RunManifest of the last run. Sheets whose formulas and
+      relevant names are unchanged since then are skipped; the manifest is
+      updated for the sheets that were rewritten.
+
+    Returns:
+    - Number of formulas that were rewritten
+    """
+    sheets_to_update = [wb[name] for name in sheet_names]
+
+    # 2. Get the nested mapping from sheet_name to (cell_address -> named_range)
+    metrics = get_metrics()
+    if name_index is None:
+        name_index = NameIndex.from_workbook(wb)
+    mapping = name_index.mapping
+    log.info("Using %d named cells from %d defined names.", sum(len(cells) for cells in mapping.values()), len(name_index))
 
-        for sheet, coord in destinations:
-            sheet_clean = sheet.strip("'").strip()
-            coord_clean = coord.upper().replace('$', '')
-            
-            # Initialize the inner dictionary if the sheet is not yet in mapping
-            if sheet_clean not in mapping:
-                mapping[sheet_clean] = {}
-            
-            mapping[sheet_clean][coord_clean] = dn.name
-            print(f"  -> Refers to: {sheet_clean}!{coord_clean}")
-
-    # Debugging: Print the mapping
-    print("\nMapping of Sheet and Cell Addresses to Named Ranges:")
-    for sheet, cells in mapping.items():
-        for cell, name in cells.items():
-            print(f"{sheet}!{cell} => {name}")
-
-    # Define regex to find cell references with optional sheet names
-    # Matches patterns like:
-    # 'Sheet1'!A1, Sheet1!A1, A1
-    cell_ref_pattern = re.compile(r"(?:'([^']+)')?!?(\$?[A-Z]{1,3}\$?\d{1,7})")
-
-    # 3. Define the replacement function
-    def replace_match(match, current_sheet):
-        sheet_name, cell_ref = match.groups()
-        if sheet_name:
-            # Reference includes sheet name
-            ref_sheet = sheet_name
-        else:
-            # Reference does not include sheet name; assume current sheet
-            ref_sheet = current_sheet
-        cell_ref_clean = cell_ref.upper().replace('$', '')
-        
-        # Check if this cell reference is part of a range
-        if ':' in match.string:
-            # If it's part of a range, don't replace it
-            return match.group(0)
-        
-        # Access the nested mapping
-        return mapping.get(ref_sheet, {}).get(cell_ref_clean, match.group(0))  # Replace if mapped, else keep original
+    if manifest is None:
+        if dependency_index is not None:
+            dependency_index.refresh(sheets_to_update)
+        return _update_sheets(sheets_to_update, mapping, max_workers, dependency_index)
+
+    # Leave out the sheets an update would not change since the last run
+    formula_cells_by_sheet = {}
+    stale_sheets = []
+    with metrics.phase('fingerprint'):
+        mapping_digest = mapping_fingerprint(mapping)
+        for ws in sheets_to_update:
+            if ws.sheet_state not in ['hidden', 'veryHidden']:
+                formula_cells = collect_formula_cells(ws)
+                if manifest.is_current(ws.title, formula_cells, mapping, mapping_digest):
+                    log.info("Sheet '%s' is unchanged since the last run; skipping.", ws.title)
+                    metrics.count('sheets_unchanged')
+                    continue
+                formula_cells_by_sheet[ws.title] = formula_cells
+            stale_sheets.append(ws)
+
+    if dependency_index is not None:
+        dependency_index.refresh(stale_sheets, formula_cells_by_sheet)
+    changed_formulas = {}
+    updated = _update_sheets(stale_sheets, mapping, max_workers, dependency_index, formula_cells_by_sheet,
+                             changed_formulas)
+
+    # Remember the formulas as the update left them: the collected cells with
+    # the rewritten formulas swapped in, so the sheets are not scanned again
+    with metrics.phase('fingerprint'):
+        for ws in stale_sheets:
+            if ws.sheet_state not in ['hidden', 'veryHidden']:
+                formula_cells = formula_cells_by_sheet[ws.title]
+                changed = changed_formulas.get(ws.title)
+                if changed:
+                    # The cells are sorted by (row, column), so each change is found by bisection
+                    formula_cells = list(formula_cells)
+                    for (row, column), formula_new in changed.items():
+                        formula_cells[bisect_left(formula_cells, (row, column))] = (row, column, formula_new)
+                manifest.record(ws.title, formula_cells, mapping, mapping_digest)
+    return updated
+
+def _update_sheets(sheets_to_update, mapping, max_workers=None, dependency_index=None, formula_cells_by_sheet=None,
+                   changed_formulas=None):
+    """
+    Rewrites the formulas of the given sheets with the fastest applicable strategy.
+
+    Parameters:
+    - sheets_to_update: List of openpyxl Worksheet objects (hidden sheets are skipped)
+    - mapping: Dict of sheet name -> {cell address -> defined name}
+    - max_workers: See update_workbook_formulas
+    - dependency_index: See update_workbook_formulas
+    - formula_cells_by_sheet: Optional dict of sheet name -> formula cells
+      already collected by collect_formula_cells
+    - changed_formulas: See update_sheets_in_parallel
+
+    Returns:
+    - Number of formulas that were rewritten
+    """
+    metrics = get_metrics()
+    formula_cells_by_sheet = formula_cells_by_sheet or {}
+
+    # With a dependency index only the formulas that use a named cell are visited
+    if dependency_index is not None:
+        return update_dependent_formulas(sheets_to_update, mapping, dependency_index, max_workers, changed_formulas)
+
+    # Several sheets: spread the per-sheet rewrite over a process pool
+    if len(sheets_to_update) > 1 and max_workers != 1:
+        visible_sheets = []
+        for ws in sheets_to_update:
+            if ws.sheet_state in ['hidden', 'veryHidden']:
+                log.info("Skipping hidden sheet: %s", ws.title)
+                continue
+            visible_sheets.append(ws)
+        return update_sheets_in_parallel(visible_sheets, mapping, max_workers, formula_cells_by_sheet, changed_formulas)
+
+    # 3. Build the formula rewriter once for all sheets
+    # It tokenizes each formula in a single pass and only replaces standalone
+    # single-cell references (ranges and string literals are left alone).
+    with metrics.phase('build_rewriter'):
+        rewriter = FormulaRewriter(mapping)
+    change_log = get_change_log()
+    show_progress = progress_enabled()
+    updated = 0
 
     # 4. Iterate through the selected sheets and update formulas
-    for ws in tqdm(sheets_to_update, desc="Processing Sheets", unit="sheet"):
+    for ws in tqdm(sheets_to_update, desc="Processing Sheets", unit="sheet", disable=not show_progress):
         # Check if the sheet is hidden
         if ws.sheet_state in ['hidden', 'veryHidden']:
-            print(f"\nSkipping hidden sheet: {ws.title}")
+            log.info("Skipping hidden sheet: %s", ws.title)
             continue  # Skip processing this sheet
 
-        print(f"\nProcessing sheet: {ws.title} at {time.strftime('%X')}")
-
-        # **Step 1: Identify and Skip Non-Primary Merged Cells**
-        # Create a set of all non-primary merged cells in the sheet
-        non_primary_merged_cells = set()
-        for merged_range in ws.merged_cells.ranges:
-            # merged_range.bounds returns (min_col, min_row, max_col, max_row)
-            min_col, min_row, max_col, max_row = merged_range.bounds
-            # Iterate over all cells in the merged range except the primary cell
-            for row in range(min_row, max_row + 1):
-                for col in range(min_col, max_col + 1):
-                    cell_coord = ws.cell(row=row, column=col).coordinate
-                    # Skip the primary cell (top-left cell)
-                    if row == min_row and col == min_col:
-                        continue
-                    non_primary_merged_cells.add(cell_coord)
-
-        # **Step 2: Preprocess Image Anchors to Create a Set of Cells with Images**
-        image_cells = set()
-        for image in ws._images:
-            if hasattr(image.anchor, 'from_'):  # Note: In newer versions, it's 'from_'
-                img_row = image.anchor.from_.row + 1  # zero-based index
-                img_col = image.anchor.from_.col + 1  # zero-based index
-                img_cell = ws.cell(row=img_row, column=img_col).coordinate
-                image_cells.add(img_cell)
-
-        # **Step 3: Calculate Total Number of Cells with Formulas to Process**
-        # Exclude non-primary merged cells and cells with images from the total count
-        total_formula_cells = 0
-        for row in ws.iter_rows():
-            for cell in row:
-                if cell.data_type == 'f' and cell.coordinate not in non_primary_merged_cells and cell.coordinate not in image_cells:
-                    total_formula_cells += 1
-
-        # **Step 4: Initialize Cell-Level Progress Bar**
-        with tqdm(total=total_formula_cells, desc="Updating Cells", unit="cell", leave=False) as cell_pbar:
-            for row in ws.iter_rows():
-                for cell in row:
-                    # **Step 4.1: Skip Non-Primary Merged Cells**
-                    if cell.coordinate in non_primary_merged_cells:
-                        continue  # Skip processing this cell
-
-                    # **Step 4.2: Skip Cells Associated with Images**
-                    if cell.coordinate in image_cells:
-                        continue  # Skip processing this cell
-
-                    if cell.data_type == 'f':  # 'f' indicates a formula
-                        formula = cell.value
-                        if not formula:
-                            cell_pbar.update(1)
-                            continue
-
-                        # Check if the formula is a string
-                        if not isinstance(formula, str):
-                            print(f"Skipping cell {cell.coordinate} in '{ws.title}': Expected string formula, got {type(formula).__name__}")
-                            cell_pbar.update(1)
-                            continue
-
-                        # Perform the replacement using re.sub with the replacement function
-                        formula_new = cell_ref_pattern.sub(lambda m: replace_match(m, ws.title), formula)
-
-                        if formula_new != formula:
-                            # Inform the user about the formula update
-                            print(f"  Updated cell {cell.coordinate} in '{ws.title}': '{formula}' to '{formula_new}'")
-                            cell.value = formula_new
-
-                        # Update the cell progress bar
-                        cell_pbar.update(1)
+        log.info("Processing sheet: %s at %s", ws.title, time.strftime('%X'))
+        updated_in_sheet = 0
+
+        # **Steps 1-3: Collect the Formula Cells in a Single Pass**
+        # Non-primary merged cells and cells with images are left out
+        formula_cells = formula_cells_by_sheet.get(ws.title)
+        if formula_cells is None:
+            formula_cells = collect_formula_cells(ws)
+
+        # **Step 4: Rewrite from the Collected List**
+        # The progress bar is advanced once per batch instead of once per cell
+        with metrics.phase('rewrite'), tqdm(total=len(formula_cells), desc="Updating Cells", unit="cell", leave=False,
+                                            disable=not show_progress) as cell_pbar:
+            for batch_start in range(0, len(formula_cells), PROGRESS_BATCH_SIZE):
+                batch = formula_cells[batch_start:batch_start + PROGRESS_BATCH_SIZE]
+                for row, column, formula in batch:
+                    # Replace named cell references in the formula
+                    formula_new = rewriter.rewrite(formula, ws.title, row)
+
+                    if formula_new is not formula:
+                        # Record the formula update (verbose output and change log)
+                        cell = ws.cell(row=row, column=column)
+                        _report_update(ws.title, cell, formula, formula_new, change_log)
+                        store_formula(cell, formula_new)
+                        if changed_formulas is not None:
+                            changed_formulas.setdefault(ws.title, {})[(row, column)] = formula_new
+                        updated_in_sheet += 1
+
+                # Update the cell progress bar
+                cell_pbar.update(len(batch))
+
+        updated += updated_in_sheet
+        _report_sheet(ws.title, updated_in_sheet)
+    change_log.flush()
+    metrics.count('formulas_rewritten', updated)
+
+    info = rewriter.cache_info()
+    log.info("Rewrite cache: %d hits, %d misses", info.hits, info.misses)
+    return updated
@@ -0,0 +1,167 @@
+# journal.py
+
+from contextlib import contextmanager
+from cell_address import key_address, pack, unpack
+from app_logging import get_change_log, get_logger
+
+log = get_logger(__name__)
+
+# Kinds of journal entries, the same words as in the change log
+FORMULA = 'formula'
+DEFINED_NAME = 'defined_name'
+
+# Journal that receives the changes of the running operation, see Journal.operation
+_active_journal = None
+
+
+def get_journal():
+    """Returns the journal of the running operation, or None if changes are not journaled."""
+    return _active_journal
+
+
+class Journal:
+    """
+    Append-only in-memory record of the formula and defined-name changes of a session.
+
+    Every formula write and every defined name created or replaced while an
+    operation is running (see operation()) is appended as a small tuple:
+
+    - (FORMULA, sheet, key, old, new): key is the cell_address.pack()ed cell,
+      old and new are the formula texts
+    - (DEFINED_NAME, name, refers_to, old_defined_name): the DefinedName that
+      was replaced, or None if the name was created
+
+    Undoing an operation or rolling back to a checkpoint replays the entries
+    backwards on the loaded workbook, so going back costs a few microseconds
+    per changed cell instead of reloading the file.
+    """
+
+    def __init__(self):
+        self.entries = []
+        # (label, position of the first entry) of the journaled operations, oldest first
+        self.operations = []
+        # label -> position
+        self.checkpoints = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @contextmanager
+    def operation(self, label):
+        """
+        Journals the changes made inside the with-block as one operation that undo() can revert.
+
+        Parameters:
+        - label: Description shown when the operation is undone, e.g. 'Update Formulas'
+        """
+        global _active_journal
+        previous, _active_journal = _active_journal, self
+        start = len(self.entries)
+        try:
+            yield self
+        finally:
+            _active_journal = previous
+            if len(self.entries) > start:
+                self.operations.append((label, start))
+
+    def record_formula(self, sheet, row, column, old, new):
+        """Adds a formula write to the journal."""
+        self.entries.append((FORMULA, sheet, pack(row, column), old, new))
+
+    def record_name(self, name, refers_to, old_defined_name=None):
+        """
+        Adds a defined name change to the journal.
+
+        Parameters:
+        - name: Name that was written
+        - refers_to: Its new reference ("'Tax Calculation'!$L$404")
+        - old_defined_name: DefinedName object it replaced, or None if it was created
+        """
+        self.entries.append((DEFINED_NAME, name, refers_to, old_defined_name))
+
+    def checkpoint(self, label):
+        """Marks the current state so rollback(label) can return to it."""
+        self.checkpoints[label] = len(self.entries)
+
+    def undo(self, wb, name_index=None):
+        """
+        Reverts the last journaled operation.
+
+        Parameters:
+        - wb: openpyxl Workbook object the changes were made to
+        - name_index: NameIndex kept for the session, updated with the reverted names
+
+        Returns:
+        - Tuple (label, number of changes reverted), or None if there is nothing to undo
+        """
+        if not self.operations:
+            return None
+        label, start = self.operations[-1]
+        return label, self._revert(wb, start, name_index)
+
+    def rollback(self, wb, label, name_index=None):
+        """
+        Reverts every change made after a checkpoint. The checkpoint itself is kept.
+
+        Parameters:
+        - wb: openpyxl Workbook object the changes were made to
+        - label: Label given to checkpoint()
+        - name_index: NameIndex kept for the session, updated with the reverted names
+
+        Returns:
+        - Number of changes reverted
+
+        Raises:
+        - ValueError if there is no checkpoint with that label
+        """
+        if label not in self.checkpoints:
+            raise ValueError(f"No checkpoint named '{label}'.")
+        return self._revert(wb, self.checkpoints[label], name_index)
+
+    def _revert(self, wb, position, name_index):
+        """Replays the entries after position backwards and drops them from the journal."""
+        global _active_journal
+        # The writes below restore earlier states and are not journaled themselves
+        previous, _active_journal = _active_journal, None
+        try:
+            self._replay(wb, position, name_index)
+        finally:
+            _active_journal = previous
+
+        reverted = len(self.entries) - position
+        del self.entries[position:]
+        self.operations = [operation for operation in self.operations if operation[1] < position]
+        self.checkpoints = {label: mark for label, mark in self.checkpoints.items() if mark <= position}
+        log.info("Reverted %d change(s).", reverted)
+        return reverted
+
+    def _replay(self, wb, position, name_index):
+        """Restores the old values of the entries after position, newest first."""
+        from formula_updater import store_formula
+        from name_index import reference_destinations
+
+        change_log = get_change_log()
+        entries = self.entries
+        for index in range(len(entries) - 1, position - 1, -1):
+            entry = entries[index]
+            if entry[0] == FORMULA:
+                _, sheet, key, old, new = entry
+                row, column = unpack(key)
+                store_formula(wb[sheet].cell(row=row, column=column), old)
+                if change_log.enabled:
+                    change_log.record(FORMULA, sheet, key_address(key), new, old, undo=True)
+                continue
+
+            _, name, refers_to, old_defined_name = entry
+            del wb.defined_names[name]
+            if name_index is not None:
+                name_index.remove(name)
+            if old_defined_name is not None:
+                wb.defined_names.add(old_defined_name)
+                if name_index is not None:
+                    name_index.add(old_defined_name.name, reference_destinations(old_defined_name.attr_text or ''))
+            if change_log.enabled:
+                change_log.record(DEFINED_NAME, None, None, refers_to,
+                                  None if old_defined_name is None else old_defined_name.attr_text,
+                                  name=name, undo=True)
+        change_log.flush()
@@ -1,12 +1,214 @@
 # main.py
 
+import argparse
 import os
-import openpyxl
 from utils import get_user_input
-from named_ranges import add_named_ranges
-from formula_updater import update_formulas
+from app_logging import LOG_LEVELS, configure_logging, get_change_log
+from metrics import Metrics, get_metrics, set_metrics
+from session import Session
+from xlsx_stream import read_sheet_names, stream_update_formulas
 import sys
 
+# openpyxl, pandas and the modules built on them are imported where they are
+# first needed (see session.py), so the first prompt shows up right away
+
+def prompt_output_file(file_path):
+    """
+    Asks whether to overwrite the original file or save as a new file.
+
+    Parameters:
+    - file_path: Path of the workbook that was opened
+
+    Returns:
+    - Tuple (output_file, overwrite)
+    """
+    directory, file_name = os.path.split(file_path)
+    
+    # Prompt the user for saving preference
+    save_choice = get_user_input(
+        "Do you want to overwrite the original file or save as a new file? (overwrite/save_as_new)",
+        "save_as_new"
+    ).strip().lower()
+    
+    if save_choice in ['overwrite', 'o']:
+        return file_path, True  # Overwrite the original file
+    new_file_name = 'updated_' + file_name
+    return os.path.join(directory, new_file_name), False
+
+def prompt_named_range_configurations():
+    """
+    Prompts for one or more named range configurations.
+
+    Returns:
+    - List of configuration dicts ('type', optional 'prefix', 'cell_range', 'search_columns')
+    """
+    # Initialize a list to hold multiple configurations for named ranges
+    configurations = []
+
+    while True:
+        print("\n--- Add a New Named Range Configuration ---")
+        print("1. Named Range with Prefix")
+        print("2. Named Range without Prefix")
+        range_type = get_user_input("Enter the type of named range to create (1/2)", "1")
+
+        if range_type == "1":
+            # Named Range with Prefix
+            default_prefix = 'display_code_'
+            default_cell_range = 'L200:L408'
+            default_search_columns = 'J,K'
+
+            prefix = get_user_input("Enter the prefix for the named ranges", default_prefix)
+            cell_range = get_user_input("Enter the cell range (e.g., 'L200:L408')", default_cell_range)
+            search_columns_input = get_user_input("Enter the columns to search for tax codes (e.g., 'J,K')", default_search_columns)
+            search_columns = [col.strip().upper() for col in search_columns_input.split(',')]
+
+            # Validate search columns
+            valid_columns = [chr(i) for i in range(ord('A'), ord('Z')+1)]
+            invalid_cols = [col for col in search_columns if col not in valid_columns]
+            if invalid_cols:
+                print(f"Error: Invalid column letters detected: {', '.join(invalid_cols)}. Please enter valid column letters (A-Z).\n")
+                continue
+
+            configurations.append({
+                'type': 'with_prefix',
+                'prefix': prefix,
+                'cell_range': cell_range,
+                'search_columns': search_columns
+            })
+        elif range_type == "2":
+            # Named Range without Prefix
+            default_cell_range = 'L200:L408'
+            default_search_columns = 'J,K'
+
+            cell_range = get_user_input("Enter the cell range (e.g., 'L200:L408')", default_cell_range)
+            search_columns_input = get_user_input("Enter the columns to search for tax codes (e.g., 'J,K')", default_search_columns)
+            search_columns = [col.strip().upper() for col in search_columns_input.split(',')]
+
+            # Validate search columns
+            valid_columns = [chr(i) for i in range(ord('A'), ord('Z')+1)]
+            invalid_cols = [col for col in search_columns if col not in valid_columns]
+            if invalid_cols:
+                print(f"Error: Invalid column letters detected: {', '.join(invalid_cols)}. Please enter valid column letters (A-Z).\n")
+                continue
+
+            configurations.append({
+                'type': 'without_prefix',
+                'cell_range': cell_range,
+                'search_columns': search_columns
+            })
+        else:
+            print("Invalid choice. Please enter 1 or 2.")
+            continue
+
+        add_more = get_user_input("Do you want to add another range configuration? (yes/no)", "no").strip().lower()
+        if add_more not in ['yes', 'y']:
+            break
+
+    return configurations
+
+def run_streaming_update(file_path):
+    """
+    Updates formulas by editing the sheet XML inside the .xlsx file directly,
+    without loading the workbook into memory.
+
+    Parameters:
+    - file_path: Path to the .xlsx file
+    """
+    from formula_updater import select_sheets_to_update
+
+    print("\n--- Streaming Formula Update ---")
+    try:
+        sheet_names = select_sheets_to_update(read_sheet_names(file_path))
+    except Exception as e:
+        print(f"Error reading workbook: {e}\n")
+        return
+    if sheet_names is None:
+        return
+
+    output_file, overwrite = prompt_output_file(file_path)
+
+    try:
+        results = stream_update_formulas(file_path, output_file, sheet_names)
+    except Exception as e:
+        print(f"Error updating workbook: {e}")
+        return
+
+    for sheet_name, updated in results.items():
+        print(f"  {sheet_name}: {updated} formula(s) updated")
+    if overwrite:
+        print(f"\nOriginal Excel file '{file_path}' has been overwritten.")
+    else:
+        print(f"\nUpdated Excel file saved as '{output_file}'.")
+
+def run_fast_named_ranges(file_path):
+    """
+    Creates named ranges by reading one sheet in read-only mode and patching
+    only the defined names of the .xlsx file.
+
+    Parameters:
+    - file_path: Path to the .xlsx file
+    """
+    from named_range_planner import add_named_ranges_to_file
+
+    print("\n--- Fast Named Range Creation ---")
+    try:
+        sheet_names = read_sheet_names(file_path)
+    except Exception as e:
+        print(f"Error reading workbook: {e}\n")
+        return
+
+    default_specific_sheet = 'Tax Calculation'
+    print(f"\nAvailable sheets: {', '.join(sheet_names)}")
+    specific_sheet = get_user_input(
+        f"Enter the sheet name to create/update named ranges (default: '{default_specific_sheet}')",
+        default_specific_sheet
+    ).strip()
+    if specific_sheet not in sheet_names:
+        print(f"Error: Sheet '{specific_sheet}' does not exist in the workbook.")
+        return
+
+    configurations = prompt_named_range_configurations()
+    output_file, overwrite = prompt_output_file(file_path)
+
+    try:
+        created = add_named_ranges_to_file(file_path, output_file, specific_sheet, configurations)
+    except Exception as e:
+        print(f"Error updating workbook: {e}")
+        return
+    if created is None:
+        return
+
+    print(f"\n{created} named range(s) created.")
+    if overwrite:
+        print(f"\nOriginal Excel file '{file_path}' has been overwritten.")
+    else:
+        print(f"\nUpdated Excel file saved as '{output_file}'.")
+
+def wait_for_workbook(session):
+    """
+    Returns True once the session's workbook is loaded, or False if loading failed.
+
+    Parameters:
+    - session: Session loading the workbook in the background
+    """
+    try:
+        session.load()
+        return True
+    except Exception as e:
+        print(f"Error loading workbook: {e}\n")
+        return False
+
+def parse_args(argv=None):
+    """Parses the command line options that control the output."""
+    parser = argparse.ArgumentParser(description="Excel Formula and Named Range Manager")
+    parser.add_argument('--log-level', choices=list(LOG_LEVELS), default='normal',
+                        help="quiet: per-sheet summaries only; verbose: one line per changed cell")
+    parser.add_argument('--change-log', help="Append one JSON line per changed cell to this file")
+    parser.add_argument('--metrics', help="Write a JSON report with per-phase timings and counts to this file")
+    parser.add_argument('--trace-memory', action='store_true', help="Record the peak memory of every phase")
+    parser.add_argument('--profile-dir', help="Write a cProfile dump per phase to this directory")
+    return parser.parse_args(argv)
+
 def main():
     print("=== Excel Formula and Named Range Manager ===\n")
     
@@ -20,12 +222,32 @@ def main():
             continue
         break
 
-    # Load the workbook after validating the file path
+    # Choose how to open the workbook
+    print("\n--- Load Mode ---")
+    print("1. Full edit (load the workbook into memory)")
+    print("2. Streaming formula update (edits the sheet XML directly, low memory)")
+    print("3. Create named ranges only (reads one sheet, patches the defined names)")
+    mode = get_user_input("Enter the number corresponding to your choice", "1")
+    if mode == "2":
+        run_streaming_update(file_path)
+        print("Exiting the program. Goodbye!")
+        return
+    if mode == "3":
+        run_fast_named_ranges(file_path)
+        print("Exiting the program. Goodbye!")
+        return
+
+    from formula_updater import select_sheets_to_update
+
+    # Start loading the workbook in the background; the prompts below only
+    # need the sheet names, which are read from xl/workbook.xml right away.
+    # The session keeps the name and dependency indexes and the run manifest.
     try:
-        wb = openpyxl.load_workbook(file_path)
+        session = Session(file_path, background=True)
     except Exception as e:
         print(f"Error loading workbook: {e}\n")
         return
+    sheet_names = session.sheet_names
 
     # Main interaction loop
     while True:
@@ -35,6 +257,10 @@ def main():
         print("2. Update Formulas")
         print("3. Save and Exit")
         print("4. Exit Without Saving")
+        print("5. Expand Named Ranges back to Cell References")
+        print("6. Undo Last Operation")
+        print("7. Set Checkpoint")
+        print("8. Roll Back to Checkpoint")
         
         choice = get_user_input("Enter the number corresponding to your choice", "1")
         
@@ -43,128 +269,54 @@ def main():
             
             # Prompt for the sheet name to update named ranges
             default_specific_sheet = 'Tax Calculation'
-            available_sheets = wb.sheetnames
-            print(f"\nAvailable sheets: {', '.join(available_sheets)}")
+            print(f"\nAvailable sheets: {', '.join(sheet_names)}")
             
             specific_sheet = get_user_input(
                 f"Enter the sheet name to create/update named ranges (default: '{default_specific_sheet}')",
                 default_specific_sheet
             ).strip()
             
-            if specific_sheet not in wb.sheetnames:
+            if specific_sheet not in sheet_names:
                 print(f"Error: Sheet '{specific_sheet}' does not exist in the workbook.")
                 continue  # Return to the main menu if sheet doesn't exist
             
-            ws = wb[specific_sheet]  # Set the worksheet for named range creation
-            
-            # Initialize a list to hold multiple configurations for named ranges
-            configurations = []
-
-            while True:
-                print("\n--- Add a New Named Range Configuration ---")
-                print("1. Named Range with Prefix")
-                print("2. Named Range without Prefix")
-                range_type = get_user_input("Enter the type of named range to create (1/2)", "1")
-
-                if range_type == "1":
-                    # Named Range with Prefix
-                    default_prefix = 'display_code_'
-                    default_cell_range = 'L200:L408'
-                    default_search_columns = 'J,K'
-
-                    prefix = get_user_input("Enter the prefix for the named ranges", default_prefix)
-                    cell_range = get_user_input("Enter the cell range (e.g., 'L200:L408')", default_cell_range)
-                    search_columns_input = get_user_input("Enter the columns to search for tax codes (e.g., 'J,K')", default_search_columns)
-                    search_columns = [col.strip().upper() for col in search_columns_input.split(',')]
-
-                    # Validate search columns
-                    valid_columns = [chr(i) for i in range(ord('A'), ord('Z')+1)]
-                    invalid_cols = [col for col in search_columns if col not in valid_columns]
-                    if invalid_cols:
-                        print(f"Error: Invalid column letters detected: {', '.join(invalid_cols)}. Please enter valid column letters (A-Z).\n")
-                        continue
-
-                    configurations.append({
-                        'type': 'with_prefix',
-                        'prefix': prefix,
-                        'cell_range': cell_range,
-                        'search_columns': search_columns
-                    })
-                elif range_type == "2":
-                    # Named Range without Prefix
-                    default_cell_range = 'L200:L408'
-                    default_search_columns = 'J,K'
-
-                    cell_range = get_user_input("Enter the cell range (e.g., 'L200:L408')", default_cell_range)
-                    search_columns_input = get_user_input("Enter the columns to search for tax codes (e.g., 'J,K')", default_search_columns)
-                    search_columns = [col.strip().upper() for col in search_columns_input.split(',')]
-
-                    # Validate search columns
-                    valid_columns = [chr(i) for i in range(ord('A'), ord('Z')+1)]
-                    invalid_cols = [col for col in search_columns if col not in valid_columns]
-                    if invalid_cols:
-                        print(f"Error: Invalid column letters detected: {', '.join(invalid_cols)}. Please enter valid column letters (A-Z).\n")
-                        continue
-
-                    configurations.append({
-                        'type': 'without_prefix',
-                        'cell_range': cell_range,
-                        'search_columns': search_columns
-                    })
-                else:
-                    print("Invalid choice. Please enter 1 or 2.")
-                    continue
-
-                add_more = get_user_input("Do you want to add another range configuration? (yes/no)", "no").strip().lower()
-                if add_more not in ['yes', 'y']:
-                    break
-
-            # Process each configuration after collecting all configurations
-            for config in configurations:
-                if config['type'] == 'with_prefix':
-                    add_named_ranges(
-                        wb=wb,
-                        ws=ws,
-                        prefix=config['prefix'],
-                        cell_range=config['cell_range'],
-                        search_columns=config['search_columns']
-                    )
-                else:
-                    add_named_ranges(
-                        wb=wb,
-                        ws=ws,
-                        cell_range=config['cell_range'],
-                        search_columns=config['search_columns']
-                    )
+            # Collect one or more configurations for named ranges
+            configurations = prompt_named_range_configurations()
+
+            if not wait_for_workbook(session):
+                break
+
+            # Process all configurations in a single scan of the worksheet
+            try:
+                session.add_named_ranges(specific_sheet, configurations)
+            except ValueError as e:
+                print(f"Error: {e}")
+                continue  # Nothing was written; return to the main menu
 
             print("\nNamed range creation completed.")
         
         elif choice == "2":
             # Update Formulas
             print("\n--- Updating Formulas ---")
-            update_formulas(wb)
+            sheets_to_update = select_sheets_to_update(sheet_names)
+            if sheets_to_update is None:
+                continue
+
+            if not wait_for_workbook(session):
+                break
+            session.update_formulas(sheets_to_update)
             print("Formula update completed.")
         
         elif choice == "3":
             # Save and Exit
             print("\n--- Saving Workbook ---")
-            directory, file_name = os.path.split(file_path)
-            
-            # Prompt the user for saving preference
-            save_choice = get_user_input(
-                "Do you want to overwrite the original file or save as a new file? (overwrite/save_as_new)",
-                "save_as_new"
-            ).strip().lower()
-            
-            if save_choice in ['overwrite', 'o']:
-                output_file = file_path  # Overwrite the original file
-            else:
-                new_file_name = 'updated_' + file_name
-                output_file = os.path.join(directory, new_file_name)
+            output_file, overwrite = prompt_output_file(file_path)
 
+            if not wait_for_workbook(session):
+                break
             try:
-                wb.save(output_file)
-                if save_choice in ['overwrite', 'o']:
+                session.save(output_file)
+                if overwrite:
                     print(f"\nOriginal Excel file '{file_path}' has been overwritten.")
                 else:
                     print(f"\nUpdated Excel file saved as '{output_file}'.")
@@ -182,12 +334,64 @@ def main():
             else:
                 print("Returning to the main menu.")
         
+        elif choice == "5":
+            # Expand Named Ranges (the reverse of Update Formulas)
+            print("\n--- Expanding Named Ranges ---")
+            sheets_to_update = select_sheets_to_update(sheet_names)
+            if sheets_to_update is None:
+                continue
+
+            if not wait_for_workbook(session):
+                break
+            session.expand_names(sheets_to_update)
+            print("Named range expansion completed.")
+
+        elif choice == "6":
+            # Undo Last Operation (replays the in-memory journal, no reload)
+            if not wait_for_workbook(session):
+                break
+            undone = session.undo()
+            if undone is None:
+                print("Nothing to undo.")
+            else:
+                label, reverted = undone
+                print(f"Undid '{label}' ({reverted} change(s) reverted).")
+
+        elif choice == "7":
+            # Set Checkpoint
+            label = get_user_input("Enter a name for the checkpoint", f"checkpoint {len(session.journal.checkpoints) + 1}")
+            session.checkpoint(label)
+            print(f"Checkpoint '{label}' set.")
+
+        elif choice == "8":
+            # Roll Back to Checkpoint
+            if not session.journal.checkpoints:
+                print("No checkpoints have been set.")
+                continue
+            print(f"\nCheckpoints: {', '.join(session.journal.checkpoints)}")
+            label = get_user_input("Enter the checkpoint to roll back to", list(session.journal.checkpoints)[-1])
+            if not wait_for_workbook(session):
+                break
+            try:
+                reverted = session.rollback(label)
+            except ValueError as e:
+                print(f"Error: {e}")
+                continue
+            print(f"Rolled back to '{label}' ({reverted} change(s) reverted).")
+
         else:
-            print("Invalid choice. Please enter a number between 1 and 4.")
+            print("Invalid choice. Please enter a number between 1 and 8.")
 
 if __name__ == "__main__":
+    args = parse_args()
+    configure_logging(args.log_level, args.change_log)
+    set_metrics(Metrics(trace_memory=args.trace_memory, profile_dir=args.profile_dir))
     try:
         main()
     except KeyboardInterrupt:
         print("\nProgram interrupted. Exiting gracefully...")
-        sys.exit(0)
\ No newline at end of file
+        sys.exit(0)
+    finally:
+        get_change_log().close()
+        if args.metrics or args.profile_dir:
+            get_metrics().write_report(args.metrics)
\ No newline at end of file
@@ -0,0 +1,169 @@
+# metrics.py
+
+import cProfile
+import json
+import os
+import platform
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Bump when the layout of the JSON report changes
+REPORT_FORMAT_VERSION = 1
+
+
+class Metrics:
+    """
+    Collects per-phase wall time, counters and, optionally, peak memory and
+    cProfile captures for a run.
+
+    Phases are timed with the phase() context manager and can nest; a phase
+    entered several times (e.g. once per sheet) accumulates its time and
+    call count. Counters are plain named totals ('cells_scanned', ...).
+
+    Phases may run on any thread, e.g. the 'load' phase on the prefetch
+    thread of workbook_prefetch. Nesting and profiling are tracked per
+    thread. tracemalloc only knows the peak of the whole process, so the
+    peak_bytes of phases running at the same time on different threads
+    include each other's allocations.
+
+    Parameters:
+    - trace_memory: Record the peak traced memory of every phase (tracemalloc)
+    - profile_dir: Directory receiving one '<phase>.prof' cProfile dump per
+      phase, or None to disable profiling
+    """
+
+    def __init__(self, trace_memory=False, profile_dir=None):
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.phases = {}
+        self.counters = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        # Thread ident -> peaks of the open phases of that thread, innermost last
+        self._memory_stacks = {}
+        self._profiles = {}
+        # Per thread: only one profiler can be active at a time; nested phases share it
+        self._thread_state = threading.local()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def count(self, name, amount=1):
+        """Adds amount to a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times a block of code as the named phase.
+
+        Example:
+            with metrics.phase('save'):
+                wb.save(output_file)
+        """
+        trace_memory = self.trace_memory
+        if trace_memory:
+            with self._lock:
+                # The running peak belongs to the phases open until now
+                self._fold_peak()
+                self._memory_stacks.setdefault(threading.get_ident(), []).append(0)
+
+        profiler = None
+        if self.profile_dir is not None and not getattr(self._thread_state, 'profiling', False):
+            profiler = self._start_profiler(name)
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiler is not None:
+                profiler.disable()
+                self._thread_state.profiling = False
+
+            with self._lock:
+                peak = None
+                if trace_memory:
+                    self._fold_peak()
+                    stack = self._memory_stacks[threading.get_ident()]
+                    peak = stack.pop()
+                    if stack:
+                        stack[-1] = max(stack[-1], peak)
+                    else:
+                        del self._memory_stacks[threading.get_ident()]
+
+                record = self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                record['seconds'] += elapsed
+                record['calls'] += 1
+                if peak is not None:
+                    record['peak_bytes'] = max(record.get('peak_bytes', 0), peak)
+
+    def _fold_peak(self):
+        """Adds the traced peak since the last reset to the innermost open phase of every thread (lock held)."""
+        peak = tracemalloc.get_traced_memory()[1]
+        for stack in self._memory_stacks.values():
+            stack[-1] = max(stack[-1], peak)
+        tracemalloc.reset_peak()
+
+    def _start_profiler(self, name):
+        """Enables the profiler of a phase on this thread; returns it, or None if it is busy elsewhere."""
+        with self._lock:
+            profiler = self._profiles.get(name)
+            if profiler is None:
+                profiler = self._profiles[name] = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return None  # Another thread is profiling (Python 3.12+ allows one profiler per process)
+        self._thread_state.profiling = True
+        return profiler
+
+    def report(self):
+        """Returns the collected metrics as a JSON-serialisable dict."""
+        import openpyxl  # Only needed for the version; keeps this module cheap to import
+
+        with self._lock:
+            return {
+                'format': REPORT_FORMAT_VERSION,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'total_seconds': round(time.time() - self.started, 6),
+                'python': platform.python_version(),
+                'openpyxl': openpyxl.__version__,
+                'phases': {
+                    name: dict(record, seconds=round(record['seconds'], 6))
+                    for name, record in self.phases.items()
+                },
+                'counters': dict(self.counters),
+            }
+
+    def write_report(self, path):
+        """
+        Writes the JSON report and, when profiling, the per-phase cProfile dumps.
+
+        Parameters:
+        - path: Path of the JSON report (None only writes the profiles)
+        """
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            for name, profiler in self._profiles.items():
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+        if path is not None:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.report(), f, indent=2)
+
+
+_metrics = Metrics()
+
+
+def set_metrics(metrics):
+    """Replaces the process-wide Metrics and returns it."""
+    global _metrics
+    _metrics = metrics
+    return metrics
+
+
+def get_metrics():
+    """Returns the process-wide Metrics."""
+    return _metrics
@@ -0,0 +1,163 @@
+# name_expander.py
+
+import re
+import time
+from tqdm import tqdm
+from name_index import NameIndex
+from formula_updater import collect_formula_cells, store_formula
+from app_logging import SUMMARY, get_change_log, get_logger, progress_enabled
+from metrics import get_metrics
+
+log = get_logger(__name__)
+
+# Single compiled pattern that finds the identifiers of a formula.
+# String literals, quoted sheet names and structured references are consumed
+# as a whole so a name-like word inside them is never seen as a name. The
+# look-behind and look-ahead keep out fragments of longer tokens, sheet-scoped
+# names ('Sheet1!name'), function calls and sheet prefixes.
+#
+# Only the identifier alternative has a capturing group, so every other token
+# leaves match.lastindex as None.
+NAME_TOKEN_PATTERN = re.compile(r"""
+    "(?:[^"]|"")*"                                      # string literal
+  | '(?:[^']|'')*'!?                                    # 'Quoted Sheet'!
+  | \[(?:[^\[\]]|\[[^\]]*\])*\]                         # structured reference / [1]
+  | (?<![\w.$!\\])                                      # not inside a name, number or after a sheet
+    ((?:[^\W\d]|\\)[\w.\\]*)                            # identifier
+    (?![\w.(!\[])                                       # not a function, sheet or table
+""", re.VERBOSE)
+
+# Sheet names that can be written without quotes
+_PLAIN_SHEET = re.compile(r"[^\W\d][\w.]*")
+_CELL_LIKE = re.compile(r"[A-Za-z]{1,3}\d+|R\d*C\d*", re.IGNORECASE)
+
+
+def _sheet_prefix(sheet):
+    """Returns 'Sheet1!' or "'Tax Calculation'!" as Excel would write it."""
+    if _PLAIN_SHEET.fullmatch(sheet) and not _CELL_LIKE.fullmatch(sheet):
+        return f"{sheet}!"
+    return "'" + sheet.replace("'", "''") + "'!"
+
+
+def _absolute(coord):
+    """Turns 'L404' into '$L$404' and 'L200:L210' into '$L$200:$L$210'."""
+    parts = []
+    for cell in coord.split(':'):
+        split = len(cell.rstrip('0123456789'))
+        parts.append(f"${cell[:split]}${cell[split:]}")
+    return ':'.join(parts)
+
+
+def build_expansions(name_index):
+    """
+    Builds the name -> reference text table used by NameExpander.
+
+    Names that point to more than one block cannot be written as a single
+    reference and are left out.
+
+    Parameters:
+    - name_index: NameIndex of the workbook
+
+    Returns:
+    - Dict of upper-cased defined name -> absolute reference ("'Tax Calculation'!$L$404")
+    """
+    expansions = {}
+    for name in name_index.names():
+        destinations = name_index.destinations(name)
+        if len(destinations) != 1:
+            continue
+        sheet, coord = destinations[0]
+        # Excel names are case-insensitive
+        expansions[name.upper()] = _sheet_prefix(sheet) + _absolute(coord)
+    return expansions
+
+
+class NameExpander:
+    """
+    Replaces defined names in formulas with the cell or range they refer to,
+    the reverse of FormulaRewriter.
+
+    All names are matched in one pass of NAME_TOKEN_PATTERN: the regex engine
+    walks the formula once, in C, and hands back only whole identifiers,
+    which are then looked up in a hash of the names. The cost of a formula
+    does not grow with the number of defined names, and a name is never
+    replaced inside a longer identifier, a string literal or a sheet name.
+
+    Parameters:
+    - expansions: Dict of upper-cased defined name -> reference text, see build_expansions
+    """
+
+    def __init__(self, expansions):
+        self._expansions = expansions
+
+        def replace(match):
+            if match.lastindex is None:
+                return match.group()
+            return expansions.get(match.group(1).upper()) or match.group()
+
+        self._replace = replace
+
+    def __len__(self):
+        return len(self._expansions)
+
+    def expand(self, formula):
+        """
+        Expands the names of a single formula.
+
+        Returns:
+        - The expanded formula, or the very same string object if nothing changed.
+        """
+        if not self._expansions:
+            return formula
+        formula_new = NAME_TOKEN_PATTERN.sub(self._replace, formula)
+        return formula if formula_new == formula else formula_new
+
+
+def expand_workbook_names(wb, sheet_names, name_index=None):
+    """
+    Expands the defined names in the formulas of the given sheets back to cell references.
+
+    For example, in every sheet '=display_code_1657*2' becomes
+    "='Tax Calculation'!$L$404*2". The defined names themselves are kept.
+
+    Parameters:
+    - wb: openpyxl Workbook object
+    - sheet_names: Names of the sheets to update (hidden sheets are skipped)
+    - name_index: NameIndex kept for the session (built from wb.defined_names if omitted)
+
+    Returns:
+    - Number of formulas that were rewritten
+    """
+    metrics = get_metrics()
+    if name_index is None:
+        name_index = NameIndex.from_workbook(wb)
+    with metrics.phase('build_expander'):
+        expander = NameExpander(build_expansions(name_index))
+    log.info("Expanding %d defined names.", len(expander))
+
+    change_log = get_change_log()
+    updated = 0
+    for ws in tqdm([wb[name] for name in sheet_names], desc="Processing Sheets", unit="sheet",
+                   disable=not progress_enabled()):
+        if ws.sheet_state in ['hidden', 'veryHidden']:
+            log.info("Skipping hidden sheet: %s", ws.title)
+            continue
+
+        log.info("Processing sheet: %s at %s", ws.title, time.strftime('%X'))
+        updated_in_sheet = 0
+        formula_cells = collect_formula_cells(ws)
+        with metrics.phase('expand'):
+            for row, column, formula in formula_cells:
+                formula_new = expander.expand(formula)
+                if formula_new is not formula:
+                    cell = ws.cell(row=row, column=column)
+                    log.debug("  Expanded cell %s in '%s': '%s' to '%s'", cell.coordinate, ws.title, formula, formula_new)
+                    if change_log.enabled:
+                        change_log.record('formula', ws.title, cell.coordinate, formula, formula_new)
+                    store_formula(cell, formula_new)
+                    updated_in_sheet += 1
+        updated += updated_in_sheet
+        log.log(SUMMARY, "Sheet '%s': %d formula(s) expanded", ws.title, updated_in_sheet)
+    change_log.flush()
+    metrics.count('formulas_expanded', updated)
+    return updated
@@ -0,0 +1,244 @@
+# name_index.py
+
+import json
+import os
+import tempfile
+from formula_tokenizer import iter_references
+from range_index import normalize_range
+from utils import default_cache_dir, file_content_hash
+from app_logging import get_logger
+from metrics import get_metrics
+
+log = get_logger(__name__)
+
+# Bump when the serialised layout changes so old cache files are ignored
+CACHE_FORMAT_VERSION = 3
+
+
+def reference_destinations(refers_to):
+    """
+    Returns the (sheet, cell or range) destinations of a defined name's reference.
+
+    Only a plain reference or a union of references is accepted
+    ("'Tax Calculation'!$L$404", 'Sheet1!$A$1:$B$2,Sheet1!$D$4'); a name
+    defined by a formula such as OFFSET(Sheet1!$E$1,0,0,5) or Sheet1!$A$1*2
+    does not stand for the cells it mentions and has no destinations.
+
+    Parameters:
+    - refers_to: Reference text of the name, without '='
+
+    Returns:
+    - List of (sheet, coord) tuples, empty if the text is not a reference
+    """
+    destinations = []
+    position = 0
+    for sheet, cell, range_end, start, end in iter_references(refers_to):
+        if sheet is None or refers_to[position:start].strip() != ('' if position == 0 else ','):
+            return []
+        destinations.append((sheet, f"{cell}:{range_end}" if range_end else cell))
+        position = end
+    if refers_to[position:].strip():
+        return []
+    return destinations
+
+
+def _clean_destination(sheet, coord):
+    """Normalises a (sheet, cell) destination to the form used in the mapping."""
+    sheet_clean = sheet.strip().strip("'").replace("''", "'")
+    if ':' in coord:
+        return sheet_clean, normalize_range(coord.upper())
+    return sheet_clean, coord.upper().replace('$', '')
+
+
+class NameIndex:
+    """
+    Index of the workbook's defined names that refer to single cells or
+    rectangular ranges.
+
+    It is built once per session and kept in sync by add_named_ranges, so
+    update_formulas no longer has to rebuild the mapping from
+    wb.defined_names. The index can be stored in a cache file keyed by the
+    workbook's content hash, which lets re-opening an unchanged file skip
+    the rebuild.
+
+    Attributes:
+    - mapping: Dict of sheet name -> {cell address ('L404') or range
+      ('L200:L210', top-left corner first) -> defined name}
+    - version: Counter bumped on every change to the index
+    """
+
+    def __init__(self):
+        self.mapping = {}
+        self.version = 0
+        # name -> list of (sheet, cell) destinations
+        self._destinations = {}
+        # (sheet, cell) -> names pointing at that cell, oldest first
+        self._cell_names = {}
+
+    def __contains__(self, name):
+        return name in self._destinations
+
+    def __len__(self):
+        return len(self._destinations)
+
+    def names(self):
+        """Returns the indexed names in insertion order."""
+        return list(self._destinations)
+
+    def destinations(self, name):
+        """Returns the (sheet, cell) destinations of a name, or an empty list."""
+        return list(self._destinations.get(name, []))
+
+    def add(self, name, destinations):
+        """
+        Adds or replaces a name.
+
+        Parameters:
+        - name: Defined name
+        - destinations: Iterable of (sheet, cell) tuples; cell may be a range
+        """
+        if name in self._destinations:
+            self.remove(name)
+
+        cells = []
+        for sheet, coord in destinations:
+            try:
+                sheet_clean, coord_clean = _clean_destination(sheet, coord)
+            except ValueError:
+                continue  # Whole rows or columns ('$A:$A') never replace a reference
+            cells.append((sheet_clean, coord_clean))
+            self._cell_names.setdefault((sheet_clean, coord_clean), []).append(name)
+            self.mapping.setdefault(sheet_clean, {})[coord_clean] = name
+
+        self._destinations[name] = cells
+        self.version += 1
+
+    def remove(self, name):
+        """
+        Removes a name. If another name still points at one of its cells,
+        that name takes over the cell in the mapping.
+
+        Parameters:
+        - name: Defined name
+        """
+        cells = self._destinations.pop(name, None)
+        if cells is None:
+            return
+
+        for sheet, coord in cells:
+            names = self._cell_names[(sheet, coord)]
+            names.remove(name)
+            sheet_cells = self.mapping[sheet]
+            if names:
+                sheet_cells[coord] = names[-1]
+                continue
+            del self._cell_names[(sheet, coord)]
+            del sheet_cells[coord]
+            if not sheet_cells:
+                del self.mapping[sheet]
+        self.version += 1
+
+    @classmethod
+    def from_workbook(cls, wb):
+        """
+        Builds the index from wb.defined_names.
+
+        Parameters:
+        - wb: openpyxl Workbook object
+        """
+        index = cls()
+        with get_metrics().phase('build_name_index'):
+            index._add_defined_names(wb)
+        return index
+
+    def _add_defined_names(self, wb):
+        """Adds every cell and range defined name of a workbook."""
+        # Imported here so that importing this module does not load openpyxl
+        from openpyxl.workbook.defined_name import DefinedName
+
+        for name in wb.defined_names:
+            dn = wb.defined_names[name]  # Retrieve the DefinedName object
+            if not isinstance(dn, DefinedName):
+                log.warning("'%s' is not a DefinedName object.", name)
+                continue
+            self.add(dn.name, reference_destinations(dn.attr_text or ''))
+
+    def to_dict(self):
+        """Returns a JSON-serialisable representation of the index."""
+        return {
+            'format': CACHE_FORMAT_VERSION,
+            'names': [[name, cells] for name, cells in self._destinations.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds an index from to_dict() output.
+
+        Returns:
+        - NameIndex, or None if the data was written by another format version.
+        """
+        if data.get('format') != CACHE_FORMAT_VERSION:
+            return None
+        index = cls()
+        for name, cells in data['names']:
+            index.add(name, [tuple(cell) for cell in cells])
+        return index
+
+    @staticmethod
+    def cache_path(content_hash, cache_dir=None):
+        """Returns the cache file used for a workbook with the given content hash."""
+        return os.path.join(cache_dir or default_cache_dir(), f"{content_hash}.names.json")
+
+    def save_for_file(self, file_path, cache_dir=None):
+        """
+        Stores the index in the cache under the content hash of file_path.
+        Call it after the workbook was saved to that file.
+
+        Parameters:
+        - file_path: Path of the saved workbook
+        - cache_dir: Cache directory (default: utils.default_cache_dir())
+        """
+        self._write(self.cache_path(file_content_hash(file_path), cache_dir))
+
+    def _write(self, path):
+        """Writes the index to a cache file (atomically)."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A unique temp file: batch workers may write the same entry at once
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @classmethod
+    def load_or_build(cls, wb, file_path, cache_dir=None, content_hash=None):
+        """
+        Returns the index for a workbook that was just loaded from file_path,
+        reading it from the cache when the file content is unchanged.
+
+        Parameters:
+        - wb: openpyxl Workbook object loaded from file_path
+        - file_path: Path of the workbook file
+        - cache_dir: Cache directory (default: utils.default_cache_dir())
+        - content_hash: SHA-256 of the file if the caller already computed it
+        """
+        path = cls.cache_path(content_hash or file_content_hash(file_path), cache_dir)
+        try:
+            with open(path, encoding='utf-8') as f:
+                index = cls.from_dict(json.load(f))
+            if index is not None:
+                log.info("Loaded %d defined names from cache.", len(index))
+                return index
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # No usable cache entry; build from the workbook
+
+        index = cls.from_workbook(wb)
+        try:
+            index._write(path)
+        except OSError as e:
+            log.warning("Could not write name cache: %s", e)
+        return index
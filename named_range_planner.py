@@ -0,0 +1,206 @@
+# named_range_planner.py
+
+import shutil
+import openpyxl
+from named_ranges import (
+    parse_range, read_range_block, find_named_rows, named_range_name,
+    check_defined_names, diff_defined_names, report_upsert, upsert_defined_names, UpsertResult
+)
+from xlsx_stream import patch_defined_names
+from app_logging import SUMMARY, get_change_log, get_logger
+from metrics import get_metrics
+
+log = get_logger(__name__)
+
+def _config_prefix(config):
+    """Returns the prefix of a configuration, or None for 'without_prefix' ones."""
+    return config.get('prefix') if config.get('type') == 'with_prefix' else None
+
+def _merge_row_spans(parsed_configs):
+    """
+    Groups configurations whose row spans overlap or touch, so each group is read once.
+
+    Parameters:
+    - parsed_configs: List of (config_index, target_column, start_row, end_row, search_columns)
+
+    Returns:
+    - List of (start_row, end_row, columns, members) tuples, where members are the parsed configs of the group
+    """
+    groups = []
+    for parsed in sorted(parsed_configs, key=lambda p: p[2]):
+        _, target_column, start_row, end_row, search_columns = parsed
+        if groups and start_row <= groups[-1][1] + 1:
+            group = groups[-1]
+            group[1] = max(group[1], end_row)
+        else:
+            group = [start_row, end_row, [], []]
+            groups.append(group)
+        group[2].extend(list(search_columns) + [target_column])
+        group[3].append(parsed)
+    return [(start, end, list(dict.fromkeys(columns)), members) for start, end, columns, members in groups]
+
+def plan_named_ranges(ws, configurations):
+    """
+    Computes the names of all configurations for one worksheet in a single scan.
+
+    Configurations whose row ranges overlap are read as one block covering the
+    union of their rows and columns; each configuration then picks its names
+    from that block with the usual add_named_ranges rules.
+
+    Parameters:
+    - ws: openpyxl Worksheet object
+    - configurations: List of configuration dicts as collected in main.py
+      ('type', optional 'prefix', 'cell_range', 'search_columns')
+
+    Returns:
+    - Tuple (entries, collisions), or None if a configuration has an invalid range.
+      entries is a list of unique (named_range, target_column, row) in configuration order;
+      collisions maps a name to the sorted list of distinct cells it was planned for.
+    """
+    parsed_configs = []
+    for config_index, config in enumerate(configurations):
+        parsed = parse_range(config['cell_range'])
+        if parsed is None:
+            return None
+        start_col_letter, start_row, _, end_row = parsed
+        parsed_configs.append((config_index, start_col_letter, start_row, end_row, config['search_columns']))
+
+    # One block read per group of overlapping configurations
+    entries_by_config = {}
+    for start_row, end_row, columns, members in _merge_row_spans(parsed_configs):
+        block = read_range_block(ws, start_row, end_row, columns)
+        for config_index, target_column, config_start, config_end, search_columns in members:
+            prefix = _config_prefix(configurations[config_index])
+            named_rows = find_named_rows(block.loc[config_start:config_end], search_columns, target_column, prefix)
+            entries_by_config[config_index] = [
+                (named_range_name(value, prefix), target_column, row) for row, value in named_rows
+            ]
+
+    # Overlapping configurations may plan the very same name twice; keep one
+    entries = []
+    for config_index in range(len(configurations)):
+        entries.extend(entries_by_config[config_index])
+    entries = list(dict.fromkeys(entries))
+
+    # A name planned for different cells by different configurations is a collision
+    cells_by_name = {}
+    configs_by_name = {}
+    for config_index in range(len(configurations)):
+        for named_range, target_column, row in entries_by_config[config_index]:
+            cells_by_name.setdefault(named_range, set()).add(f"{target_column}{row}")
+            configs_by_name.setdefault(named_range, set()).add(config_index)
+    collisions = {
+        name: sorted(cells) for name, cells in cells_by_name.items()
+        if len(cells) > 1 and len(configs_by_name[name]) > 1
+    }
+    return entries, collisions
+
+def _report_collisions(collisions):
+    """Logs the names that two configurations would give to different cells."""
+    for name, cells in collisions.items():
+        log.error("The configurations would create '%s' for different cells: %s", name, ', '.join(cells))
+    log.error("No named ranges were created. Adjust the configurations and try again.")
+
+def add_named_range_configurations(wb, ws, configurations, name_index=None):
+    """
+    Creates the named ranges of several configurations for one worksheet.
+
+    All names are planned first (plan_named_ranges); if two configurations
+    would give the same name to different cells nothing is written.
+    Otherwise the names are written in one bulk upsert_defined_names call.
+
+    Parameters:
+    - wb: openpyxl Workbook object
+    - ws: openpyxl Worksheet object
+    - configurations: List of configuration dicts as collected in main.py
+    - name_index: Optional NameIndex that is updated with every change
+
+    Returns:
+    - Number of names created or replaced, or None if nothing was written
+    """
+    metrics = get_metrics()
+    with metrics.phase('plan_named_ranges'):
+        plan = plan_named_ranges(ws, configurations)
+    if plan is None:
+        return None
+    entries, collisions = plan
+
+    if collisions:
+        _report_collisions(collisions)
+        return None
+
+    log.log(SUMMARY, "Creating %d named ranges from %d configuration(s) in '%s'.", len(entries), len(configurations), ws.title)
+    with metrics.phase('create_named_ranges'):
+        result = upsert_defined_names(
+            wb, [(named_range, ws.title, f'{target_column}{row}') for named_range, target_column, row in entries],
+            name_index
+        )
+    report_upsert(result)
+    created = result.created + result.replaced
+    metrics.count('names_created', created)
+    return created
+
+def add_named_ranges_to_file(file_path, output_path, sheet_name, configurations):
+    """
+    Fast path for creating named ranges without loading or saving the whole workbook.
+
+    The sheet is opened in read_only mode and only the rows and columns of
+    the configurations are read; the names follow the same rules as
+    add_named_range_configurations. The result is written by patching the
+    <definedNames> block of xl/workbook.xml, every other part of the file is
+    copied unchanged.
+
+    Parameters:
+    - file_path: Path to the .xlsx file
+    - output_path: Path to write the updated file to (may equal file_path)
+    - sheet_name: Name of the sheet the configurations apply to
+    - configurations: List of configuration dicts as collected in main.py
+
+    Names are validated and checked for duplicates like in
+    upsert_defined_names; names that already point at the right cell are
+    not written again.
+
+    Returns:
+    - Number of names created or replaced, or None if nothing was written
+    """
+    metrics = get_metrics()
+    with metrics.phase('plan_named_ranges'):
+        wb = openpyxl.load_workbook(file_path, read_only=True)
+        try:
+            if sheet_name not in wb.sheetnames:
+                log.error("Sheet '%s' does not exist in the workbook.", sheet_name)
+                return None
+            plan = plan_named_ranges(wb[sheet_name], configurations)
+            # Lower-cased name -> (name, refers_to) of the existing global names
+            existing = {name.lower(): (name, dn.attr_text) for name, dn in wb.defined_names.items()}
+        finally:
+            wb.close()
+
+    if plan is None:
+        return None
+    entries, collisions = plan
+    if collisions:
+        _report_collisions(collisions)
+        return None
+
+    log.log(SUMMARY, "Creating %d named ranges from %d configuration(s) in '%s'.", len(entries), len(configurations), sheet_name)
+    accepted, invalid, duplicates = check_defined_names(
+        [(named_range, sheet_name, f'{target_column}{row}') for named_range, target_column, row in entries]
+    )
+    changes, unchanged = diff_defined_names(accepted, existing)
+    replaced = sum(1 for change in changes if change[4] is not None)
+
+    if changes:
+        with metrics.phase('patch_defined_names'):
+            patch_defined_names(file_path, output_path, [(change[0], change[3]) for change in changes])
+    elif file_path != output_path:
+        shutil.copyfile(file_path, output_path)
+    report_upsert(UpsertResult(len(changes) - replaced, replaced, unchanged, invalid, duplicates))
+    metrics.count('names_created', len(changes))
+
+    change_log = get_change_log()
+    if change_log.enabled:
+        for named_range, _, cell, refers_to, _, old_refers_to in changes:
+            change_log.record('defined_name', sheet_name, cell, old_refers_to, refers_to, name=named_range)
+        change_log.flush()
+    return len(changes)
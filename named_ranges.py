@@ -1,10 +1,328 @@
 # named_ranges.py
 
-import openpyxl
+import re
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from openpyxl.utils import column_index_from_string
 from openpyxl.workbook.defined_name import DefinedName
 from utils import parse_cell
+from journal import get_journal
+from app_logging import SUMMARY, get_change_log, get_logger
 
-def add_named_ranges(wb, ws, cell_range, search_columns, prefix=None):
+log = get_logger(__name__)
+
+# Excel's rules for a defined name: a letter, '_' or '\' first, then letters,
+# digits, '_', '.' or '\', at most 255 characters in total
+_NAME_PATTERN = re.compile(r"(?:[^\W\d]|\\)[\w.\\]{0,254}")
+# Names that Excel would read as an A1 or R1C1 reference
+_A1_NAME_PATTERN = re.compile(r"([A-Za-z]{1,3})(\d+)")
+_R1C1_NAME_PATTERN = re.compile(r"[Rr]\d*(?:[Cc]\d*)?|[Cc]\d*")
+
+# Outcome of upsert_defined_names:
+# - created, replaced, unchanged: Names added, pointed at a new cell, already correct
+# - invalid: List of (name, reason) tuples for names Excel would reject
+# - duplicates: Dict of name -> sorted cells the batch gave it (the last entry wins)
+UpsertResult = namedtuple('UpsertResult', ['created', 'replaced', 'unchanged', 'invalid', 'duplicates'])
+
+def read_range_block(ws, start_row, end_row, columns):
+    """
+    Reads the given columns of a row range as one block.
+
+    Parameters:
+    - ws: openpyxl Worksheet object (read-only worksheets work too)
+    - start_row: First row of the range
+    - end_row: Last row of the range (the two are swapped if given in reverse)
+    - columns: Column letters to read (e.g. ['J', 'K', 'L'])
+
+    Returns:
+    - pandas DataFrame of cell values (dtype object) indexed by row number,
+      with one column per requested column letter
+    """
+    start_row, end_row = min(start_row, end_row), max(start_row, end_row)
+    columns = list(dict.fromkeys(col.upper() for col in columns))
+    indexes = [column_index_from_string(col) for col in columns]
+    min_col, max_col = min(indexes), max(indexes)
+
+    cells = getattr(ws, '_cells', None)
+    if cells is not None:
+        # Regular worksheet: look the cells up directly. Unlike iter_rows this
+        # does not create empty cells in the worksheet and skips ws.cell().
+        get = cells.get
+        values = np.empty((end_row - start_row + 1, len(indexes)), dtype=object)
+        for j, col in enumerate(indexes):
+            column_cells = [get((row, col)) for row in range(start_row, end_row + 1)]
+            values[:, j] = [cell.value if cell is not None else None for cell in column_cells]
+    else:
+        # Read-only worksheet: stream the rows spanning all requested columns
+        rows = ws.iter_rows(min_row=start_row, max_row=end_row, min_col=min_col, max_col=max_col, values_only=True)
+        block = np.empty((end_row - start_row + 1, max_col - min_col + 1), dtype=object)
+        for i, row_values in enumerate(rows):
+            # Read-only worksheets may return short rows
+            block[i, :len(row_values)] = row_values
+        values = block[:, [index - min_col for index in indexes]]
+
+    return pd.DataFrame(values, index=pd.RangeIndex(start_row, end_row + 1), columns=columns)
+
+def _candidate_values(column, prefix):
+    """
+    Validates one search column at once.
+
+    Returns:
+    - Tuple (valid, text): boolean array of usable cells and the name part for each cell
+    """
+    if prefix:
+        # With a prefix only tax codes count: a 4-digit string or an int from 1000 to 9999
+        types = column.map(type)
+        is_str = types.eq(str).to_numpy()
+        is_int = types.eq(int).to_numpy()
+        str_valid = np.zeros(len(column), dtype=bool)
+        if is_str.any():
+            strings = column[is_str].astype(str)
+            str_valid[is_str] = (strings.str.isdigit() & strings.str.len().eq(4)).to_numpy()
+        int_valid = np.zeros(len(column), dtype=bool)
+        if is_int.any():
+            ints = column[is_int].astype(float)
+            int_valid[is_int] = ((ints >= 1000) & (ints <= 9999)).to_numpy()
+        text = column.astype(str).to_numpy()
+        return str_valid | int_valid, text
+
+    # Without a prefix any non-empty value is used
+    present = column.notna().to_numpy()
+    text = np.full(len(column), '', dtype=object)
+    if present.any():
+        text[present] = column[present].astype(str).str.strip().to_numpy()
+    return present & (text != ''), text
+
+def find_named_rows(block, search_columns, target_column, prefix=None):
+    """
+    Finds the rows that get a named range, using vectorized operations on a block
+    read by read_range_block.
+
+    For each row the first search column with a usable value wins. With a prefix
+    only tax codes are usable (4-digit str or int 1000-9999); without one any
+    non-empty value is. Rows whose target cell is empty are skipped.
+
+    Parameters:
+    - block: DataFrame from read_range_block
+    - search_columns: List of column letters to search, in priority order
+    - target_column: Column letter of the cells to name
+    - prefix: Optional string prefix (enables tax code validation)
+
+    Returns:
+    - List of (row, value) tuples in row order
+    """
+    if not search_columns:
+        return []
+    valid = np.empty((len(search_columns), len(block)), dtype=bool)
+    text = np.empty((len(search_columns), len(block)), dtype=object)
+    for i, col_letter in enumerate(search_columns):
+        valid[i], text[i] = _candidate_values(block[col_letter.upper()], prefix)
+
+    # First non-empty/valid search column per row
+    first = valid.argmax(axis=0)
+    selected = valid.any(axis=0) & block[target_column.upper()].notna().to_numpy()
+    positions = np.flatnonzero(selected)
+    values = text[first[positions], positions]
+    rows = block.index.to_numpy()[positions]
+    return list(zip(rows.tolist(), values.tolist()))
+
+def parse_range(cell_range):
+    """
+    Parses a range like 'L200:L408'.
+
+    A single cell ('L404') is a range of one row. A reversed range
+    ('L408:L200') is read top to bottom, with a warning.
+
+    Returns:
+    - Tuple (start_col_letter, start_row, end_col_letter, end_row) with
+      start_row <= end_row, or None if the format is invalid
+    """
+    # Extract start and end cells
+    start_cell, separator, end_cell = cell_range.partition(':')
+    try:
+        start_col_letter, start_row = parse_cell(start_cell)
+        end_col_letter, end_row = parse_cell(end_cell if separator else start_cell)
+    except ValueError:
+        log.error("Invalid cell range format '%s'. Please use format like 'L200:L408'.", cell_range)
+        return None
+    if start_row > end_row:
+        log.warning("Cell range '%s' is reversed; using rows %d to %d.", cell_range, end_row, start_row)
+        start_row, end_row = end_row, start_row
+    return start_col_letter, start_row, end_col_letter, end_row
+
+def named_range_name(value, prefix=None):
+    """Returns the defined name for a found value, with the prefix if one is given."""
+    return f"{prefix}{value}" if prefix else value
+
+def cell_reference(sheet_title, column, row):
+    """Returns the absolute reference a named range refers to, e.g. "'Tax Calculation'!$L$404"."""
+    # Ensure sheet name is properly quoted (handles single quotes in sheet name)
+    sheet_name_quoted = sheet_title.replace("'", "''")
+    return f"'{sheet_name_quoted}'!${column}${row}"
+
+def name_syntax_error(name):
+    """
+    Checks a defined name against Excel's naming rules.
+
+    Returns:
+    - None if the name is valid, otherwise the reason it is not
+    """
+    if not isinstance(name, str) or not _NAME_PATTERN.fullmatch(name):
+        return "must start with a letter, '_' or '\\' and contain only letters, digits, '_', '.' or '\\' (max 255)"
+    cell = _A1_NAME_PATTERN.fullmatch(name)
+    if cell is not None and column_index_from_string(cell.group(1).upper()) <= 16384 and int(cell.group(2)) <= 1048576:
+        return "looks like a cell reference"
+    if _R1C1_NAME_PATTERN.fullmatch(name):
+        return "looks like an R1C1 reference"
+    return None
+
+def check_defined_names(entries):
+    """
+    Validates a batch of names before anything is written.
+
+    Parameters:
+    - entries: List of (name, sheet, cell) tuples, e.g. ('display_code_1657', 'Tax Calculation', 'L404')
+
+    Returns:
+    - Tuple (accepted, invalid, duplicates). accepted is a dict of lower-cased
+      name -> (name, sheet, cell) in first-seen order, where a name given for
+      several cells keeps its last entry (Excel compares names
+      case-insensitively); invalid is a list of (name, reason) tuples;
+      duplicates maps those names to the sorted list of their cells.
+    """
+    accepted = {}
+    invalid = []
+    cells_by_name = {}
+    for name, sheet, cell in entries:
+        reason = name_syntax_error(name)
+        if reason is not None:
+            invalid.append((name, reason))
+            continue
+        key = name.lower()
+        cells_by_name.setdefault(key, set()).add(f"{sheet}!{cell}")
+        accepted[key] = (name, sheet, cell)
+    duplicates = {
+        accepted[key][0]: sorted(cells) for key, cells in cells_by_name.items() if len(cells) > 1
+    }
+    return accepted, invalid, duplicates
+
+def diff_defined_names(accepted, existing):
+    """
+    Compares validated names with the names a workbook already has.
+
+    Parameters:
+    - accepted: Dict from check_defined_names
+    - existing: Dict of lower-cased name -> (name, refers_to) of the workbook's global names
+
+    Returns:
+    - Tuple (changes, unchanged): changes is a list of (name, sheet, cell,
+      refers_to, old_name, old_refers_to) tuples in batch order, with
+      old_name None for new names; unchanged counts the names that already
+      point at their cell
+    """
+    changes = []
+    unchanged = 0
+    for key, (name, sheet, cell) in accepted.items():
+        column, row = parse_cell(cell)
+        refers_to = cell_reference(sheet, column, row)
+        old_name, old_refers_to = existing.get(key, (None, None))
+        if old_name == name and old_refers_to == refers_to:
+            unchanged += 1
+            continue
+        changes.append((name, sheet, f'{column}{row}', refers_to, old_name, old_refers_to))
+    return changes, unchanged
+
+def report_upsert(result):
+    """Logs one summary of an upsert: counts, then every rejected and duplicate name."""
+    log.log(SUMMARY, "Defined names: %d created, %d replaced, %d unchanged, %d invalid, %d duplicate(s).",
+            result.created, result.replaced, result.unchanged, len(result.invalid), len(result.duplicates))
+    for name, reason in result.invalid:
+        log.warning("Skipped invalid name %r: %s", name, reason)
+    for name, cells in result.duplicates.items():
+        log.warning("Name '%s' found for several cells, using the last one: %s", name, ', '.join(cells))
+
+# Attribute values of a default global DefinedName, copied by _new_defined_name
+_DEFINED_NAME_DEFAULTS = DefinedName(name='_').__dict__
+
+def _new_defined_name(name, refers_to):
+    """
+    Creates a global DefinedName without going through its descriptors.
+
+    DefinedName.__init__ validates every attribute through a descriptor, which is
+    most of the cost of creating tens of thousands of names; the name has
+    already been checked by check_defined_names.
+    """
+    defined_name = object.__new__(DefinedName)
+    defined_name.__dict__.update(_DEFINED_NAME_DEFAULTS, name=name, attr_text=refers_to)
+    return defined_name
+
+def upsert_defined_names(wb, entries, name_index=None):
+    """
+    Creates or replaces many single-cell defined names at once.
+
+    The whole batch is validated first (check_defined_names) and compared
+    with the workbook's names through a case-insensitive hash index, so
+    names that already point at the right cell are left alone. The changes
+    are then applied in one pass, in entry order.
+
+    Parameters:
+    - wb: openpyxl Workbook object
+    - entries: List of (name, sheet, cell) tuples, e.g. ('display_code_1657', 'Tax Calculation', 'L404')
+    - name_index: Optional NameIndex that is updated with the changes
+
+    Returns:
+    - UpsertResult
+    """
+    accepted, invalid, duplicates = check_defined_names(entries)
+    existing = {name.lower(): (name, dn.attr_text) for name, dn in wb.defined_names.items()}
+    changes, unchanged = diff_defined_names(accepted, existing)
+
+    change_log = get_change_log()
+    journal = get_journal()
+    for name, sheet, cell, refers_to, old_name, old_refers_to in changes:
+        old_defined_name = None
+        if old_name is not None:
+            old_defined_name = wb.defined_names[old_name]
+            del wb.defined_names[old_name]
+            if name_index is not None:
+                name_index.remove(old_name)
+        wb.defined_names.add(_new_defined_name(name, refers_to))
+        if name_index is not None:
+            name_index.add(name, [(sheet, cell)])
+        log.debug("Named range '%s' set to '%s'.", name, refers_to)
+        if journal is not None:
+            journal.record_name(name, refers_to, old_defined_name)
+        if change_log.enabled:
+            change_log.record('defined_name', sheet, cell, old_refers_to, refers_to, name=name)
+    change_log.flush()
+
+    replaced = sum(1 for change in changes if change[4] is not None)
+    return UpsertResult(len(changes) - replaced, replaced, unchanged, invalid, duplicates)
+
+def create_named_range(wb, ws, named_range, target_column, row, name_index=None):
+    """
+    Creates (or replaces) a defined name referring to a single cell.
+    For more than a handful of names use upsert_defined_names.
+
+    Parameters:
+    - wb: openpyxl Workbook object
+    - ws: openpyxl Worksheet object the cell lives in
+    - named_range: Name to create
+    - target_column: Column letter of the cell
+    - row: Row number of the cell
+    - name_index: Optional NameIndex that is updated with the change
+
+    Returns:
+    - True if the name was created, False otherwise
+    """
+    result = upsert_defined_names(wb, [(named_range, ws.title, f'{target_column}{row}')], name_index)
+    if result.invalid:
+        log.error("Error creating named range '%s': %s", named_range, result.invalid[0][1])
+        return False
+    return True
+
+def add_named_ranges(wb, ws, cell_range, search_columns, prefix=None, name_index=None):
     """
     Adds named ranges based on the provided cell range and search columns.
     If a prefix is provided, it will be used for the named ranges and tax code validation will be applied.
@@ -16,89 +334,32 @@ def add_named_ranges(wb, ws, cell_range, search_columns, prefix=None):
     - cell_range: String representing the cell range (e.g., 'L200:L408')
     - search_columns: List of column letters to search for values (e.g., ['J', 'K'])
     - prefix: Optional string prefix for the named ranges
+    - name_index: Optional NameIndex that is updated with every name removed or created
+
+    Returns:
+    - UpsertResult, or None if the cell range is invalid
     """
-    # Extract start and end cells
-    try:
-        start_cell, end_cell = cell_range.split(':')
-    except ValueError:
-        print(f"Error: Invalid cell range format '{cell_range}'. Please use format like 'L200:L408'.")
+    parsed = parse_range(cell_range)
+    if parsed is None:
         return
-
-    start_col_letter, start_row = parse_cell(start_cell)
-    end_col_letter, end_row = parse_cell(end_cell)
+    start_col_letter, start_row, end_col_letter, end_row = parsed
 
     # Ensure target_column is correct (should always be the same as start_col_letter)
     target_column = start_col_letter
 
-    # Debugging: Print parsed cell references
-    print(f"\nProcessing Range:")
-    print(f"Start Column: {start_col_letter}, Start Row: {start_row}")
-    print(f"End Column: {end_col_letter}, End Row: {end_row}")
-    print(f"Target Column: {target_column}")
-
-    # Iterate over the range and find values in the specified columns
-    for row in range(start_row, end_row + 1):
-        value = None
-
-        # Loop through each specified column to search for a value
-        for col_letter in search_columns:
-            cell_address = f'{col_letter}{row}'
-            cell_value = ws[cell_address].value
-
-            # Debugging: Uncomment the next line to see which cells are being checked
-            print(f"Checking cell {cell_address} with value: {cell_value}")
-
-            # Handle possible empty cells
-            if cell_value is None:
-                continue
-
-            if prefix:
-                # If prefix is provided, apply tax code validation
-                if isinstance(cell_value, str) and cell_value.isdigit() and len(cell_value) == 4:
-                    value = cell_value
-                    break  # Found a valid tax code
-                elif isinstance(cell_value, int) and 1000 <= cell_value <= 9999:
-                    value = str(cell_value)
-                    break  # Found a valid tax code
-            else:
-                # If no prefix, use any non-empty value
-                value = str(cell_value).strip()
-                if value:
-                    break  # Found a non-empty value
-
-        # If no valid value is found, skip this row
-        if value is None:
-            continue
+    # Debugging: Log parsed cell references
+    log.debug("Processing Range:")
+    log.debug("Start Column: %s, Start Row: %s", start_col_letter, start_row)
+    log.debug("End Column: %s, End Row: %s", end_col_letter, end_row)
+    log.debug("Target Column: %s", target_column)
+
+    # Read the target column and the search columns as one block
+    block = read_range_block(ws, start_row, end_row, list(search_columns) + [target_column])
+
+    # Find the rows that get a named range and the value to use for each
+    named_rows = find_named_rows(block, search_columns, target_column, prefix)
 
-        # Check if the target cell has a valid value
-        target_cell_address = f'{target_column}{row}'
-        target_cell_value = ws[target_cell_address].value
-        if target_cell_value is None:
-            continue  # Skip if the target cell is empty
-
-        # Create a named range for the target cell
-        # Ensure sheet name is properly quoted (handles single quotes in sheet name)
-        sheet_name_quoted = ws.title.replace("'", "''")
-        target_cell_ref = f"'{sheet_name_quoted}'!${target_column}${row}"
-        
-        if prefix:
-            named_range = f"{prefix}{value}"
-        else:
-            named_range = value
-
-        # Debugging: Print the named range details
-        print(f"Creating named range '{named_range}' referring to '{target_cell_ref}'.")
-
-        # Remove existing named range if it exists
-        if named_range in wb.defined_names:
-            del wb.defined_names[named_range]
-            print(f"Removed existing named range '{named_range}'.")
-
-        # Add the named range using DefinedName and append to defined_names
-        try:
-            new_defined_name = DefinedName(name=named_range, attr_text=target_cell_ref)
-            wb.defined_names[named_range] = new_defined_name  
-            print(f"Named range '{named_range}' created successfully.")
-        except Exception as e:
-            print(f"Error creating named range '{named_range}': {e}")
-            continue
\ No newline at end of file
+    entries = [(named_range_name(value, prefix), ws.title, f'{target_column}{row}') for row, value in named_rows]
+    result = upsert_defined_names(wb, entries, name_index)
+    report_upsert(result)
+    return result
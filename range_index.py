@@ -0,0 +1,92 @@
+# range_index.py
+
+from cell_address import ADDRESS_PATTERN, column_letter, parse_address
+
+
+def range_bounds(start, end):
+    """
+    Returns the (min_row, min_col, max_row, max_col) of the block between two corners.
+
+    Parameters:
+    - start, end: Corner cells in any order and spelling ('L210', '$L$200')
+    """
+    start_row, start_column = parse_address(start)
+    end_row, end_column = parse_address(end)
+    return (min(start_row, end_row), min(start_column, end_column),
+            max(start_row, end_row), max(start_column, end_column))
+
+
+def normalize_range(coord):
+    """
+    Returns the canonical spelling of a range: top-left and bottom-right
+    corner without '$' ('$L$210:L200' -> 'L200:L210').
+
+    Raises:
+    - ValueError for whole rows or columns ('$A:$A', '1:3')
+    """
+    start, end = coord.split(':', 1)
+    if not (ADDRESS_PATTERN.fullmatch(start) and ADDRESS_PATTERN.fullmatch(end)):
+        raise ValueError(f"Not a cell range: '{coord}'")
+    min_row, min_col, max_row, max_col = range_bounds(start, end)
+    return f"{column_letter(min_col)}{min_row}:{column_letter(max_col)}{max_row}"
+
+
+def range_corners(coord):
+    """Returns the four corner cells of a normalised range ('L200', 'L210', ...)."""
+    start, end = coord.split(':', 1)
+    min_row, min_col, max_row, max_col = range_bounds(start, end)
+    return {f"{column_letter(column)}{row}" for row in (min_row, max_row) for column in (min_col, max_col)}
+
+
+class RangeIndex:
+    """
+    Named rectangular ranges of one sheet, keyed by their bounds.
+
+    A range reference in a formula is reduced to its (min_row, min_col,
+    max_row, max_col) rectangle and looked up in a hash of the named
+    rectangles, so a lookup costs the same with ten or fifty thousand
+    names and the spelling of the reference ('$L$200:$L$210', 'L210:L200')
+    does not matter. The raw text of each reference seen is memoised
+    because copied formulas repeat the same ranges over and over.
+
+    It has the get() interface of the per-sheet cell dicts used by
+    FormulaRewriter, so both kinds of lookup share one code path.
+    """
+
+    def __init__(self):
+        # (min_row, min_col, max_row, max_col) -> defined name
+        self._rectangles = {}
+        # Reference text ('L200:L210') -> defined name or None
+        self._texts = {}
+
+    def __len__(self):
+        return len(self._rectangles)
+
+    def add(self, coord, name):
+        """
+        Adds a named range.
+
+        Parameters:
+        - coord: Range such as 'L200:L210' (any corner order, '$' allowed)
+        - name: Defined name
+        """
+        start, end = coord.split(':', 1)
+        self._rectangles[range_bounds(start, end)] = name
+        self._texts = {}
+
+    def get(self, coord, default=None):
+        """Returns the name of the range spelled coord ('$L$200:$L$210'), or default."""
+        name = self._texts.get(coord, False)
+        if name is False:
+            start, end = coord.split(':', 1)
+            name = self._texts[coord] = self._rectangles.get(range_bounds(start, end))
+        return default if name is None else name
+
+    def corners(self):
+        """Returns the corner cells of every named range ('L200', 'L210', ...)."""
+        return {
+            f"{column_letter(column)}{row}"
+            for min_row, min_col, max_row, max_col in self._rectangles
+            for row in (min_row, max_row)
+            for column in (min_col, max_col)
+        }
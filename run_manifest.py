@@ -0,0 +1,187 @@
+# run_manifest.py
+
+import hashlib
+import json
+import os
+import tempfile
+from formula_tokenizer import CANDIDATE_PATTERN
+from range_index import range_corners
+from utils import default_cache_dir
+from app_logging import get_logger
+
+log = get_logger(__name__)
+
+# Bump when the serialised layout changes so old manifests are ignored
+MANIFEST_FORMAT_VERSION = 1
+
+
+def formula_fingerprint(formula_cells):
+    """
+    Returns a digest of a sheet's formula cells.
+
+    Parameters:
+    - formula_cells: List of (row, column, formula) tuples, as returned by
+      formula_updater.collect_formula_cells
+    """
+    text = '\n'.join(f"{row},{column},{formula}" for row, column, formula in formula_cells)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def referenced_cells(formula_cells):
+    """Returns the sorted cell addresses ('L404') the formulas may reference, sheet left out."""
+    # One regex pass over all formulas; a newline never belongs to a candidate
+    cells = set(CANDIDATE_PATTERN.findall('\n'.join(formula for _, _, formula in formula_cells)))
+    return sorted({cell.replace('$', '') for cell in cells})
+
+
+def mapping_fingerprint(mapping, cells=None):
+    """
+    Returns a digest of a name mapping.
+
+    Parameters:
+    - mapping: Dict of sheet name -> {cell address or range -> defined name}
+    - cells: Only include the entries for these cell addresses, on any sheet,
+      and the ranges with one of them as a corner (default: every entry)
+    """
+    wanted = None if cells is None else set(cells)
+    digest = hashlib.sha256()
+    for sheet in sorted(mapping):
+        sheet_cells = mapping[sheet]
+        if wanted is None:
+            coords = sorted(sheet_cells)
+        else:
+            coords = [coord for coord in cells if coord in sheet_cells]
+            coords += sorted(
+                coord for coord in sheet_cells
+                if ':' in coord and not wanted.isdisjoint(range_corners(coord))
+            )
+        for coord in coords:
+            digest.update(f"{sheet}\x1f{coord}\x1f{sheet_cells[coord]}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """
+    Per-sheet record of the last formula update of a workbook.
+
+    For every updated sheet it keeps a fingerprint of the formulas as they
+    were left by the update, the cell addresses those formulas may still
+    reference and a fingerprint of the name mapping entries for those
+    addresses. A sheet can be skipped on the next run when its formulas are
+    unchanged and no name was added, removed or moved for a cell they
+    reference: rewriting it again would not change anything.
+
+    The manifest describes the formulas of a saved file, so it is stored in
+    the cache directory under the path of the file it was saved with.
+    """
+
+    def __init__(self):
+        # Sheet name -> {'formulas': digest, 'cells': [...], 'names': digest,
+        #                'mapping': digest of the whole mapping last checked against}
+        self.sheets = {}
+
+    def __len__(self):
+        return len(self.sheets)
+
+    def is_current(self, sheet_title, formula_cells, mapping, mapping_digest=None):
+        """
+        Returns True if an update of the sheet would not change any formula.
+
+        Parameters:
+        - sheet_title: Name of the sheet
+        - formula_cells: The sheet's current (row, column, formula) tuples
+        - mapping: Dict of sheet name -> {cell address -> defined name} for this run
+        - mapping_digest: mapping_fingerprint(mapping) if the caller already computed it
+        """
+        entry = self.sheets.get(sheet_title)
+        if entry is None or entry['formulas'] != formula_fingerprint(formula_cells):
+            return False
+        mapping_digest = mapping_digest or mapping_fingerprint(mapping)
+        if entry['mapping'] == mapping_digest:
+            return True
+        # Other names changed; only the ones for cells this sheet references matter
+        if entry['names'] != mapping_fingerprint(mapping, entry['cells']):
+            return False
+        entry['mapping'] = mapping_digest
+        return True
+
+    def record(self, sheet_title, formula_cells, mapping, mapping_digest=None):
+        """
+        Stores the state of a sheet right after its formulas were updated.
+
+        Parameters:
+        - sheet_title: Name of the sheet
+        - formula_cells: The sheet's (row, column, formula) tuples after the update
+        - mapping: Dict of sheet name -> {cell address -> defined name} used for the update
+        - mapping_digest: mapping_fingerprint(mapping) if the caller already computed it
+        """
+        cells = referenced_cells(formula_cells)
+        self.sheets[sheet_title] = {
+            'formulas': formula_fingerprint(formula_cells),
+            'cells': cells,
+            'names': mapping_fingerprint(mapping, cells),
+            'mapping': mapping_digest or mapping_fingerprint(mapping),
+        }
+
+    def to_dict(self):
+        """Returns a JSON-serialisable representation of the manifest."""
+        return {'format': MANIFEST_FORMAT_VERSION, 'sheets': self.sheets}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds a manifest from to_dict() output.
+
+        Returns:
+        - RunManifest, or None if the data was written by another format version.
+        """
+        if data.get('format') != MANIFEST_FORMAT_VERSION:
+            return None
+        manifest = cls()
+        manifest.sheets = dict(data['sheets'])
+        return manifest
+
+    @staticmethod
+    def manifest_path(file_path, cache_dir=None):
+        """Returns the manifest file used for the workbook at file_path."""
+        key = hashlib.sha256(os.path.abspath(file_path).encode('utf-8')).hexdigest()
+        return os.path.join(cache_dir or default_cache_dir(), 'manifests', f"{key}.json")
+
+    @classmethod
+    def load_for_file(cls, file_path, cache_dir=None):
+        """
+        Returns the manifest stored for a workbook file, or an empty one.
+
+        Parameters:
+        - file_path: Path of the workbook file
+        - cache_dir: Cache directory (default: utils.default_cache_dir())
+        """
+        try:
+            with open(cls.manifest_path(file_path, cache_dir), encoding='utf-8') as f:
+                manifest = cls.from_dict(json.load(f))
+            if manifest is not None:
+                log.info("Loaded run manifest for %d sheet(s).", len(manifest))
+                return manifest
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # No usable manifest; every sheet is updated
+        return cls()
+
+    def save_for_file(self, file_path, cache_dir=None):
+        """
+        Stores the manifest for a workbook file (atomically).
+        Call it after the workbook was saved to that file.
+
+        Parameters:
+        - file_path: Path of the saved workbook
+        - cache_dir: Cache directory (default: utils.default_cache_dir())
+        """
+        path = self.manifest_path(file_path, cache_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
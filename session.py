@@ -0,0 +1,256 @@
+# session.py
+
+"""
+Library entry point: the steps of main.py's menu as method calls, without
+prompts, so another Python process can drive the tool.
+
+    from session import Session
+
+    session = Session('Client 42.xlsx')
+    session.add_named_ranges('Tax Calculation', [
+        {'type': 'with_prefix', 'prefix': 'display_code_',
+         'cell_range': 'L200:L408', 'search_columns': ['J', 'K']},
+    ])
+    session.checkpoint('names added')
+    session.update_formulas()
+    session.rollback('names added')     # or session.undo()
+    session.save('updated_Client 42.xlsx')
+
+Importing this module is cheap: openpyxl, pandas and the modules built on
+them are imported on first use. A long-lived worker pays for them once (or
+up front with preload()) and then only pays for the workbooks themselves.
+Errors are raised instead of printed; progress goes through app_logging.
+"""
+
+from workbook_prefetch import WorkbookPrefetch
+from run_manifest import RunManifest
+from journal import Journal
+from app_logging import get_logger
+from metrics import get_metrics
+
+log = get_logger(__name__)
+
+
+def preload():
+    """Imports the modules a session needs, so the first workbook does not wait for them."""
+    import dependency_index
+    import formula_updater
+    import name_expander
+    import named_range_planner
+    import workbook_cache
+
+
+class Session:
+    """
+    One workbook opened for editing.
+
+    The workbook, its NameIndex, the DependencyIndex and the RunManifest are
+    kept for the lifetime of the session, like in an interactive main.py
+    session, so later steps reuse the indexes built by earlier ones. Every
+    step is journaled (see journal.Journal), so it can be undone in memory.
+
+    The workbook may also be edited directly through the workbook attribute:
+    every formula update re-indexes the sheets whose formulas no longer match
+    the dependency index. Such edits are not journaled, and defined names
+    must be changed through the session (or name_index kept in sync), since
+    the NameIndex does not watch wb.defined_names.
+
+    Parameters:
+    - file_path: Path to the .xlsx file
+    - background: Load the workbook on a background thread (see
+      WorkbookPrefetch); sheet_names is available right away and the first
+      step that needs the workbook waits for the load
+
+    Attributes:
+    - file_path: Path the workbook was opened from
+    - sheet_names: Sheet names in workbook order
+    - manifest: RunManifest of the last saved run of the file
+    - dependency_index: DependencyIndex of the sheets updated so far, created
+      by the second formula update of the session (a single update is faster
+      without it) and extended with the sheets later updates select
+    - journal: Journal of the changes made by the steps of this session
+
+    Raises:
+    - Whatever openpyxl.load_workbook raises (on the first step that needs
+      the workbook when loading in the background)
+    """
+
+    def __init__(self, file_path, background=False):
+        self.file_path = file_path
+        # Sheets left unchanged since the last saved run are not rewritten again
+        self.manifest = RunManifest.load_for_file(file_path)
+        self.dependency_index = None
+        self._formula_updates = 0
+        self.journal = Journal()
+        if background:
+            self._prefetch = WorkbookPrefetch(file_path)
+            self._loaded = None
+            self.sheet_names = self._prefetch.sheet_names
+        else:
+            from workbook_cache import load_workbook_cached
+            self._prefetch = None
+            self._loaded = load_workbook_cached(file_path)
+            self.sheet_names = list(self._loaded[0].sheetnames)
+
+    def load(self):
+        """
+        Returns the loaded workbook and its name index, waiting for a background load if needed.
+
+        Returns:
+        - Tuple (wb, name_index)
+        """
+        if self._loaded is None:
+            self._loaded = self._prefetch.result()
+        return self._loaded
+
+    @property
+    def workbook(self):
+        """The openpyxl Workbook object."""
+        return self.load()[0]
+
+    @property
+    def name_index(self):
+        """The NameIndex kept in sync with the workbook's defined names."""
+        return self.load()[1]
+
+    def select_sheets(self, sheet_names=None):
+        """
+        Returns the sheets a formula step works on.
+
+        Parameters:
+        - sheet_names: List of sheet names, or None for all sheets except
+          formula_updater.SHEETS_TO_SKIP
+
+        Raises:
+        - ValueError if a sheet does not exist in the workbook
+        """
+        if sheet_names is None:
+            from formula_updater import SHEETS_TO_SKIP
+            return [name for name in self.sheet_names if name not in SHEETS_TO_SKIP]
+        missing = [name for name in sheet_names if name not in self.sheet_names]
+        if missing:
+            raise ValueError(f"Sheet(s) not in the workbook: {', '.join(missing)}")
+        return list(sheet_names)
+
+    def add_named_ranges(self, sheet_name, configurations):
+        """
+        Creates the named ranges of one or more configurations in one scan of a sheet.
+
+        Parameters:
+        - sheet_name: Sheet holding the cells to name
+        - configurations: List of configuration dicts ('type', optional 'prefix',
+          'cell_range', 'search_columns') as collected by main.py
+
+        Returns:
+        - Number of names created or replaced
+
+        Raises:
+        - ValueError if the sheet does not exist or nothing could be written
+          (invalid range, name collisions; the details are logged)
+        """
+        from named_range_planner import add_named_range_configurations
+
+        self.select_sheets([sheet_name])
+        wb, name_index = self.load()
+        with self.journal.operation('Create Named Ranges'):
+            created = add_named_range_configurations(wb, wb[sheet_name], configurations, name_index=name_index)
+        if created is None:
+            raise ValueError(f"Named range configurations for '{sheet_name}' could not be applied.")
+        return created
+
+    def update_formulas(self, sheet_names=None, max_workers=None):
+        """
+        Replaces references to named cells and ranges with their names.
+
+        From the second call on, the dependency index is kept and reused, so
+        repeated updates only visit the formulas that reference a named cell;
+        sheets the manifest shows as unchanged are skipped.
+
+        Parameters:
+        - sheet_names: See select_sheets
+        - max_workers: See formula_updater.update_workbook_formulas
+
+        Returns:
+        - Number of formulas that were rewritten
+        """
+        from formula_updater import update_workbook_formulas
+        from dependency_index import DependencyIndex
+
+        sheet_names = self.select_sheets(sheet_names)
+        wb, name_index = self.load()
+        # Indexing costs more than one plain rewrite; it pays off from the second update on
+        if self.dependency_index is None and self._formula_updates:
+            self.dependency_index = DependencyIndex()
+        with self.journal.operation('Update Formulas'):
+            updated = update_workbook_formulas(wb, sheet_names, max_workers, name_index=name_index,
+                                               dependency_index=self.dependency_index, manifest=self.manifest)
+        self._formula_updates += 1
+        return updated
+
+    def expand_names(self, sheet_names=None):
+        """
+        Replaces defined names in formulas with the references they stand for.
+
+        Parameters:
+        - sheet_names: See select_sheets
+
+        Returns:
+        - Number of formulas that were rewritten
+        """
+        from name_expander import expand_workbook_names
+
+        sheet_names = self.select_sheets(sheet_names)
+        wb, name_index = self.load()
+        with self.journal.operation('Expand Named Ranges'):
+            return expand_workbook_names(wb, sheet_names, name_index=name_index)
+
+    def undo(self):
+        """
+        Reverts the last step that changed the workbook.
+
+        Returns:
+        - Tuple (step label, number of changes reverted), or None if there is nothing to undo
+        """
+        wb, name_index = self.load()
+        return self.journal.undo(wb, name_index)
+
+    def checkpoint(self, label):
+        """Marks the current state of the workbook so rollback(label) can return to it."""
+        self.journal.checkpoint(label)
+
+    def rollback(self, label):
+        """
+        Reverts every change made after a checkpoint.
+
+        Returns:
+        - Number of changes reverted
+
+        Raises:
+        - ValueError if there is no checkpoint with that label
+        """
+        wb, name_index = self.load()
+        return self.journal.rollback(wb, label, name_index)
+
+    def save(self, output_file=None):
+        """
+        Saves the workbook, then stores its name cache and run manifest for the next session.
+
+        Parameters:
+        - output_file: Path to save to (default: overwrite the opened file)
+
+        Returns:
+        - Path the workbook was saved to
+        """
+        output_file = output_file or self.file_path
+        wb, name_index = self.load()
+        with get_metrics().phase('save'):
+            wb.save(output_file)
+        try:
+            name_index.save_for_file(output_file)
+        except OSError as e:
+            log.warning("Could not write name cache: %s", e)
+        try:
+            self.manifest.save_for_file(output_file)
+        except OSError as e:
+            log.warning("Could not write run manifest: %s", e)
+        return output_file
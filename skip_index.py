@@ -0,0 +1,91 @@
+# skip_index.py
+
+from bisect import bisect_right
+
+class SkipIndex:
+    """
+    Cells whose formulas must not be touched: non-primary cells of merged
+    ranges and cells that anchor an image.
+
+    The cells are kept as sorted, non-overlapping row intervals per column,
+    so a lookup is a binary search and a large merged area costs one
+    interval per column instead of one entry per cell. Building the index
+    only reads the merged ranges and image anchors; no cells are created
+    in the worksheet.
+    """
+
+    def __init__(self):
+        # column -> (interval start rows, interval end rows), both sorted
+        self._columns = {}
+        # column -> list of (start_row, end_row) not yet merged into _columns
+        self._pending = {}
+
+    def add(self, min_row, max_row, column):
+        """Marks rows min_row..max_row (inclusive) of a column as skipped."""
+        if min_row <= max_row:
+            self._pending.setdefault(column, []).append((min_row, max_row))
+
+    def add_merged_range(self, min_col, min_row, max_col, max_row):
+        """Marks every cell of a merged range except its primary (top-left) cell."""
+        self.add(min_row + 1, max_row, min_col)
+        for column in range(min_col + 1, max_col + 1):
+            self.add(min_row, max_row, column)
+
+    def _build(self):
+        """Merges the pending intervals into the sorted per-column lists."""
+        for column, intervals in self._pending.items():
+            starts, ends = self._columns.get(column, ([], []))
+            intervals.extend(zip(starts, ends))
+            intervals.sort()
+            starts, ends = [], []
+            for start, end in intervals:
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._columns[column] = (starts, ends)
+        self._pending = {}
+
+    def skips(self, row, column):
+        """Returns True if the cell at (row, column) must be skipped."""
+        if self._pending:
+            self._build()
+        intervals = self._columns.get(column)
+        if intervals is None:
+            return False
+        starts, ends = intervals
+        position = bisect_right(starts, row) - 1
+        return position >= 0 and row <= ends[position]
+
+    def __contains__(self, cell):
+        row, column = cell
+        return self.skips(row, column)
+
+    def __bool__(self):
+        return bool(self._columns or self._pending)
+
+    @classmethod
+    def from_worksheet(cls, ws):
+        """
+        Builds the index of a worksheet.
+
+        Parameters:
+        - ws: openpyxl Worksheet object
+        """
+        index = cls()
+
+        # Non-primary merged cells
+        for merged_range in ws.merged_cells.ranges:
+            # merged_range.bounds returns (min_col, min_row, max_col, max_row)
+            index.add_merged_range(*merged_range.bounds)
+
+        # Cells with images
+        for image in ws._images:
+            if hasattr(image.anchor, 'from_'):  # Note: In newer versions, it's 'from_'
+                img_row = image.anchor.from_.row + 1  # zero-based index
+                img_col = image.anchor.from_.col + 1  # zero-based index
+                index.add(img_row, img_row, img_col)
+
+        index._build()
+        return index
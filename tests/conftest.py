@@ -0,0 +1,70 @@
+# conftest.py
+
+import os
+import sys
+import pytest
+
+# The modules live in the repository root, next to main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Defined names of the test workbook: plain cells, a range, a union and two
+# names defined by a formula, which must never replace the cells they mention
+DEFINED_NAMES = {
+    'code_a': "'Tax Calculation'!$L$10",
+    'code_b': "'Tax Calculation'!$L$11",
+    'block': "'Tax Calculation'!$L$20:$L$25",
+    'pair': "'Tax Calculation'!$M$1,'Tax Calculation'!$M$2",
+    'off': "OFFSET('Tax Calculation'!$E$1,0,0,5)",
+    'twice': "'Tax Calculation'!$E$2*2",
+}
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keeps the name, workbook and manifest caches of a test in its own directory."""
+    path = tmp_path / 'cache'
+    monkeypatch.setenv('FORMULA_CELL_MAPPER_CACHE', str(path))
+    return path
+
+
+@pytest.fixture
+def workbook_path(tmp_path):
+    """Writes a small workbook with local, cross-sheet and filled-down references."""
+    import openpyxl
+    from openpyxl.workbook.defined_name import DefinedName
+
+    wb = openpyxl.Workbook()
+    tax = wb.active
+    tax.title = 'Tax Calculation'
+    summary = wb.create_sheet('Summary')
+    other = wb.create_sheet('My Sheet')
+    for row in range(1, 31):
+        tax.cell(row=row, column=5, value=row)
+        tax.cell(row=row, column=12, value=row * 10)
+        tax.cell(row=row, column=14, value=f"=L{row}*2")
+        other.cell(row=row, column=1, value=f"='Tax Calculation'!L{row}+1")
+    tax['P1'] = "=E1+E2+$L$10+L11"
+    tax['P2'] = "=SUM(L20:L25)+SUM($L$20:$L$25)"
+    tax['P3'] = "=M1+M2+'My Sheet'!L10"
+    tax['P4'] = '="L10"&L11'
+    summary['A1'] = "='Tax Calculation'!L10+'Tax Calculation'!E1"
+    summary['A2'] = "=SUM('Tax Calculation'!$L$20:$L$25)*L10"
+    summary['A3'] = "=SUM('My Sheet'!A1:'My Sheet'!A2)+'Tax Calculation'!$L$11"
+    for name, refers_to in DEFINED_NAMES.items():
+        wb.defined_names[name] = DefinedName(name, attr_text=refers_to)
+
+    path = tmp_path / 'book.xlsx'
+    wb.save(path)
+    return str(path)
+
+
+def read_formulas(wb):
+    """Returns {(sheet, coordinate): formula} of every formula cell of a workbook."""
+    from formula_updater import formula_text
+    return {
+        (ws.title, cell.coordinate): formula_text(cell.value)
+        for ws in wb.worksheets
+        for row in ws.iter_rows()
+        for cell in row
+        if cell.data_type == 'f'
+    }
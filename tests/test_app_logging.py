@@ -0,0 +1,16 @@
+# test_app_logging.py
+
+import logging
+from app_logging import SUMMARY, _ConsoleFormatter
+
+
+def _format(level, message):
+    record = logging.LogRecord('formula_cell_mapper.test', level, __file__, 1, message, ('x',), None)
+    return _ConsoleFormatter('%(message)s').format(record)
+
+
+def test_console_formatter_adds_the_level_to_warnings_and_errors():
+    assert _format(logging.INFO, "Processing sheet: %s") == "Processing sheet: x"
+    assert _format(SUMMARY, "Sheet '%s': 1 formula(s) updated") == "Sheet 'x': 1 formula(s) updated"
+    assert _format(logging.WARNING, "Could not write name cache: %s") == "Warning: Could not write name cache: x"
+    assert _format(logging.ERROR, "Sheet '%s' does not exist") == "Error: Sheet 'x' does not exist"
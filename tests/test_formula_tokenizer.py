@@ -0,0 +1,48 @@
+# test_formula_tokenizer.py
+
+import pytest
+from formula_tokenizer import FormulaRewriter, iter_references
+
+MAPPING = {
+    'X': {'A1': 'local_a1', 'B2': 'local_b2', 'L200:L210': 'local_block'},
+    'My Sheet': {'A1': 'my_a1', 'B2': 'my_b2'},
+    'Sheet1': {'B2': 'sheet1_b2'},
+}
+
+
+@pytest.mark.parametrize('row', [None, 7])
+@pytest.mark.parametrize('formula, expected', [
+    ("=A1+B2", "=local_a1+local_b2"),
+    ("=$A$1*2", "=local_a1*2"),
+    ("='My Sheet'!B2+A1", "=my_b2+local_a1"),
+    ("=Sheet1!B2", "=sheet1_b2"),
+    ("=SUM($L$200:$L$210)", "=SUM(local_block)"),
+    ("=SUM(L210:L200)", "=SUM(local_block)"),
+    # Ranges whose end is sheet-qualified are left alone, and their end
+    # cell is never taken for a cell of the formula's own sheet
+    ("=SUM('My Sheet'!A1:'My Sheet'!B2)", "=SUM('My Sheet'!A1:'My Sheet'!B2)"),
+    ("=SUM(Sheet1!A1:Sheet1!B2)", "=SUM(Sheet1!A1:Sheet1!B2)"),
+    ("=#REF!A1+B2", "=#REF!A1+local_b2"),
+    ('="A1"&B2', '="A1"&local_b2'),
+    ("=LOG10(A1)", "=LOG10(local_a1)"),
+    ("=A1:B2", "=A1:B2"),
+])
+def test_rewrite(formula, expected, row):
+    assert FormulaRewriter(MAPPING).rewrite(formula, 'X', row) == expected
+
+
+def test_unchanged_formula_is_returned_as_is():
+    formula = "=C3+1"
+    assert FormulaRewriter(MAPPING).rewrite(formula, 'X') is formula
+
+
+def test_row_plans_follow_relative_references():
+    rewriter = FormulaRewriter({'X': {'A5': 'five', 'A6': 'six'}})
+    assert rewriter.rewrite("=A5*2", 'X', 5) == "=five*2"
+    assert rewriter.rewrite("=A6*2", 'X', 6) == "=six*2"
+    assert rewriter.rewrite("=A7*2", 'X', 7) == "=A7*2"
+
+
+def test_iter_references():
+    references = [ref[:3] for ref in iter_references("='My Sheet'!A1+SUM(B2:C3)")]
+    assert references == [('My Sheet', 'A1', None), (None, 'B2', 'C3')]
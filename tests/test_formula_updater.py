@@ -0,0 +1,57 @@
+# test_formula_updater.py
+
+import openpyxl
+import formula_updater
+from conftest import read_formulas
+from dependency_index import DependencyIndex
+from formula_updater import update_workbook_formulas
+
+SHEETS = ['Tax Calculation', 'Summary', 'My Sheet']
+
+
+def _update(workbook_path, **options):
+    """Loads the test workbook, updates all sheets and returns (formulas, count)."""
+    wb = openpyxl.load_workbook(workbook_path)
+    updated = update_workbook_formulas(wb, SHEETS, **options)
+    return read_formulas(wb), updated
+
+
+def test_dependency_index_uses_the_pool(workbook_path, monkeypatch):
+    monkeypatch.setattr(formula_updater, 'PARALLEL_MIN_FORMULAS', 0)
+    calls = []
+    monkeypatch.setattr(formula_updater, 'update_sheets_in_parallel',
+                        lambda *args, **kwargs: calls.append(args) or 0)
+    wb = openpyxl.load_workbook(workbook_path)
+    update_workbook_formulas(wb, SHEETS, max_workers=2, dependency_index=DependencyIndex.from_workbook(wb))
+    assert len(calls) == 1
+
+
+def test_dependency_index_pool_matches_serial(workbook_path, monkeypatch):
+    monkeypatch.setattr(formula_updater, 'PARALLEL_MIN_FORMULAS', 0)
+    wb = openpyxl.load_workbook(workbook_path)
+    dependency_index = DependencyIndex.from_workbook(wb)
+    updated = update_workbook_formulas(wb, SHEETS, max_workers=2, dependency_index=dependency_index)
+    assert (read_formulas(wb), updated) == _update(workbook_path, max_workers=1)
+
+    # The index follows the rewritten formulas, so a second run changes nothing
+    assert update_workbook_formulas(wb, SHEETS, max_workers=2, dependency_index=dependency_index) == 0
+
+
+def test_pool_matches_serial(workbook_path):
+    serial = _update(workbook_path, max_workers=1)
+    assert serial[1] > 0
+    assert _update(workbook_path, max_workers=2) == serial
+
+
+def test_dependency_index_matches_serial(workbook_path):
+    wb = openpyxl.load_workbook(workbook_path)
+    updated = update_workbook_formulas(wb, SHEETS, max_workers=1, dependency_index=DependencyIndex.from_workbook(wb))
+    assert (read_formulas(wb), updated) == _update(workbook_path, max_workers=1)
+
+
+def test_dependency_index_covers_only_the_selected_sheets(workbook_path):
+    wb = openpyxl.load_workbook(workbook_path)
+    dependency_index = DependencyIndex()
+    updated = update_workbook_formulas(wb, ['Summary'], max_workers=1, dependency_index=dependency_index)
+    assert updated > 0
+    assert 'Summary' in dependency_index and 'Tax Calculation' not in dependency_index
@@ -0,0 +1,55 @@
+# test_journal.py
+
+import pytest
+from session import Session
+from conftest import read_formulas
+from named_ranges import upsert_defined_names
+
+
+def _snapshot(session):
+    """Returns the formulas, defined names and name index mapping of a session's workbook."""
+    wb = session.workbook
+    names = {name: dn.attr_text for name, dn in wb.defined_names.items()}
+    mapping = {sheet: dict(cells) for sheet, cells in session.name_index.mapping.items()}
+    return read_formulas(wb), names, mapping
+
+
+def test_undo_restores_formulas_and_names(workbook_path):
+    session = Session(workbook_path)
+    before = _snapshot(session)
+
+    with session.journal.operation('Replace code_a'):
+        upsert_defined_names(session.workbook, [('code_a', 'Tax Calculation', 'L12')], name_index=session.name_index)
+    replaced = _snapshot(session)
+    assert replaced[1]['code_a'] == "'Tax Calculation'!$L$12"
+
+    assert session.update_formulas(max_workers=1) > 0
+    assert session.undo()[0] == 'Update Formulas'
+    assert _snapshot(session) == replaced
+
+    assert session.undo()[0] == 'Replace code_a'
+    assert _snapshot(session) == before
+    assert session.undo() is None
+
+
+def test_rollback_restores_the_checkpoint(workbook_path):
+    session = Session(workbook_path)
+    ws = session.workbook['Tax Calculation']
+    for row in range(1, 31):
+        ws.cell(row=row, column=10, value=1000 + row)
+    before = _snapshot(session)
+    session.checkpoint('start')
+
+    created = session.add_named_ranges('Tax Calculation', [
+        {'type': 'with_prefix', 'prefix': 'code_', 'cell_range': 'L1:L30', 'search_columns': ['J']},
+    ])
+    assert created == 30
+    assert session.update_formulas(max_workers=1) > 0
+    assert session.expand_names() > 0
+    assert _snapshot(session) != before
+
+    assert session.rollback('start') > 0
+    assert _snapshot(session) == before
+
+    with pytest.raises(ValueError):
+        session.rollback('missing')
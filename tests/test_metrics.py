@@ -0,0 +1,67 @@
+# test_metrics.py
+
+import threading
+import tracemalloc
+import pytest
+from metrics import Metrics
+
+
+@pytest.fixture
+def stop_tracing():
+    """Stops tracemalloc again if a test started it."""
+    tracing = tracemalloc.is_tracing()
+    yield
+    if not tracing:
+        tracemalloc.stop()
+
+
+def _in_thread(metrics, name, started, release):
+    """Runs a phase on a background thread that allocates and stays open until release is set."""
+    def run():
+        with metrics.phase(name):
+            data = bytearray(4_000_000)
+            started.set()
+            release.wait(5)
+            del data
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_phases_on_other_threads_record_peak_memory(stop_tracing):
+    metrics = Metrics(trace_memory=True)
+    started, release = threading.Event(), threading.Event()
+    thread = _in_thread(metrics, 'load', started, release)
+    started.wait(5)
+    # A main-thread phase resetting the peak meanwhile must not hide the load's peak
+    with metrics.phase('prompt'):
+        pass
+    release.set()
+    thread.join()
+
+    assert metrics.phases['load']['peak_bytes'] >= 4_000_000
+    assert 'peak_bytes' in metrics.phases['prompt']
+
+
+def test_nested_phase_peak_counts_for_the_outer_phase(stop_tracing):
+    metrics = Metrics(trace_memory=True)
+    with metrics.phase('outer'):
+        with metrics.phase('inner'):
+            data = bytearray(2_000_000)
+            del data
+    assert metrics.phases['outer']['peak_bytes'] >= metrics.phases['inner']['peak_bytes'] >= 2_000_000
+
+
+def test_profiling_is_tracked_per_thread(tmp_path):
+    metrics = Metrics(profile_dir=str(tmp_path))
+    started, release = threading.Event(), threading.Event()
+    thread = _in_thread(metrics, 'load', started, release)
+    started.wait(5)
+    with metrics.phase('update'):
+        sum(range(1000))
+    release.set()
+    thread.join()
+
+    metrics.write_report(None)
+    assert (tmp_path / 'update.prof').exists()
@@ -0,0 +1,46 @@
+# test_name_expander.py
+
+import openpyxl
+import pytest
+from name_expander import NameExpander, build_expansions
+from name_index import NameIndex
+
+EXPANSIONS = {
+    'CODE_A': "'Tax Calculation'!$L$10",
+    'BLOCK': "'Tax Calculation'!$L$20:$L$25",
+    'RATE': 'Rates!$B$2',
+}
+
+
+@pytest.mark.parametrize('formula, expanded', [
+    ('=code_a*2', "='Tax Calculation'!$L$10*2"),
+    ('=Code_A+SUM(block)', "='Tax Calculation'!$L$10+SUM('Tax Calculation'!$L$20:$L$25)"),
+    ('=IF(code_a>0,rate,-code_a)', "=IF('Tax Calculation'!$L$10>0,Rates!$B$2,-'Tax Calculation'!$L$10)"),
+    # Longer identifiers and dotted names only contain a name
+    ('=code_a2+my.code_a+code_a.x+_code_a', None),
+    # String literals, with doubled quotes inside
+    ('="code_a"&"say ""rate"""&code_a', '="code_a"&"say ""rate"""&\'Tax Calculation\'!$L$10'),
+    # Sheet names, plain and quoted, and names local to another sheet
+    ("=Rate!A1+'code_a'!B2+Sheet1!code_a", None),
+    ("='It''s code_a'!A1+rate", "='It''s code_a'!A1+Rates!$B$2"),
+    # Functions, tables and structured references
+    ('=RATE(1,2,3)+block[Total]+Table1[code_a]+[1]rate!A1', None),
+    # Numbers and escaped names
+    ('=1.code_a+code_a', "=1.code_a+'Tax Calculation'!$L$10"),
+    ('=\\code_a+code_a\\x', None),
+])
+def test_expand(formula, expanded):
+    result = NameExpander(EXPANSIONS).expand(formula)
+    if expanded is None:
+        assert result is formula
+    else:
+        assert result == expanded
+
+
+def test_build_expansions_skips_unions(workbook_path):
+    expansions = build_expansions(NameIndex.from_workbook(openpyxl.load_workbook(workbook_path)))
+    assert expansions == {
+        'CODE_A': "'Tax Calculation'!$L$10",
+        'CODE_B': "'Tax Calculation'!$L$11",
+        'BLOCK': "'Tax Calculation'!$L$20:$L$25",
+    }
@@ -0,0 +1,43 @@
+# test_name_index.py
+
+import os
+import threading
+import openpyxl
+from name_index import NameIndex
+from utils import file_content_hash
+
+
+def test_cache_round_trip(workbook_path, cache_dir):
+    wb = openpyxl.load_workbook(workbook_path)
+    built = NameIndex.load_or_build(wb, workbook_path)
+    assert os.path.exists(NameIndex.cache_path(file_content_hash(workbook_path)))
+
+    cached = NameIndex.load_or_build(None, workbook_path)
+    assert cached.mapping == built.mapping
+    assert sorted(cached.names()) == sorted(built.names())
+
+
+def test_concurrent_cache_writes_use_their_own_temp_files(workbook_path, cache_dir):
+    index = NameIndex.from_workbook(openpyxl.load_workbook(workbook_path))
+    path = NameIndex.cache_path(file_content_hash(workbook_path))
+    # A fixed '<entry>.tmp' name would collide with this
+    os.makedirs(path + '.tmp')
+
+    errors = []
+
+    def write():
+        try:
+            for _ in range(20):
+                index._write(path)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert NameIndex.load_or_build(None, workbook_path).mapping == index.mapping
+    assert sorted(os.listdir(os.path.dirname(path))) == sorted([os.path.basename(path), os.path.basename(path) + '.tmp'])
@@ -0,0 +1,106 @@
+# test_named_ranges.py
+
+import openpyxl
+import pytest
+from named_range_planner import add_named_range_configurations
+from named_ranges import check_defined_names, diff_defined_names, name_syntax_error, parse_range, read_range_block
+
+
+@pytest.fixture
+def tax_sheet():
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'Tax Calculation'
+    for row, code in [(10, 1001), (11, '1002'), (12, 'n/a'), (13, 1004)]:
+        ws.cell(row=row, column=10, value=code)
+        ws.cell(row=row, column=12, value=row * 100)
+    return wb, ws
+
+
+def _configuration(cell_range):
+    return [{'type': 'with_prefix', 'prefix': 'code_', 'cell_range': cell_range, 'search_columns': ['J']}]
+
+
+def test_parse_range():
+    assert parse_range('L10:L13') == ('L', 10, 'L', 13)
+    assert parse_range('L13:L10') == ('L', 10, 'L', 13)
+    assert parse_range('L12') == ('L', 12, 'L', 12)
+    assert parse_range('L12:') is None
+
+
+def test_read_range_block_reversed(tax_sheet):
+    _, ws = tax_sheet
+    block = read_range_block(ws, 13, 10, ['J', 'L'])
+    assert block.index.tolist() == [10, 11, 12, 13]
+    assert block.loc[10, 'J'] == 1001
+
+
+def test_reversed_range_creates_names(tax_sheet):
+    wb, ws = tax_sheet
+    assert add_named_range_configurations(wb, ws, _configuration('L13:L10')) == 3
+    assert wb.defined_names['code_1004'].attr_text == "'Tax Calculation'!$L$13"
+
+
+@pytest.mark.parametrize('cell_range', ['L11', 'L11:L11'])
+def test_single_cell_range(tax_sheet, cell_range):
+    wb, ws = tax_sheet
+    assert add_named_range_configurations(wb, ws, _configuration(cell_range)) == 1
+    assert list(wb.defined_names) == ['code_1002']
+
+
+@pytest.mark.parametrize('name', ['display_code_1657', '_total', '\\notes', 'Tax.Rate', 'XFE1', 'ABCD1', 'A1048577', 'Rate2'])
+def test_valid_names(name):
+    assert name_syntax_error(name) is None
+
+
+@pytest.mark.parametrize('name, reason', [
+    ('1657_code', 'must start'),
+    ('display code', 'must start'),
+    ('', 'must start'),
+    (1657, 'must start'),
+    ('a' * 256, 'must start'),
+    ('L404', 'cell reference'),
+    ('xfd1048576', 'cell reference'),
+    ('R', 'R1C1'),
+    ('c', 'R1C1'),
+    ('R1C1', 'R1C1'),
+    ('R2C', 'R1C1'),
+])
+def test_invalid_names(name, reason):
+    assert reason in name_syntax_error(name)
+
+
+def test_check_defined_names_keeps_the_last_cell_of_a_duplicate():
+    accepted, invalid, duplicates = check_defined_names([
+        ('code_a', 'Tax Calculation', 'L10'),
+        ('L404', 'Tax Calculation', 'L11'),
+        ('CODE_A', 'Tax Calculation', 'L12'),
+        ('code_b', 'Tax Calculation', 'L13'),
+        ('code_b', 'Tax Calculation', 'L13'),
+    ])
+    assert list(accepted.values()) == [('CODE_A', 'Tax Calculation', 'L12'), ('code_b', 'Tax Calculation', 'L13')]
+    assert [name for name, _ in invalid] == ['L404']
+    # The same name for the same cell twice is not a duplicate
+    assert duplicates == {'CODE_A': ['Tax Calculation!L10', 'Tax Calculation!L12']}
+
+
+def test_diff_defined_names():
+    accepted, _, _ = check_defined_names([
+        ('code_a', 'Tax Calculation', 'L10'),
+        ('code_b', 'Tax Calculation', '$L$11'),
+        ('Code_C', 'Tax Calculation', 'L12'),
+        ('code_d', "Bob's Sheet", 'A1'),
+    ])
+    existing = {
+        'code_a': ('code_a', "'Tax Calculation'!$L$10"),
+        'code_b': ('code_b', "'Tax Calculation'!$L$99"),
+        'code_c': ('code_c', "'Tax Calculation'!$L$12"),
+    }
+    changes, unchanged = diff_defined_names(accepted, existing)
+    assert unchanged == 1
+    assert changes == [
+        ('code_b', 'Tax Calculation', 'L11', "'Tax Calculation'!$L$11", 'code_b', "'Tax Calculation'!$L$99"),
+        # Renaming the case of a name replaces it
+        ('Code_C', 'Tax Calculation', 'L12', "'Tax Calculation'!$L$12", 'code_c', "'Tax Calculation'!$L$12"),
+        ('code_d', "Bob's Sheet", 'A1', "'Bob''s Sheet'!$A$1", None, None),
+    ]
@@ -0,0 +1,64 @@
+# test_run_manifest.py
+
+import openpyxl
+import pytest
+import formula_updater
+from dependency_index import DependencyIndex
+from formula_updater import collect_formula_cells, update_workbook_formulas
+from run_manifest import RunManifest, formula_fingerprint
+
+SHEETS = ['Tax Calculation', 'Summary', 'My Sheet']
+FORMULAS = [(1, 2, '=A1+C7'), (2, 2, '=SUM(A1:A3)')]
+MAPPING = {'Tax Calculation': {'C7': 'code_a', 'E5': 'other'}}
+
+
+def test_is_current_after_record():
+    manifest = RunManifest()
+    assert not manifest.is_current('Tax Calculation', FORMULAS, MAPPING)
+    manifest.record('Tax Calculation', FORMULAS, MAPPING)
+    assert manifest.is_current('Tax Calculation', FORMULAS, MAPPING)
+    assert not manifest.is_current('Summary', FORMULAS, MAPPING)
+
+
+def test_is_current_sees_edited_formulas():
+    manifest = RunManifest()
+    manifest.record('Tax Calculation', FORMULAS, MAPPING)
+    assert not manifest.is_current('Tax Calculation', FORMULAS[:1], MAPPING)
+    assert not manifest.is_current('Tax Calculation', [(1, 2, '=A1+C8'), FORMULAS[1]], MAPPING)
+
+
+def test_is_current_ignores_names_of_unreferenced_cells():
+    manifest = RunManifest()
+    manifest.record('Tax Calculation', FORMULAS, MAPPING)
+    elsewhere = {'Tax Calculation': {**MAPPING['Tax Calculation'], 'Z99': 'unused'}}
+    assert manifest.is_current('Tax Calculation', FORMULAS, elsewhere)
+
+    for mapping in [
+        {'Tax Calculation': {'C7': 'renamed', 'E5': 'other'}},
+        {'Tax Calculation': {'E5': 'other'}},
+        {'Tax Calculation': {**MAPPING['Tax Calculation'], 'A1': 'new_name'}},
+        {**MAPPING, 'Summary': {'A3:A9': 'block'}},
+    ]:
+        assert not manifest.is_current('Tax Calculation', FORMULAS, mapping)
+
+
+def test_from_dict_rejects_other_formats():
+    manifest = RunManifest()
+    manifest.record('Tax Calculation', FORMULAS, MAPPING)
+    assert RunManifest.from_dict(manifest.to_dict()).is_current('Tax Calculation', FORMULAS, MAPPING)
+    assert RunManifest.from_dict({**manifest.to_dict(), 'format': 0}) is None
+
+
+@pytest.mark.parametrize('options', [
+    {'max_workers': 1},
+    {'max_workers': 2},
+    {'max_workers': 1, 'dependency_index': DependencyIndex()},
+])
+def test_update_records_the_formulas_it_left(workbook_path, monkeypatch, options):
+    monkeypatch.setattr(formula_updater, 'PARALLEL_MIN_FORMULAS', 0)
+    wb = openpyxl.load_workbook(workbook_path)
+    manifest = RunManifest()
+    assert update_workbook_formulas(wb, SHEETS, manifest=manifest, **options) > 0
+    for ws in wb.worksheets:
+        assert manifest.sheets[ws.title]['formulas'] == formula_fingerprint(collect_formula_cells(ws))
+    assert update_workbook_formulas(wb, SHEETS, manifest=manifest, **options) == 0
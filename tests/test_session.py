@@ -0,0 +1,37 @@
+# test_session.py
+
+from session import Session
+
+
+def test_dependency_index_is_built_by_the_second_update(workbook_path):
+    session = Session(workbook_path)
+    session.update_formulas(['Summary'], max_workers=1)
+    assert session.dependency_index is None
+
+    session.update_formulas(['My Sheet'], max_workers=1)
+    assert 'My Sheet' in session.dependency_index
+    assert 'Tax Calculation' not in session.dependency_index
+
+    session.update_formulas(max_workers=1)
+    assert 'Tax Calculation' in session.dependency_index
+
+
+def test_update_sees_formulas_edited_through_the_workbook(workbook_path):
+    session = Session(workbook_path)
+    ws = session.workbook['Tax Calculation']
+    session.update_formulas(max_workers=1)
+    ws['J12'] = 1012
+    session.add_named_ranges('Tax Calculation', [
+        {'type': 'with_prefix', 'prefix': 'code_', 'cell_range': 'L12:L12', 'search_columns': ['J']},
+    ])
+    assert session.update_formulas(max_workers=1) > 0
+    assert 'Tax Calculation' in session.dependency_index
+
+    ws['Q1'] = '=L999+1'
+    ws['J999'] = 1999
+    ws['L999'] = 5
+    session.add_named_ranges('Tax Calculation', [
+        {'type': 'with_prefix', 'prefix': 'code_', 'cell_range': 'L999:L999', 'search_columns': ['J']},
+    ])
+    assert session.update_formulas(max_workers=1) == 1
+    assert ws['Q1'].value == '=code_1999+1'
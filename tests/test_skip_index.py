@@ -0,0 +1,57 @@
+# test_skip_index.py
+
+import random
+from types import SimpleNamespace
+import openpyxl
+from skip_index import SkipIndex
+
+
+def test_matches_a_set_of_cells():
+    rng = random.Random(7)
+    index = SkipIndex()
+    cells = set()
+    for step in range(300):
+        column = rng.randint(1, 5)
+        min_row = rng.randint(1, 200)
+        max_row = min_row + rng.randint(-2, 20)
+        index.add(min_row, max_row, column)
+        cells.update((row, column) for row in range(min_row, max_row + 1))
+        if step % 50 == 0:
+            # Adding after a lookup merges into the intervals built so far
+            assert index.skips(1, 1) == ((1, 1) in cells)
+
+    for row in range(0, 230):
+        for column in range(0, 7):
+            assert ((row, column) in index) == ((row, column) in cells)
+
+
+def test_adjacent_and_nested_intervals_merge():
+    index = SkipIndex()
+    index.add(1, 3, 2)
+    index.add(4, 6, 2)
+    index.add(2, 5, 2)
+    index.add(10, 10, 2)
+    assert index.skips(6, 2) and not index.skips(7, 2) and index.skips(10, 2)
+    assert index._columns[2] == ([1, 10], [6, 10])
+
+
+def test_empty_index():
+    index = SkipIndex()
+    assert not index
+    assert not index.skips(1, 1)
+    index.add(5, 4, 1)  # Empty interval
+    assert not index
+
+
+def test_from_worksheet():
+    ws = openpyxl.Workbook().active
+    ws.merge_cells('B2:D4')
+    ws.merge_cells('F1:F3')
+    ws._images.append(SimpleNamespace(anchor=SimpleNamespace(from_=SimpleNamespace(row=9, col=0))))
+    index = SkipIndex.from_worksheet(ws)
+
+    merged = {(row, column) for row in range(2, 5) for column in range(2, 5)} - {(2, 2)}
+    merged |= {(2, 6), (3, 6)}
+    for row in range(1, 12):
+        for column in range(1, 8):
+            assert index.skips(row, column) == ((row, column) in merged or (row, column) == (10, 1))
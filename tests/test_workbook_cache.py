@@ -0,0 +1,33 @@
+# test_workbook_cache.py
+
+import os
+from conftest import read_formulas
+from workbook_cache import cache_key, load_workbook_cached, workbook_cache_dir
+
+
+def test_cache_is_off_by_default(workbook_path, cache_dir, monkeypatch):
+    monkeypatch.delenv('FORMULA_CELL_MAPPER_WORKBOOK_CACHE_MB', raising=False)
+    load_workbook_cached(workbook_path)
+    assert not os.path.exists(workbook_cache_dir(str(cache_dir)))
+
+
+def test_cache_round_trip(workbook_path, cache_dir, monkeypatch):
+    monkeypatch.setenv('FORMULA_CELL_MAPPER_WORKBOOK_CACHE_MB', '64')
+    wb, name_index = load_workbook_cached(workbook_path)
+    assert len(os.listdir(workbook_cache_dir(str(cache_dir)))) == 1
+
+    cached_wb, cached_index = load_workbook_cached(workbook_path)
+    assert read_formulas(cached_wb) == read_formulas(wb)
+    assert cached_index.mapping == name_index.mapping
+
+
+def test_cache_write_uses_its_own_temp_file(workbook_path, cache_dir, monkeypatch):
+    monkeypatch.setenv('FORMULA_CELL_MAPPER_WORKBOOK_CACHE_MB', '64')
+    directory = workbook_cache_dir(str(cache_dir))
+    key = cache_key(workbook_path)
+    # A fixed '<entry>.tmp' name would collide with this
+    os.makedirs(os.path.join(directory, f"{key}.wbcache.tmp"))
+
+    wb, name_index = load_workbook_cached(workbook_path)
+    assert sorted(os.listdir(directory)) == [f"{key}.wbcache", f"{key}.wbcache.tmp"]
+    assert read_formulas(load_workbook_cached(workbook_path)[0]) == read_formulas(wb)
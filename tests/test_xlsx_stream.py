@@ -0,0 +1,118 @@
+# test_xlsx_stream.py
+
+import zipfile
+import openpyxl
+from conftest import DEFINED_NAMES, read_formulas
+from formula_updater import update_workbook_formulas
+from name_index import NameIndex, reference_destinations
+from xlsx_stream import build_name_mapping, stream_update_formulas
+
+
+def test_reference_destinations():
+    assert reference_destinations("'Tax Calculation'!$L$10") == [('Tax Calculation', '$L$10')]
+    assert reference_destinations("Sheet1!$A$1:$B$2,Sheet1!$D$4") == [('Sheet1', '$A$1:$B$2'), ('Sheet1', '$D$4')]
+    assert reference_destinations("OFFSET(Sheet1!$E$1,0,0,5)") == []
+    assert reference_destinations("Sheet1!$E$2*2") == []
+    assert reference_destinations("$A$1") == []
+
+
+def test_name_mapping_matches_openpyxl(workbook_path):
+    mapping = build_name_mapping([(name, None, refers_to) for name, refers_to in DEFINED_NAMES.items()])
+    assert mapping == NameIndex.from_workbook(openpyxl.load_workbook(workbook_path)).mapping
+    assert 'E1' not in mapping['Tax Calculation']
+    assert 'E2' not in mapping['Tax Calculation']
+
+
+def test_stream_update_matches_openpyxl(workbook_path, tmp_path):
+    sheet_names = ['Tax Calculation', 'Summary', 'My Sheet']
+    wb = openpyxl.load_workbook(workbook_path)
+    update_workbook_formulas(wb, sheet_names, max_workers=1)
+
+    output = str(tmp_path / 'streamed.xlsx')
+    results = stream_update_formulas(workbook_path, output, sheet_names)
+
+    streamed = read_formulas(openpyxl.load_workbook(output))
+    assert streamed == read_formulas(wb)
+    assert sum(results.values()) > 0
+    assert streamed[('Tax Calculation', 'P1')] == "=E1+E2+code_a+code_b"
+    assert streamed[('Summary', 'A1')] == "=code_a+'Tax Calculation'!E1"
+
+
+def test_stream_update_keeps_member_metadata(workbook_path, tmp_path):
+    output = str(tmp_path / 'streamed.xlsx')
+    stream_update_formulas(workbook_path, output, ['Summary'])
+    with zipfile.ZipFile(workbook_path) as src, zipfile.ZipFile(output) as dst:
+        for info in src.infolist():
+            copied = dst.getinfo(info.filename)
+            assert (copied.compress_type, copied.date_time) == (info.compress_type, info.date_time)
+            assert copied.extract_version < 45  # No ZIP64 extensions on small members
+            if info.filename != 'xl/worksheets/sheet2.xml':
+                assert dst.read(info.filename) == src.read(info.filename)
+
+
+def _rewrite_cells(cells, mapping):
+    """Streams a worksheet part holding the given <c> elements and returns its new <sheetData> content."""
+    import io
+    from formula_tokenizer import FormulaRewriter
+    from xlsx_stream import MAIN_NS, rewrite_sheet_xml
+
+    xml = f'<worksheet xmlns="{MAIN_NS}"><sheetData><row r="1">{"".join(cells)}</row></sheetData></worksheet>'
+    dst = io.BytesIO()
+    updated = rewrite_sheet_xml(io.BytesIO(xml.encode('utf-8')), dst, FormulaRewriter(mapping), 'Tax Calculation')
+    text = dst.getvalue().decode('utf-8')
+    return text[text.index('<row r="1">') + len('<row r="1">'):text.index('</row>')], updated
+
+
+MAPPING = {'Tax Calculation': {'L10': 'code_a', 'L11': 'code_b'}}
+
+
+def test_shared_group_with_absolute_name_stays_shared():
+    cells, updated = _rewrite_cells([
+        '<c r="B1"><f t="shared" ref="B1:B3" si="0">$L$10*2</f></c>',
+        '<c r="B2"><f t="shared" si="0"/></c>',
+        '<c r="B3"><f t="shared" si="0"/></c>',
+    ], MAPPING)
+    assert cells == (
+        '<c r="B1"><f t="shared" ref="B1:B3" si="0">code_a*2</f></c>'
+        '<c r="B2"><f t="shared" si="0"/></c>'
+        '<c r="B3"><f t="shared" si="0"/></c>'
+    )
+    assert updated == 3
+
+
+def test_shared_group_expands_dependents_that_differ():
+    cells, updated = _rewrite_cells([
+        '<c r="B1"><f t="shared" ref="B1:B4" si="0">L10*2</f></c>',
+        '<c r="B2"><f t="shared" si="0"/></c>',
+        '<c r="B3"><f t="shared" si="0"/></c>',
+    ], MAPPING)
+    assert cells == (
+        '<c r="B1"><f t="shared" ref="B1:B4" si="0">code_a*2</f></c>'
+        '<c r="B2"><f>code_b*2</f></c>'
+        '<c r="B3"><f>L12*2</f></c>'
+    )
+    assert updated == 2
+
+
+def test_shared_group_without_cell_addresses_is_left_alone():
+    cells = [
+        '<c><f t="shared" ref="B1:B2" si="0">$L$10*2</f></c>',
+        '<c><f t="shared" si="0"/></c>',
+        '<c r="C1"><f t="shared" ref="C1:C2" si="1">$L$11</f></c>',
+        '<c s="1"><f t="shared" si="1"/></c>',
+    ]
+    result, updated = _rewrite_cells(cells, MAPPING)
+    assert result == ''.join(cells[:2]) + '<c r="C1"><f t="shared" ref="C1:C2" si="1">code_b</f></c>' + cells[3]
+    assert updated == 1
+
+
+def test_array_and_data_table_formulas():
+    cells, updated = _rewrite_cells([
+        '<c r="B1"><f t="array" ref="B1:B2">L10:L11*$L$11</f></c>',
+        '<c r="C1"><f t="dataTable" ref="C1:C2" r1="L10"/></c>',
+    ], MAPPING)
+    assert cells == (
+        '<c r="B1"><f t="array" ref="B1:B2">L10:L11*code_b</f></c>'
+        '<c r="C1"><f t="dataTable" ref="C1:C2" r1="L10"/></c>'
+    )
+    assert updated == 1
@@ -1,5 +1,9 @@
 # utils.py
 
+import hashlib
+import os
+from cell_address import split_address
+
 def get_user_input(prompt, default):
     """Helper function to get user input with a default value."""
     user_input = input(f"{prompt} (default: '{default}'): ")
@@ -7,9 +11,7 @@ def get_user_input(prompt, default):
 
 def parse_cell(cell):
     """Parses a cell reference into column letter and row number."""
-    col_letter = ''.join(filter(str.isalpha, cell)).upper()
-    row_number = int(''.join(filter(str.isdigit, cell)))
-    return col_letter, row_number
+    return split_address(cell.strip())
 
 
 # utils.py
@@ -30,3 +32,18 @@ def get_user_input(prompt, default=""):
         return user_input if user_input else default
     else:
         return input(f"{prompt}: ").strip()
+
+def default_cache_dir():
+    """Returns the directory used for on-disk caches (override with FORMULA_CELL_MAPPER_CACHE)."""
+    return os.environ.get(
+        'FORMULA_CELL_MAPPER_CACHE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'formula_cell_mapper')
+    )
+
+def file_content_hash(file_path, chunk_size=1 << 20):
+    """Returns the SHA-256 hex digest of a file's content, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
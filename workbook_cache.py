@@ -0,0 +1,239 @@
+# workbook_cache.py
+
+import hashlib
+import os
+import pickle
+import tempfile
+from array import array
+import openpyxl
+from openpyxl.cell.cell import Cell, MergedCell
+from openpyxl.styles.cell_style import StyleArray
+from name_index import NameIndex
+from utils import default_cache_dir, file_content_hash
+from app_logging import get_logger
+from metrics import get_metrics
+
+log = get_logger(__name__)
+
+# Bump when the layout of a cache entry changes so old entries are ignored
+CACHE_FORMAT_VERSION = 1
+
+# Size limit of the workbook cache directory in megabytes. The cache is off
+# unless FORMULA_CELL_MAPPER_WORKBOOK_CACHE_MB is set to a positive limit:
+# an entry takes about five times the size of the .xlsx file on disk (a
+# 1.8 MB workbook gives a 9 MB entry) and writing it makes the first load of
+# a file about a quarter slower. It pays off for large workbooks that are
+# reopened unchanged.
+DEFAULT_MAX_MB = 0
+
+_MERGED = 'M'
+
+
+def workbook_cache_dir(cache_dir=None):
+    """Returns the directory holding the parsed-workbook cache entries."""
+    return os.path.join(cache_dir or default_cache_dir(), 'workbooks')
+
+
+def max_cache_bytes():
+    """Returns the configured size limit of the workbook cache in bytes (0: the cache is off)."""
+    try:
+        megabytes = float(os.environ.get('FORMULA_CELL_MAPPER_WORKBOOK_CACHE_MB', DEFAULT_MAX_MB))
+    except ValueError:
+        megabytes = DEFAULT_MAX_MB
+    return int(megabytes * 1024 * 1024)
+
+
+def cache_key(file_path, content_hash=None):
+    """
+    Returns the cache key of a workbook file: a digest of its absolute path,
+    size, modification time and content hash.
+
+    Parameters:
+    - file_path: Path to the .xlsx file
+    - content_hash: SHA-256 of the file if already known
+    """
+    stat = os.stat(file_path)
+    content_hash = content_hash or file_content_hash(file_path)
+    raw = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}|{content_hash}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _pack_cells(ws):
+    """
+    Turns the cells of a worksheet into flat arrays.
+
+    Pickling every Cell object is nearly as slow as parsing the XML, so the
+    coordinates, values, data types and style ids are stored as columns
+    and the few cells with a hyperlink or comment are kept aside.
+    """
+    rows, columns, style_ids = array('i'), array('i'), array('i')
+    values, data_types = [], []
+    styles, extras = {}, {}
+    for (row, column), cell in ws._cells.items():
+        rows.append(row)
+        columns.append(column)
+        if cell.__class__ is MergedCell:
+            values.append(None)
+            data_types.append(_MERGED)
+        else:
+            values.append(cell._value)
+            data_types.append(cell.data_type)
+            if cell._hyperlink is not None or cell._comment is not None:
+                extras[(row, column)] = (cell._hyperlink, cell._comment)
+        style_ids.append(styles.setdefault(tuple(cell._style), len(styles)))
+    return rows, columns, values, ''.join(data_types), style_ids, list(styles), extras
+
+
+def _unpack_cells(ws, packed):
+    """Rebuilds ws._cells from _pack_cells output without going through Cell.__init__."""
+    rows, columns, values, data_types, style_ids, styles, extras = packed
+    new = object.__new__
+    cells = {}
+    for row, column, value, data_type, style_id in zip(rows, columns, values, data_types, style_ids):
+        if data_type == _MERGED:
+            cell = new(MergedCell)
+        else:
+            cell = new(Cell)
+            cell._value = value
+            cell.data_type = data_type
+            cell._hyperlink, cell._comment = extras.get((row, column), (None, None))
+        cell.row = row
+        cell.column = column
+        cell.parent = ws
+        # Every cell owns its StyleArray: style changes update it in place
+        cell._style = StyleArray(styles[style_id])
+        cells[(row, column)] = cell
+    ws._cells = cells
+
+
+def save_workbook_cache(wb, name_index, key, cache_dir=None, max_bytes=None):
+    """
+    Stores a parsed workbook and its name index under a cache key.
+
+    Parameters:
+    - wb: openpyxl Workbook object, as loaded from the file the key belongs to
+    - name_index: NameIndex of the workbook
+    - key: Value of cache_key() for the file
+    - cache_dir: Cache directory (default: utils.default_cache_dir())
+    - max_bytes: Size limit of the cache directory (default: max_cache_bytes())
+    """
+    directory = workbook_cache_dir(cache_dir)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{key}.wbcache")
+
+    # The cells travel as flat arrays; the rest of the object graph is pickled as is
+    sheets = [ws for ws in wb.worksheets if hasattr(ws, '_cells')]
+    saved_cells = [ws._cells for ws in sheets]
+    # Unique per writer, so batch workers caching the same file never share a temp file
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    try:
+        packed = [_pack_cells(ws) for ws in sheets]
+        for ws in sheets:
+            ws._cells = {}
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({
+                'format': CACHE_FORMAT_VERSION,
+                'openpyxl': openpyxl.__version__,
+                'workbook': wb,
+                'cells': packed,
+                'names': name_index.to_dict(),
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    finally:
+        for ws, cells in zip(sheets, saved_cells):
+            ws._cells = cells
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    evict(directory, max_cache_bytes() if max_bytes is None else max_bytes)
+
+
+def load_workbook_cache(key, cache_dir=None):
+    """
+    Returns the cached (wb, name_index) for a cache key, or None on a miss.
+
+    Entries written by another format version or openpyxl version are ignored.
+    """
+    path = os.path.join(workbook_cache_dir(cache_dir), f"{key}.wbcache")
+    try:
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning("Ignoring unreadable workbook cache entry: %s", e)
+        return None
+    if data.get('format') != CACHE_FORMAT_VERSION or data.get('openpyxl') != openpyxl.__version__:
+        return None
+    name_index = NameIndex.from_dict(data['names'])
+    if name_index is None:
+        return None
+
+    wb = data['workbook']
+    sheets = [ws for ws in wb.worksheets if hasattr(ws, '_cells')]
+    for ws, packed in zip(sheets, data['cells']):
+        _unpack_cells(ws, packed)
+
+    # Mark the entry as recently used for the LRU eviction
+    os.utime(path)
+    return wb, name_index
+
+
+def evict(directory, max_bytes):
+    """Removes the least recently used entries until the directory fits in max_bytes."""
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith('.wbcache'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def load_workbook_cached(file_path, cache_dir=None):
+    """
+    Loads a workbook and its name index, from the cache when the file is unchanged.
+
+    The workbook cache is opt-in (see DEFAULT_MAX_MB); while it is off this
+    is a plain openpyxl load plus the cached name index. When it is on, a
+    miss parses the workbook with openpyxl and stores it for the next
+    session; the cache directory is then trimmed to its size limit.
+
+    Parameters:
+    - file_path: Path to the .xlsx file
+    - cache_dir: Cache directory (default: utils.default_cache_dir())
+
+    Returns:
+    - Tuple (wb, name_index)
+    """
+    metrics = get_metrics()
+    max_bytes = max_cache_bytes()
+    if max_bytes <= 0:
+        with metrics.phase('load'):
+            wb = openpyxl.load_workbook(file_path)
+        return wb, NameIndex.load_or_build(wb, file_path, cache_dir)
+
+    with metrics.phase('load_cached'):
+        content_hash = file_content_hash(file_path)
+        key = cache_key(file_path, content_hash)
+        cached = load_workbook_cache(key, cache_dir)
+    if cached is not None:
+        log.info("Loaded parsed workbook from cache.")
+        return cached
+
+    with metrics.phase('load'):
+        wb = openpyxl.load_workbook(file_path)
+    name_index = NameIndex.load_or_build(wb, file_path, cache_dir, content_hash=content_hash)
+    try:
+        with metrics.phase('write_workbook_cache'):
+            save_workbook_cache(wb, name_index, key, cache_dir, max_bytes)
+    except Exception as e:
+        log.warning("Could not write workbook cache: %s", e)
+    return wb, name_index
@@ -0,0 +1,62 @@
+# workbook_prefetch.py
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xlsx_stream import read_sheet_names
+from app_logging import get_logger
+
+log = get_logger(__name__)
+
+
+def _load(file_path):
+    """Runs on the prefetch thread, so the openpyxl import is paid there as well."""
+    from workbook_cache import load_workbook_cached
+    return load_workbook_cached(file_path)
+
+
+class WorkbookPrefetch:
+    """
+    Loads a workbook on a background thread while the user answers prompts.
+
+    The sheet names are read up front from xl/workbook.xml, which is cheap,
+    so sheet listings and sheet prompts never wait for the full load. Code
+    that needs the openpyxl objects calls result(), which only blocks if the
+    load is still running. The load goes through workbook_cache, so with
+    the workbook cache enabled an unchanged file is restored from it.
+
+    Parameters:
+    - file_path: Path to the .xlsx file
+
+    Attributes:
+    - sheet_names: Sheet names in workbook order
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.sheet_names = read_sheet_names(file_path)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='workbook-prefetch')
+        self._future = self._executor.submit(_load, file_path)
+        # The thread ends by itself once the load is done
+        self._executor.shutdown(wait=False)
+
+    def ready(self):
+        """Returns True once the load has finished (successfully or not)."""
+        return self._future.done()
+
+    def result(self):
+        """
+        Returns the loaded workbook and its name index, waiting for the load if needed.
+
+        Returns:
+        - Tuple (wb, name_index)
+
+        Raises:
+        - Whatever openpyxl.load_workbook raised on the prefetch thread
+        """
+        if not self._future.done():
+            log.info("Waiting for the workbook to finish loading...")
+            started = time.perf_counter()
+            result = self._future.result()
+            log.info("Workbook loaded (waited %.1fs).", time.perf_counter() - started)
+            return result
+        return self._future.result()
@@ -0,0 +1,447 @@
+# xlsx_stream.py
+
+import html
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+import zipfile
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+from formula_tokenizer import FormulaRewriter
+from name_index import NameIndex, reference_destinations
+from app_logging import get_logger
+from metrics import get_metrics
+
+log = get_logger(__name__)
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+WORKBOOK_PART = 'xl/workbook.xml'
+WORKBOOK_RELS_PART = 'xl/_rels/workbook.xml.rels'
+
+# Bytes read from a sheet part at a time; memory use stays around a few chunks
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+def _resolve_target(target):
+    """Turns a relationship target from workbook.xml.rels into a zip member name."""
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join('xl', target))
+
+
+def read_workbook_info(zf):
+    """
+    Reads the sheet list and defined names from xl/workbook.xml without touching the sheets.
+
+    Parameters:
+    - zf: Open zipfile.ZipFile of the .xlsx file
+
+    Returns:
+    - Tuple (sheets, defined_names):
+      sheets is a list of dicts with 'name', 'state' and 'path' (zip member) in workbook order,
+      defined_names is a list of (name, local_sheet_id, refers_to) tuples.
+    """
+    rels = ElementTree.fromstring(zf.read(WORKBOOK_RELS_PART))
+    targets = {
+        rel.get('Id'): _resolve_target(rel.get('Target'))
+        for rel in rels.iter(f'{{{PKG_REL_NS}}}Relationship')
+    }
+
+    workbook = ElementTree.fromstring(zf.read(WORKBOOK_PART))
+    sheets = []
+    for sheet in workbook.iter(f'{{{MAIN_NS}}}sheet'):
+        sheets.append({
+            'name': sheet.get('name'),
+            'state': sheet.get('state', 'visible'),
+            'path': targets.get(sheet.get(f'{{{REL_NS}}}id')),
+        })
+
+    defined_names = [
+        (dn.get('name'), dn.get('localSheetId'), dn.text or '')
+        for dn in workbook.iter(f'{{{MAIN_NS}}}definedName')
+    ]
+    return sheets, defined_names
+
+
+def build_name_mapping(defined_names):
+    """
+    Creates the same sheet -> (cell_address -> named_range) mapping as update_formulas,
+    but from the raw defined names in xl/workbook.xml.
+
+    Sheet-scoped names (localSheetId) are ignored, like openpyxl's wb.defined_names,
+    and names defined by a formula are left out (see name_index.reference_destinations).
+
+    Parameters:
+    - defined_names: List of (name, local_sheet_id, refers_to) tuples from read_workbook_info
+
+    Returns:
+    - Dict of sheet name -> {cell address ('L404') or range ('L200:L210') -> defined name}
+    """
+    index = NameIndex()
+    for name, local_sheet_id, refers_to in defined_names:
+        if local_sheet_id is not None:
+            continue
+        index.add(name, reference_destinations(refers_to))
+    return index.mapping
+
+
+# Attributes that tie an <f> element to a shared formula group
+_SHARED_ATTRIBUTES = re.compile(rb'\s(?:t|ref|si)="[^"]*"')
+
+
+def _attribute(attr_text, name):
+    """Returns the value of an XML attribute from raw attribute text, or None."""
+    found = re.search(r'(?:^|\s)' + name + r'="([^"]*)"', attr_text)
+    return found.group(1) if found else None
+
+
+class _SheetXmlRewriter:
+    """
+    Rewrites the <f> elements of one worksheet part while streaming it.
+
+    Everything outside the formula text is passed through unchanged. A
+    shared formula group is rewritten as one unit: the master is rewritten
+    once and keeps its shared range, and a dependent stays an empty shared
+    <f> as long as translating the new master to its cell gives the same
+    text as rewriting the dependent itself. That holds for names of
+    absolute references, so filled-down groups stay shared and the file
+    does not grow. Only the dependents where the two differ (a relative
+    reference that is named in some rows only) are written out as plain
+    formulas. Array formulas keep their t="array" and ref attributes.
+
+    Translating needs the address of the cell, which is taken from its
+    optional r attribute. A group whose master cell has no r is left as it
+    is; a dependent without one stays shared with its (rewritten) master.
+    """
+
+    def __init__(self, rewriter, sheet_name, prefix):
+        self.rewriter = rewriter
+        self.sheet_name = sheet_name
+        self.prefix = prefix
+        self.updated = 0
+        # Imported here so that reading sheet names does not load openpyxl
+        from openpyxl.formula.translate import Translator
+        self.translator = Translator
+        # si -> (Translator for the original master formula,
+        #        Translator for the rewritten master or None if it is unchanged)
+        self.shared = {}
+        # Whether a shared formula without a cell address was already reported
+        self.warned = False
+        p = re.escape(prefix)
+        self.cell_close = b'</' + prefix + b'c>'
+        self.formula_pattern = re.compile(
+            rb'<' + p + rb'f((?:\s[^>]*?)?)(?:/>|>([^<]*)</' + p + rb'f>)'
+        )
+        self.cell_open_pattern = re.compile(rb'<' + p + rb'c\s[^>]*?\br="([A-Z]+\d+)"')
+
+    def _formula_element(self, attrs, text):
+        """Builds an <f> element with the given raw attributes and formula text."""
+        body = escape(text[1:]).encode('utf-8')
+        return b'<' + self.prefix + b'f' + attrs + b'>' + body + b'</' + self.prefix + b'f>'
+
+    def _rewrite(self, formula):
+        formula_new = self.rewriter.rewrite(formula, self.sheet_name)
+        if formula_new is not formula:
+            self.updated += 1
+        return formula_new
+
+    def _cell_coordinate(self, segment, position):
+        """Returns the r attribute ('B7') of the <c> element enclosing position, or None if it has none."""
+        cell_start = segment.rfind(b'<' + self.prefix + b'c', 0, position)
+        if cell_start < 0:
+            return None
+        match = self.cell_open_pattern.match(segment, cell_start)
+        return match.group(1).decode('ascii') if match else None
+
+    def process(self, segment):
+        """Rewrites the formulas in a segment that only contains complete <c> elements."""
+        return self.formula_pattern.sub(lambda match: self._replace(match, segment), segment)
+
+    def _replace(self, match, segment):
+        attrs, text = match.group(1), match.group(2)
+        attr_text = attrs.decode('utf-8')
+        formula_type = _attribute(attr_text, 't')
+
+        if formula_type == 'dataTable':
+            return match.group()
+
+        if formula_type != 'shared':
+            if not text:
+                return match.group()
+            formula = '=' + html.unescape(text.decode('utf-8'))
+            formula_new = self._rewrite(formula)
+            if formula_new is formula:
+                return match.group()
+            return self._formula_element(attrs, formula_new)
+
+        # Shared formula: find the coordinate of the enclosing cell
+        coord = self._cell_coordinate(segment, match.start())
+        si = _attribute(attr_text, 'si')
+        if coord is None:
+            if not self.warned:
+                log.warning("Sheet '%s': shared formula in a cell without an address; its group is not rewritten",
+                            self.sheet_name)
+                self.warned = True
+            if text:
+                self.shared[si] = None
+            return match.group()
+
+        if text:
+            # Master of the group: rewritten in place, the group stays shared
+            formula = '=' + html.unescape(text.decode('utf-8'))
+            formula_new = self._rewrite(formula)
+            if formula_new is formula:
+                self.shared[si] = (self.translator(formula, origin=coord), None)
+                return match.group()
+            self.shared[si] = (self.translator(formula, origin=coord), self.translator(formula_new, origin=coord))
+            return self._formula_element(attrs, formula_new)
+
+        # Dependent of the group
+        if self.shared.get(si) is None:
+            return match.group()
+        translator, translator_new = self.shared[si]
+        formula = translator.translate_formula(coord)
+        formula_new = self._rewrite(formula)
+        if translator_new is None:
+            if formula_new is formula:
+                return match.group()
+        elif translator_new.translate_formula(coord) == formula_new:
+            return match.group()  # The rewritten master yields the same text
+        return self._formula_element(_SHARED_ATTRIBUTES.sub(b'', attrs), formula_new)
+
+
+def rewrite_sheet_xml(src, dst, rewriter, sheet_name, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Streams a worksheet part from src to dst, rewriting only the formula text.
+
+    The part is processed in chunks cut after the last complete </c>, so
+    memory use does not depend on the size of the sheet.
+
+    Parameters:
+    - src: Readable binary file object of the worksheet XML
+    - dst: Writable binary file object
+    - rewriter: FormulaRewriter built from the workbook's defined names
+    - sheet_name: Name of the sheet the part belongs to
+    - chunk_size: Number of bytes read at a time
+
+    Returns:
+    - Number of formulas that were rewritten.
+    """
+    sheet_rewriter = None
+    buffer = b''
+    while True:
+        chunk = src.read(chunk_size)
+        buffer += chunk
+        if sheet_rewriter is None:
+            root = re.search(rb'<(\w+:)?worksheet\b', buffer)
+            if root is None and chunk:
+                continue
+            prefix = (root.group(1) or b'') if root else b''
+            sheet_rewriter = _SheetXmlRewriter(rewriter, sheet_name, prefix)
+
+        if not chunk:
+            dst.write(sheet_rewriter.process(buffer))
+            break
+
+        cut = buffer.rfind(sheet_rewriter.cell_close)
+        if cut < 0:
+            continue
+        cut += len(sheet_rewriter.cell_close)
+        dst.write(sheet_rewriter.process(buffer[:cut]))
+        buffer = buffer[cut:]
+
+    return sheet_rewriter.updated
+
+
+def _copy_info(info):
+    """
+    Creates a new ZipInfo carrying over the metadata of an existing member.
+
+    The uncompressed size is carried over as well, so zipfile only adds
+    ZIP64 extensions to members that are large enough to need them.
+    """
+    new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.external_attr = info.external_attr
+    new_info.create_system = info.create_system
+    new_info.comment = info.comment
+    new_info.file_size = info.file_size
+    return new_info
+
+
+def _needs_zip64(info):
+    """
+    Returns True if a rewritten copy of a member might outgrow the plain zip limits.
+
+    Names can be longer than the references they replace, so a rewritten
+    sheet part is given ample headroom over its original size.
+    """
+    return info.file_size * 2 > zipfile.ZIP64_LIMIT
+
+
+def read_sheet_names(file_path):
+    """
+    Returns the sheet names of an .xlsx file by reading only xl/workbook.xml.
+
+    Parameters:
+    - file_path: Path to the .xlsx file
+    """
+    with zipfile.ZipFile(file_path) as zf:
+        sheets, _ = read_workbook_info(zf)
+    return [sheet['name'] for sheet in sheets]
+
+
+def _defined_names_xml(xml, names, prefix):
+    """
+    Returns workbook.xml text with the given global defined names added or replaced.
+
+    Parameters:
+    - xml: Text of xl/workbook.xml
+    - names: List of (name, refers_to) tuples
+    - prefix: Namespace prefix of the workbook elements ('' or e.g. 'x:')
+    """
+    p = re.escape(prefix)
+    # Excel compares names case-insensitively; a name given twice keeps its last target
+    names = list({name.lower(): (name, refers_to) for name, refers_to in names}.values())
+    replaced = {name.lower() for name, _ in names}
+
+    def drop_replaced(match):
+        attr_text = match.group(1)
+        name = html.unescape(_attribute(attr_text, 'name') or '')
+        if _attribute(attr_text, 'localSheetId') is None and name.lower() in replaced:
+            return ''
+        return match.group()
+
+    xml = re.sub(
+        r'<' + p + r'definedName(\s[^>]*?)(?:/>|>.*?</' + p + r'definedName>)',
+        drop_replaced, xml, flags=re.DOTALL
+    )
+    elements = ''.join(
+        f'<{prefix}definedName name={quoteattr(name)}>{escape(refers_to)}</{prefix}definedName>'
+        for name, refers_to in names
+    )
+
+    # Append to the existing block (also if it became empty above)
+    block_end = re.search(r'</' + p + r'definedNames>', xml)
+    if block_end is not None:
+        return xml[:block_end.start()] + elements + xml[block_end.start():]
+    empty_block = re.search(r'<' + p + r'definedNames\s*/>', xml)
+    block = f'<{prefix}definedNames>{elements}</{prefix}definedNames>'
+    if empty_block is not None:
+        return xml[:empty_block.start()] + block + xml[empty_block.end():]
+
+    # No block yet: it goes after sheets/functionGroups/externalReferences
+    insert_at = None
+    for element in ['sheets', 'functionGroups', 'externalReferences']:
+        found = re.search(r'</' + p + element + r'>|<' + p + element + r'\b[^>]*/>', xml)
+        if found is not None:
+            insert_at = found.end()
+    if insert_at is None:
+        raise ValueError("xl/workbook.xml has no <sheets> element")
+    return xml[:insert_at] + block + xml[insert_at:]
+
+
+def patch_defined_names(file_path, output_path, names):
+    """
+    Adds or replaces global defined names by patching only xl/workbook.xml.
+
+    Every other member of the zip is copied with its original content and
+    metadata (date, compression method, attributes); the sheets are never
+    parsed. zipfile recompresses the copies, so the compressed bytes can
+    differ from the source. Existing global names with the
+    same name (compared case-insensitively, like Excel does) are replaced;
+    sheet-scoped names are left alone.
+
+    Parameters:
+    - file_path: Path to the source .xlsx file
+    - output_path: Path to write the patched file to (may equal file_path)
+    - names: List of (name, refers_to) tuples, e.g. ('display_code_1657', "'Tax Calculation'!$L$404")
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    fd, temp_path = tempfile.mkstemp(suffix='.xlsx', dir=output_dir)
+    os.close(fd)
+
+    try:
+        with zipfile.ZipFile(file_path) as src_zip, \
+                zipfile.ZipFile(temp_path, 'w', allowZip64=True) as dst_zip:
+            for info in src_zip.infolist():
+                if info.filename != WORKBOOK_PART:
+                    with src_zip.open(info) as src, dst_zip.open(_copy_info(info), 'w') as dst:
+                        shutil.copyfileobj(src, dst, DEFAULT_CHUNK_SIZE)
+                    continue
+                xml = src_zip.read(info).decode('utf-8')
+                root = re.search(r'<(\w+:)?workbook\b', xml)
+                prefix = (root.group(1) or '') if root else ''
+                dst_zip.writestr(_copy_info(info), _defined_names_xml(xml, names, prefix).encode('utf-8'))
+
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def stream_update_formulas(file_path, output_path, sheet_names, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Updates formulas in the given sheets by editing the sheet XML inside the .xlsx zip.
+
+    The openpyxl object model is never loaded: defined names are read from
+    xl/workbook.xml, each selected sheet part is streamed through
+    rewrite_sheet_xml and every other member is copied with its original
+    content and metadata (see patch_defined_names). Hidden
+    sheets are skipped, like in update_formulas. Merged and image-anchored
+    cells are not skipped: those checks only exist because openpyxl cannot
+    assign to merged cells, which does not apply to raw XML.
+
+    Parameters:
+    - file_path: Path to the source .xlsx file
+    - output_path: Path to write the updated file to (may equal file_path)
+    - sheet_names: Names of the sheets to update
+    - chunk_size: Number of bytes read from a sheet part at a time
+
+    Returns:
+    - Dict of sheet name -> number of formulas rewritten, in workbook order.
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    fd, temp_path = tempfile.mkstemp(suffix='.xlsx', dir=output_dir)
+    os.close(fd)
+
+    results = {}
+    try:
+        with zipfile.ZipFile(file_path) as src_zip, \
+                zipfile.ZipFile(temp_path, 'w', allowZip64=True) as dst_zip:
+            sheets, defined_names = read_workbook_info(src_zip)
+            rewriter = FormulaRewriter(build_name_mapping(defined_names))
+
+            parts_to_update = {}
+            for sheet in sheets:
+                if sheet['name'] not in sheet_names:
+                    continue
+                if sheet['state'] in ['hidden', 'veryHidden']:
+                    log.info("Skipping hidden sheet: %s", sheet['name'])
+                    continue
+                parts_to_update[sheet['path']] = sheet['name']
+
+            for info in src_zip.infolist():
+                sheet_name = parts_to_update.get(info.filename)
+                if sheet_name is None:
+                    with src_zip.open(info) as src, dst_zip.open(_copy_info(info), 'w') as dst:
+                        shutil.copyfileobj(src, dst, chunk_size)
+                    continue
+                with src_zip.open(info) as src, \
+                        dst_zip.open(_copy_info(info), 'w', force_zip64=_needs_zip64(info)) as dst:
+                    log.info("Processing sheet: %s", sheet_name)
+                    with get_metrics().phase('stream_rewrite'):
+                        results[sheet_name] = rewrite_sheet_xml(src, dst, rewriter, sheet_name, chunk_size)
+                    get_metrics().count('formulas_rewritten', results[sheet_name])
+
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return {sheet['name']: results[sheet['name']] for sheet in sheets if sheet['name'] in results}